@@ -1,10 +1,23 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
 from typing import Callable, Optional
 
 from fastapi import FastAPI, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel
 
-from app.src.agent.graph import process_input_message
+from app.src.agent.graph import (
+    process_input_message, process_input_message_async, stream_input_message
+)
+from app.src.utils import get_config
+from app.src.lifecycle import lifecycle
+from app.src.metrics import REQUEST_SECONDS, start_request, end_request
+
+
+config = get_config()
 
 
 # Исключение на стороне FastAPI
@@ -40,13 +53,42 @@ class Answer(BaseModel):
 # Обработчик запросов
 # По сути, обертка над _process_func, обрабатывающая исключения
 class RequestHandler:
-    def __init__(self):
+    def __init__(self, max_in_flight: int, queue_timeout: float):
         self._process_func: Optional[Callable] = None
+        self._async_process_func: Optional[Callable] = None
+        self._stream_func: Optional[Callable] = None
+        # Ограничиваем число одновременно обрабатываемых вопросов,
+        # остальные ждут своей очереди не дольше queue_timeout секунд
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._queue_timeout = queue_timeout
     
     def set_process_function(self, func: Callable):
         if not callable(func):
             raise ValueError('Process function must be callable')
         self._process_func = func
+
+    def set_async_process_function(self, func: Callable):
+        if not asyncio.iscoroutinefunction(func):
+            raise ValueError('Async process function must be a coroutine function')
+        self._async_process_func = func
+
+    def set_stream_function(self, func: Callable):
+        if not callable(func):
+            raise ValueError('Stream function must be callable')
+        self._stream_func = func
+
+    async def _acquire(self):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self._queue_timeout)
+        except asyncio.TimeoutError:
+            raise LocalAPIException(details='Server is busy, try again later.')
+
+    @staticmethod
+    def _check_response(response):
+        required_keys = {'answer', 'source_documents', 'session_id'}
+        if not all(key in response for key in required_keys):
+            raise ExternalAPIException(details='Bad response format.')
+        return response
     
     def process_request(self, session_id: str, question: str):
         if self._process_func is None:
@@ -54,21 +96,112 @@ class RequestHandler:
         
         try:
             response = self._process_func(session_id, question)
-            required_keys = {'answer', 'source_documents', 'session_id'}
-            if not all(key in response for key in required_keys):
-                raise ExternalAPIException(details='Bad response format.')
-            return response
+            return self._check_response(response)
         except Exception as e:
             raise ExternalAPIException(f'Unexpected error: {str(e)}')
-        
 
-app = FastAPI()
-request_handler = RequestHandler()
+    async def aprocess_request(self, session_id: str, question: str):
+        if self._async_process_func is None:
+            raise LocalAPIException(details='No async process function registered on server.')
+
+        await self._acquire()
+        try:
+            response = await self._async_process_func(session_id, question)
+            return self._check_response(response)
+        except Exception as e:
+            raise ExternalAPIException(f'Unexpected error: {str(e)}')
+        finally:
+            self._semaphore.release()
+
+    async def astream_request(self, session_id: str, question: str):
+        '''
+        Отдает события _stream_func построчно в формате NDJSON.
+        Место в очереди занимается до начала ответа, поэтому перегрузка
+        по-прежнему отдается клиенту обычной ошибкой 503. Освобождает его
+        сам ответ (см. SlotStreamingResponse), а не генератор событий:
+        если клиент отключится раньше, чем Starlette начнет читать генератор,
+        его finally так и не выполнится.
+        '''
+
+        if self._stream_func is None:
+            raise LocalAPIException(details='No stream function registered on server.')
+
+        await self._acquire()
+
+        async def events():
+            try:
+                async for event in self._stream_func(session_id, question):
+                    yield json.dumps(event, ensure_ascii=False) + '\n'
+            except Exception as e:
+                # Заголовки уже отправлены, поэтому ошибку сообщаем отдельным событием
+                yield json.dumps(
+                    {'type': 'error', 'message': f'Unexpected error: {str(e)}'},
+                    ensure_ascii=False
+                ) + '\n'
+
+        try:
+            return SlotStreamingResponse(events(), self._semaphore.release, media_type='application/x-ndjson')
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+
+class SlotStreamingResponse(StreamingResponse):
+    '''
+    Потоковый ответ, занимающий место в очереди RequestHandler.
+    Место освобождается, когда ответ отдан, прерван или так и не начат.
+    '''
+
+    def __init__(self, content, release: Callable, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    lifecycle.startup()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+request_handler = RequestHandler(
+    max_in_flight=config.concurrency.max_in_flight,
+    queue_timeout=config.concurrency.queue_timeout
+)
 request_handler.set_process_function(process_input_message)
+request_handler.set_async_process_function(process_input_message_async)
+request_handler.set_stream_function(stream_input_message)
 
 def get_handler():
     return request_handler
 
+@app.middleware('http')
+async def server_timing(request: Request, call_next):
+    # Этапы запроса (ноды, LLM, эмбеддинги, поиск) собираются в Server-Timing и в гистограммы.
+    # У потоковых ответов заголовок уходит до генерации, поэтому там он покрывает только начало
+    if not config.metrics.enabled:
+        return await call_next(request)
+    timings, token = start_request()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        if config.metrics.server_timing:
+            response.headers['Server-Timing'] = timings.header(total=time.perf_counter() - start)
+        return response
+    finally:
+        # Шаблон пути, а не сам путь - чтобы не плодить ряды метрик
+        route = getattr(request.scope.get('route'), 'path', 'unmatched')
+        REQUEST_SECONDS.labels(route, str(status)).observe(time.perf_counter() - start)
+        end_request(token)
+
 @app.exception_handler(LocalAPIException)
 def local_api_exception_handler(request: Request, exc: LocalAPIException):
     return JSONResponse(
@@ -84,14 +217,36 @@ def external_api_exception_handler(request: Request, exc: ExternalAPIException):
         content={'message': f'Oops! External API did something... {exc.details}'}
     )
 
+@app.get('/health')
+def health():
+    return {'status': 'ok'}
+
+@app.get('/ready')
+def ready():
+    # Пока идет прогрев модели, балансировщик не должен слать сюда запросы
+    if not lifecycle.ready:
+        return JSONResponse(
+            status_code=503,
+            content={'ready': False, 'error': lifecycle.error}
+        )
+    return {'ready': True, 'timings': lifecycle.timings}
+
+@app.get('/metrics')
+def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.post('/ask', response_model=Answer)
-def ask_question(q: Question, handler: RequestHandler = Depends(get_handler)):
-    response = handler.process_request(q.session_id, q.question)
+async def ask_question(q: Question, handler: RequestHandler = Depends(get_handler)):
+    response = await handler.aprocess_request(q.session_id, q.question)
     return Answer(
         answer=response['answer'],
         source_documents=response['source_documents'],
         session_id=response['session_id']
     )
 
+@app.post('/ask/stream')
+async def ask_question_stream(q: Question, handler: RequestHandler = Depends(get_handler)):
+    return await handler.astream_request(q.session_id, q.question)
+
 #def set_process_function(func: Callable):
 #    request_handler.set_process_function(func)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import argparse
+import json
+import re
+import time
+
+import numpy as np
+
+from app.src.utils import get_config
+from app.src.vectorstore.embedding_backends import create_backend
+
+
+config = get_config()
+
+
+# Сравнение бэкендов эмбеддингов с fp32 sentence-transformers:
+#   python -m app.benchmarks.embeddings --backend onnx --quantize
+#   python -m app.benchmarks.embeddings --backend onnx --no-quantize --threads 4
+#   python -m app.benchmarks.embeddings --model intfloat/multilingual-e5-small --corpus texts.txt
+# Корпус по умолчанию - тексты из коллекции documents, запросы - первые предложения корпуса.
+def load_corpus(path: str, limit: int):
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        from app.src.vectorstore.vectorstore import get_vector_store
+        texts = get_vector_store().get(include=['documents'], limit=limit)['documents']
+    return texts[:limit]
+
+
+def load_queries(path: str, corpus: list[str], count: int, seed: int = 0):
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()][:count]
+    # Без готовых запросов берем начало случайных документов - для сравнения
+    # бэкендов между собой важна не реалистичность, а одинаковый набор
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(corpus), size=min(count, len(corpus)), replace=False)
+    return [' '.join(re.split(r'(?<=[.!?])\s', corpus[i])[0].split()[:16]) for i in picked]
+
+
+def _top_k(query_vectors: np.ndarray, doc_vectors: np.ndarray, k: int):
+    sims = query_vectors @ doc_vectors.T
+    k = min(k, doc_vectors.shape[0])
+    return np.argpartition(-sims, k - 1, axis=1)[:, :k]
+
+
+def run_backend(name: str, corpus: list[str], queries: list[str], **settings):
+    start = time.perf_counter()
+    backend = create_backend(name, **settings)
+    load_seconds = time.perf_counter() - start
+
+    # Один прогон вхолостую, чтобы не мерить ленивую инициализацию
+    backend.embed_query(queries[0])
+
+    start = time.perf_counter()
+    doc_vectors = np.asarray(backend.embed_documents(corpus), dtype=np.float32)
+    docs_seconds = time.perf_counter() - start
+
+    latencies = []
+    query_vectors = []
+    for query in queries:
+        start = time.perf_counter()
+        query_vectors.append(backend.embed_query(query))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    backend.embed_queries(queries)
+    batch_seconds = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    report = {
+        'backend': name,
+        'settings': {key: value for key, value in settings.items() if value is not None},
+        'load_seconds': round(load_seconds, 3),
+        'documents_per_second': round(len(corpus) / docs_seconds, 2),
+        'queries_per_second_batched': round(len(queries) / batch_seconds, 2),
+        'query_latency_ms': {
+            'p50': round(float(np.percentile(latencies_ms, 50)), 2),
+            'p95': round(float(np.percentile(latencies_ms, 95)), 2),
+            'mean': round(float(latencies_ms.mean()), 2),
+        },
+    }
+    return report, np.asarray(query_vectors, dtype=np.float32), doc_vectors
+
+
+def recall_at_k(baseline, candidate, k: int):
+    '''
+    Доля документов из top-k эталона (fp32), которые кандидат тоже ставит в top-k.
+    '''
+
+    base_top = _top_k(*baseline, k)
+    cand_top = _top_k(*candidate, k)
+    hits = [len(set(b) & set(c)) / len(b) for b, c in zip(base_top, cand_top)]
+    return float(np.mean(hits))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embedding backend benchmark against the fp32 baseline.')
+    parser.add_argument('--backend', default='onnx', help='Backend to compare: sentence-transformers or onnx.')
+    parser.add_argument('--model', default=None, help='Model name (default: embeddings.model_name).')
+    parser.add_argument('--quantize', dest='quantize', action='store_true', default=None,
+                        help='Use int8 dynamic quantization (onnx only).')
+    parser.add_argument('--no-quantize', dest='quantize', action='store_false')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads (0 - all cores).')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--corpus', default=None, help='Text file, one passage per line.')
+    parser.add_argument('--queries', default=None, help='Text file, one query per line.')
+    parser.add_argument('--limit', type=int, default=1000, help='Max passages to embed.')
+    parser.add_argument('--num-queries', type=int, default=100)
+    parser.add_argument('-k', type=int, default=config.semantic_search.k)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.limit)
+    queries = load_queries(args.queries, corpus, args.num_queries)
+
+    common = {'model_name': args.model, 'threads': args.threads, 'batch_size': args.batch_size}
+    baseline_report, *baseline = run_backend('sentence-transformers', corpus, queries, **common)
+
+    candidate_settings = dict(common)
+    if args.backend == 'onnx':
+        candidate_settings['quantize'] = args.quantize
+    candidate_report, *candidate = run_backend(args.backend, corpus, queries, **candidate_settings)
+    candidate_report[f'recall@{args.k}'] = round(recall_at_k(baseline, candidate, args.k), 4)
+    candidate_report['speedup_documents'] = round(
+        candidate_report['documents_per_second'] / baseline_report['documents_per_second'], 2
+    )
+
+    report = {
+        'corpus_size': len(corpus),
+        'queries': len(queries),
+        'baseline': baseline_report,
+        'candidate': candidate_report,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
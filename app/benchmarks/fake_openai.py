@@ -0,0 +1,153 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from app.benchmarks.fakes import FakeChatModel
+
+
+# Локальный OpenAI-совместимый сервер для проверки llm_client (пул, лимиты, повторы, hedging):
+#   python -m app.benchmarks.fake_openai --latency-ms 200 --slow-rate 0.05 --slow-ms 3000
+#   OPENROUTER_BASE_URL=http://127.0.0.1:8766/v1 OPENROUTER_API_KEY=fake uvicorn app.api:app
+# Отвечает правилами FakeChatModel (теги, переформулировка, роутер, генерация, саммари),
+# умеет потоковый режим. Доля slow-rate ответов задерживается на slow-ms - это хвост
+# задержек, который должен срезать hedging; доля error-rate отвечает 500.
+_MESSAGE_TYPES = {'system': SystemMessage, 'user': HumanMessage}
+
+
+def to_messages(payload_messages: list[dict]):
+    messages = []
+    for message in payload_messages:
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        messages.append(_MESSAGE_TYPES.get(message['role'], AIMessage)(content=content))
+    return messages
+
+
+def _tool_calls(message: AIMessage, streaming: bool):
+    calls = []
+    for i, call in enumerate(message.tool_calls):
+        calls.append({
+            **({'index': i} if streaming else {}),
+            'id': call['id'],
+            'type': 'function',
+            'function': {'name': call['name'], 'arguments': json.dumps(call['args'], ensure_ascii=False)}
+        })
+    return calls
+
+
+def _usage(messages, message: AIMessage):
+    prompt = sum(len(str(m.content)) for m in messages) // 4
+    completion = max(1, len(str(message.content)) // 4)
+    return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+
+
+def completion(model: str, messages, message: AIMessage):
+    body = {'role': 'assistant', 'content': message.content or None}
+    if message.tool_calls:
+        body['tool_calls'] = _tool_calls(message, streaming=False)
+    return {
+        'id': f'chatcmpl-{uuid4().hex}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': body, 'finish_reason': 'tool_calls' if message.tool_calls else 'stop'}],
+        'usage': _usage(messages, message),
+    }
+
+
+def completion_chunks(model: str, messages, message: AIMessage):
+    base = {'id': f'chatcmpl-{uuid4().hex}', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model}
+    if message.tool_calls:
+        deltas = [{'role': 'assistant', 'content': None, 'tool_calls': _tool_calls(message, streaming=True)}]
+    else:
+        words = str(message.content).split(' ')
+        deltas = [{'role': 'assistant', 'content': ''}] + [
+            {'content': word if i == 0 else ' ' + word} for i, word in enumerate(words)
+        ]
+    for delta in deltas:
+        yield {**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}
+    yield {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'tool_calls' if message.tool_calls else 'stop'}]}
+    yield {**base, 'choices': [], 'usage': _usage(messages, message)}
+
+
+def make_handler(model: FakeChatModel, latency: float, slow_rate: float, slow_latency: float, error_rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send_json(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'Not found'}})
+                return
+
+            time.sleep(slow_latency if random.random() < slow_rate else latency)
+            if random.random() < error_rate:
+                self._send_json(500, {'error': {'message': 'Simulated failure', 'type': 'server_error'}})
+                return
+
+            messages = to_messages(payload.get('messages', []))
+            message = model._reply(model._site(messages), messages)
+            name = payload.get('model', 'fake')
+            if not payload.get('stream'):
+                self._send_json(200, completion(name, messages, message))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in completion_chunks(name, messages, message):
+                self._write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            self._write_chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+        def _write_chunk(self, text: str):
+            data = text.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible chat completions server with deterministic replies.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay before a typical response.')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Share of responses delayed by --slow-ms.')
+    parser.add_argument('--slow-ms', type=float, default=0.0, help='Delay of slow (tail) responses.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 500.')
+    args = parser.parse_args()
+
+    handler = make_handler(
+        FakeChatModel(), args.latency_ms / 1000, args.slow_rate, args.slow_ms / 1000, args.error_rate
+    )
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f'Fake OpenAI API on http://{args.host}:{args.port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from app.src.vectorstore.bm25 import tokenize
+from app.benchmarks.retrieval import load_fixtures
+
+
+# Локальная замена веб-поиска для тестов и бенчмарков (бэкенд http в web_search.py):
+#   python -m app.benchmarks.fake_search
+#   python -m app.benchmarks.fake_search --port 8765 --latency-ms 500 --error-rate 0.2
+# и в config.yaml: web_search.backend: http.
+# Ищет по корпусу app/benchmarks/fixtures пересечением слов, задержка и доля ошибок
+# задаются ключами - так проверяются дедлайн и circuit breaker без выхода в интернет.
+def search(corpus: list[dict], query: str, max_results: int):
+    query_terms = set(tokenize(query))
+    scored = []
+    for item in corpus:
+        score = len(query_terms & set(tokenize(item['text'])))
+        if score:
+            scored.append((score, item))
+    scored.sort(key=lambda pair: -pair[0])
+    return [
+        {'title': item['id'], 'link': item['source'], 'snippet': item['text']}
+        for _, item in scored[:max_results]
+    ]
+
+
+def make_handler(corpus: list[dict], latency: float, error_rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/search':
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            time.sleep(latency)
+            if random.random() < error_rate:
+                self.send_error(503, 'Simulated failure')
+                return
+
+            body = json.dumps(
+                search(corpus, params.get('q', [''])[0], int(params.get('n', ['4'])[0])),
+                ensure_ascii=False
+            ).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local web search stand-in over the fixture corpus.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay before every response.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503.')
+    args = parser.parse_args()
+
+    corpus, _ = load_fixtures()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(corpus, args.latency_ms / 1000, args.error_rate))
+    print(f'Fake web search on http://{args.host}:{args.port}/search')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
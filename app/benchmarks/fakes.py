@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from app.src.utils import load_prompt, PROMPTS_DIR
+
+
+class StageRecorder:
+    '''
+    Собирает длительности по этапам из разных потоков и считает по ним перцентили.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        report = {}
+        for stage, durations in sorted(self.durations.items()):
+            ms = np.array(durations) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            report[stage] = {
+                'count': len(ms),
+                'p50_ms': round(float(p50), 3),
+                'p95_ms': round(float(p95), 3),
+                'p99_ms': round(float(p99), 3),
+                'mean_ms': round(float(ms.mean()), 3),
+                'per_second': round(len(ms) / max(ms.sum() / 1000, 1e-9), 2),
+            }
+        return report
+
+
+class TimedEmbeddings(Embeddings):
+    '''
+    Обертка над эмбеддингами, которая записывает время каждого вызова в этап embed.
+    '''
+
+    def __init__(self, embeddings: Embeddings, recorder: StageRecorder):
+        self.embeddings = embeddings
+        self.recorder = recorder
+
+    def embed_query(self, text: str):
+        with self.recorder.timed('embed'):
+            return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts: list[str]):
+        with self.recorder.timed('embed'):
+            return self.embeddings.embed_queries(texts)
+
+    def embed_documents(self, texts: list[str]):
+        return self.embeddings.embed_documents(texts)
+
+
+# Простые правила вместо классификатора-LLM: основа слова - тег
+TAG_RULES = {
+    'решени': 'Решения', 'кейс': 'Кейсы', 'внедрени': 'Кейсы', 'проект': 'Кейсы',
+    'экспертиз': 'Экспертизы', 'заказчик': 'Клиенты', 'клиент': 'Клиенты',
+    'партнер': 'Партнеры', 'резюме': 'Карьера', 'ваканс': 'Карьера', 'почт': 'Контакты',
+    'адрес': 'Контакты', 'офис': 'Контакты', 'новост': 'Пресс-центр', 'компани': 'О компании',
+}
+QUESTION_WORDS = {'какие', 'какой', 'кто', 'где', 'дай', 'расскажи', 'перечисли', 'на', 'в', 'у', 'есть', 'про', 'можно'}
+
+
+class FakeChatModel(BaseChatModel):
+    '''
+    Детерминированная замена LLM для бенчмарков. Узнает вызов (теги, переформулировка,
+    роутер, генерация, саммари) по промпту и отвечает по простым правилам.
+    latency - искусственная задержка каждого вызова в секундах, чтобы
+    моделировать сетевую LLM; длительности пишутся в recorder как llm_<вызов>.
+    '''
+
+    latency: float = 0.0
+    recorder: object = None
+
+    @property
+    def _llm_type(self):
+        return 'benchmark-fake'
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    @staticmethod
+    def _signatures():
+        names = {
+            'tags': 'tag-getter-prompt.txt',
+            'reformulate': 'reformulation-prompt.txt',
+            'router': 'qr-prompt.txt',
+            'generate': 'generate-prompt.txt',
+            'summary': 'summary-prompt.txt',
+        }
+        return {site: load_prompt(os.path.join(PROMPTS_DIR, name))[:60] for site, name in names.items()}
+
+    def _site(self, messages):
+        first = str(messages[0].content)
+        for site, signature in self._signatures().items():
+            if first.startswith(signature):
+                return site
+        return 'generate'
+
+    @staticmethod
+    def _last_human(messages):
+        return next((str(m.content) for m in reversed(messages) if m.type == 'human'), '')
+
+    def _reply(self, site: str, messages):
+        if site == 'tags':
+            query = str(messages[0].content).rsplit('\n', 1)[-1].lower()
+            tags = sorted({tag for stem, tag in TAG_RULES.items() if stem in query})
+            return AIMessage(content=json.dumps(tags, ensure_ascii=False))
+        if site == 'reformulate':
+            words = [w for w in re.findall(r'[\w@.-]+', self._last_human(messages).lower()) if w not in QUESTION_WORDS]
+            return AIMessage(content=' '.join(words + ['Neoflex']))
+        if site == 'router':
+            return AIMessage(content='', tool_calls=[{
+                'name': 'retrieve_from_local',
+                'args': {'query': self._last_human(messages)},
+                'id': f'call_{uuid4().hex}',
+            }])
+        if site == 'summary':
+            return AIMessage(content='Пользователь спрашивал о компании Neoflex.')
+        context = str(messages[0].content)[len(load_prompt(os.path.join(PROMPTS_DIR, 'generate-prompt.txt'))):]
+        return AIMessage(content=context.split('\n\n')[0][:300] or 'Не знаю.')
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        site = self._site(messages)
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        message = self._reply(site, messages)
+        if self.recorder is not None:
+            self.recorder.record(f'llm_{site}', time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.src.utils import get_config, tag_metadata
+from app.benchmarks.fakes import StageRecorder, TimedEmbeddings, FakeChatModel
+
+
+config = get_config()
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+# Воспроизводимый бенчмарк ретривера и ответов (замена ranking_difference.ipynb):
+#   python -m app.benchmarks.retrieval
+#   python -m app.benchmarks.retrieval --repeats 20 --llm-latency-ms 300 --concurrency 8
+#   python -m app.benchmarks.retrieval --compare app/benchmarks/results/<прошлый прогон>.json
+# Корпус и вопросы - app/benchmarks/fixtures, LLM и эмбеддинги детерминированные,
+# индекс строится во временной папке, рабочая база и кэши не трогаются.
+def load_fixtures():
+    with open(os.path.join(FIXTURES_DIR, 'corpus.jsonl'), 'r', encoding='utf-8') as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    with open(os.path.join(FIXTURES_DIR, 'questions.json'), 'r', encoding='utf-8') as f:
+        questions = json.load(f)
+    return corpus, questions
+
+
+def configure(workdir: str):
+    # Все хранилища - во временной папке, кэши ответов и LLM выключены, чтобы мерить конвейер
+    config.embeddings.backend = 'hashing'
+    config.embedding_cache.enabled = False
+    config.answer_cache.enabled = False
+    config.llm_cache.enabled = False
+    config.memory.checkpointer = 'memory'
+    config.vectorstore.backend = 'mmap'
+    config.vectorstore.mmap.path = os.path.join(workdir, 'mmap_index')
+    config.bm25.path = os.path.join(workdir, 'bm25')
+    config.ingestion.manifest_path = os.path.join(workdir, 'ingest_manifest.json')
+    config.llm_cache.path = os.path.join(workdir, 'llm_cache.sqlite3')
+    config.embedding_cache.path = os.path.join(workdir, 'embedding_cache.sqlite3')
+    os.environ.setdefault('OPENROUTER_API_KEY', 'benchmark')
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def quality_metrics(results, relevant, embeddings, k: int, report_distance: bool):
+    '''
+    Метрики качества выдачи, посчитанные сразу по всем вопросам.
+    Списки разной длины дополняются до k, пустые ячейки маскируются.
+
+    Args:
+      results: по списку пар документ-скор на вопрос.
+      relevant: по множеству fixture_id релевантных документов на вопрос.
+      embeddings: объект Embeddings для подсчета разнообразия выдачи.
+      k: глубина выдачи.
+      report_distance: скоры выдачи - L2-расстояния плотного поиска, их среднее
+        и разброс имеют смысл. У многошагового поиска скор - нормированный RRF
+        (шкала зависит от числа слитых списков) или расстояние, и в обоих случаях
+        с поправкой на теги, так что с расстояниями он несравним и не выводится.
+
+    Returns:
+      словарь метрик: hit@k, recall@k, MRR, разнообразие и, при report_distance,
+      среднее расстояние и его разброс.
+    '''
+
+    n = len(results)
+    valid = np.zeros((n, k), dtype=bool)
+    hits = np.zeros((n, k), dtype=bool)
+    scores = np.full((n, k), np.nan, dtype=np.float32)
+    texts = [[''] * k for _ in range(n)]
+
+    for q, docs in enumerate(results):
+        for i, (doc, score) in enumerate(docs[:k]):
+            valid[q, i] = True
+            hits[q, i] = doc.metadata.get('fixture_id') in relevant[q]
+            scores[q, i] = score
+            texts[q][i] = doc.page_content
+
+    n_relevant = np.array([len(r) for r in relevant], dtype=np.float32)
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, np.inf)
+
+    # Разнообразие: 1 - средняя попарная косинусная близость документов выдачи.
+    # Одна батчевая матрица Грама на все вопросы вместо двойного цикла по парам
+    vectors = np.asarray(embeddings.embed_documents([t for row in texts for t in row]), dtype=np.float32)
+    vectors = vectors.reshape(n, k, -1)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=2, keepdims=True), 1e-12, None)
+    gram = np.einsum('qid,qjd->qij', vectors, vectors)
+    pairs = valid[:, :, np.newaxis] & valid[:, np.newaxis, :] & np.triu(np.ones((k, k), dtype=bool), 1)
+    pair_counts = pairs.sum(axis=(1, 2))
+    mean_similarity = (gram * pairs).sum(axis=(1, 2)) / np.maximum(pair_counts, 1)
+    diversity = np.where(pair_counts > 0, 1 - mean_similarity, np.nan)
+
+    metrics = {
+        f'hit@{k}': round(float(hits.any(axis=1).mean()), 4),
+        f'recall@{k}': round(float((hits.sum(axis=1) / np.maximum(n_relevant, 1)).mean()), 4),
+        'mrr': round(float((1 / first_hit).mean()), 4),
+        'diversity': round(float(np.nanmean(diversity)), 4),
+        'mean_results': round(float(valid.sum(axis=1).mean()), 2),
+    }
+    if report_distance:
+        metrics['mean_distance'] = round(float(np.nanmean(scores)), 4)
+        metrics['distance_std'] = round(float(np.nanstd(scores)), 4)
+    return metrics
+
+
+def compare(report: dict, baseline_path: str, tolerance: float, min_delta_ms: float):
+    '''
+    Сравнивает этапы с прошлым прогоном и возвращает список регрессий по p95.
+    Регрессия - рост p95 больше чем на tolerance и больше чем на min_delta_ms
+    (иначе субмиллисекундные этапы постоянно "регрессируют" от шума).
+    '''
+
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    print(f'{"stage":<28}{"p50 old":>10}{"p50 new":>10}{"p95 old":>10}{"p95 new":>10}{"delta":>9}')
+    for phase in ('retrieval', 'answer'):
+        for stage, new in report['stages'][phase].items():
+            old = baseline.get('stages', {}).get(phase, {}).get(stage)
+            if old is None:
+                continue
+            delta = (new['p95_ms'] - old['p95_ms']) / max(old['p95_ms'], 1e-6)
+            grew_ms = new['p95_ms'] - old['p95_ms']
+            flag = ' !' if delta > tolerance and grew_ms > min_delta_ms else ''
+            print(f'{phase + "." + stage:<28}{old["p50_ms"]:>10.2f}{new["p50_ms"]:>10.2f}'
+                  f'{old["p95_ms"]:>10.2f}{new["p95_ms"]:>10.2f}{delta:>+8.0%}{flag}')
+            if flag:
+                regressions.append(f'{phase}.{stage}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproducible retrieval and answer benchmark on the fixture corpus.')
+    parser.add_argument('--repeats', type=int, default=10, help='How many times to run every question.')
+    parser.add_argument('--llm-latency-ms', type=float, default=0.0, help='Simulated latency of every LLM call.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Parallel requests in the answer phase.')
+    parser.add_argument('--output', default=None, help='Where to save the JSON report.')
+    parser.add_argument('--compare', default=None, help='Previous JSON report to compare p95 against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative p95 growth.')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='Ignore p95 growth below this many ms.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='neoflex-bench-')
+    try:
+        configure(workdir)
+        report = run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'retrieval-{report["meta"]["revision"]}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report['quality'], ensure_ascii=False, indent=2))
+    print(f'Report saved to {output}')
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f'p95 regressions over {args.tolerance:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+def run(args):
+    # Модули агента импортируются только после configure: часть настроек читается при импорте
+    import app.src.agent.llm as llm_module
+    import app.src.vectorstore.vectorstore as vectorstore
+    from app.src.vectorstore.embedding_backends import create_backend
+
+    retrieval_recorder = StageRecorder()
+    backend = create_backend('hashing')
+    timed_embeddings = TimedEmbeddings(backend, retrieval_recorder)
+    fake_llm = FakeChatModel(latency=args.llm_latency_ms / 1000, recorder=retrieval_recorder)
+    llm_module.llm = fake_llm
+    vectorstore._embeddings = timed_embeddings
+
+    from app.src.ingestion.indexer import sync_documents
+    from app.src.agent.retrieval import retrieve, search_variants
+    from app.src.agent import graph
+
+    corpus, questions = load_fixtures()
+    sync_documents([
+        Document(
+            page_content=item['text'],
+            metadata={'source': item['source'], 'tags': ' '.join(item['tags']),
+                      'fixture_id': item['id'], **tag_metadata(item['tags'])}
+        )
+        for item in corpus
+    ])
+
+    texts = [item['question'] for item in questions]
+    relevant = [set(item['relevant']) for item in questions]
+    k = config.semantic_search.k
+
+    # Этапы ретривера: берем тайминги, которые retrieve считает сам
+    multistep, trivial = [], []
+    start = time.perf_counter()
+    for repeat in range(args.repeats):
+        for question in texts:
+            docs, timings = retrieve(question)
+            for stage, seconds in timings.items():
+                retrieval_recorder.record(stage, seconds)
+            if repeat == 0:
+                multistep.append(docs)
+    retrieval_seconds = time.perf_counter() - start
+
+    for question in texts:
+        with retrieval_recorder.timed('trivial_search'):
+            trivial.append(search_variants([question])[0])
+
+    # Ответы целиком через граф: роутер, инструмент, генерация
+    answer_recorder = StageRecorder()
+    timed_embeddings.recorder = answer_recorder
+    fake_llm.recorder = answer_recorder
+
+    def answer(item):
+        index, question = item
+        with answer_recorder.timed('answer'):
+            graph.process_input_message(f'benchmark-{index}', question)
+
+    jobs = list(enumerate(texts * args.repeats))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(answer, jobs))
+    answer_seconds = time.perf_counter() - start
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'corpus_size': len(corpus),
+            'questions': len(texts),
+            'repeats': args.repeats,
+            'llm_latency_ms': args.llm_latency_ms,
+            'concurrency': args.concurrency,
+            'hybrid': config.hybrid.enabled,
+            'concurrent_retrieval': config.retrieval.concurrent,
+        },
+        'stages': {
+            'retrieval': retrieval_recorder.summary(),
+            'answer': answer_recorder.summary(),
+        },
+        'throughput': {
+            'retrievals_per_second': round(len(texts) * args.repeats / retrieval_seconds, 2),
+            'answers_per_second': round(len(jobs) / answer_seconds, 2),
+        },
+        'quality': {
+            'multistep': quality_metrics(multistep, relevant, backend, k, report_distance=False),
+            'trivial': quality_metrics(trivial, relevant, backend, k, report_distance=True),
+        },
+    }
+
+
+if __name__ == '__main__':
+    main()
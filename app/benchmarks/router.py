@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from langchain_core.messages import HumanMessage
+
+from app.src.utils import get_config
+from app.src.agent.router import decide
+
+
+config = get_config()
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'router_questions.json')
+
+
+# Калибровка порога router.min_margin на отложенной выборке:
+#   python -m app.benchmarks.router
+#   python -m app.benchmarks.router --questions my_questions.json --max-false-rate 0.02
+# Центроиды тегов и эмбеддинги берутся из рабочего индекса (после app/ingest.py).
+# В выборке два списка: local - вопросы, которые можно сразу отправлять в поиск,
+# llm - те, что должен разобрать LLM-роутер (веб-поиск, общие вопросы, свежие события).
+# Для каждого порога считается доля local, обходящих LLM-роутер, и доля llm,
+# обходящих его по ошибке; предлагается наименьший порог с долей ошибок не выше --max-false-rate.
+def load_questions(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data['local'], data['llm']
+
+
+def candidate_margins(questions: list[str]):
+    '''
+    Returns:
+      отрыв (см. tagger.margin) для вопросов, которые роутер вообще мог бы
+      пропустить мимо LLM (есть признак вопроса о компании и нет других причин
+      отправить вопрос в LLM); для остальных - None.
+    '''
+
+    margins = []
+    for question in questions:
+        decision = decide([HumanMessage(content=question)])
+        margins.append(decision.confidence if decision.reason in ('pattern', 'low_confidence') else None)
+    return margins
+
+
+def sweep(local_margins, llm_margins, thresholds):
+    rows = []
+    for threshold in thresholds:
+        bypassed = sum(m is not None and m >= threshold for m in local_margins)
+        false_bypassed = sum(m is not None and m >= threshold for m in llm_margins)
+        rows.append({
+            'threshold': round(float(threshold), 4),
+            'local_bypass_rate': round(bypassed / max(len(local_margins), 1), 4),
+            'false_bypass_rate': round(false_bypassed / max(len(llm_margins), 1), 4),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate router.min_margin on labelled held-out questions.')
+    parser.add_argument('--questions', default=FIXTURES_PATH, help='JSON with "local" and "llm" question lists.')
+    parser.add_argument('--max-false-rate', type=float, default=0.0,
+                        help='Allowed share of "llm" questions that skip the LLM router.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+
+    local, llm = load_questions(args.questions)
+    local_margins, llm_margins = candidate_margins(local), candidate_margins(llm)
+    observed = [m for m in local_margins + llm_margins if m is not None]
+    thresholds = np.unique(np.round(observed + [0.0], 4)) if observed else np.array([0.0])
+
+    rows = sweep(local_margins, llm_margins, np.append(thresholds, thresholds[-1] + 1e-4))
+    suggested = next(row for row in rows if row['false_bypass_rate'] <= args.max_false_rate)
+    report = {
+        'questions': {'local': len(local), 'llm': len(llm)},
+        'current': config.router.min_margin,
+        'suggested': suggested,
+        'margins': {
+            'local': [None if m is None else round(m, 4) for m in local_margins],
+            'llm': [None if m is None else round(m, 4) for m in llm_margins],
+        },
+        'sweep': rows,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
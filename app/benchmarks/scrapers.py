@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from app.web_scrapers import scrape_all
+
+
+# Офлайн-проверка скрэпперов на сохраненной разметке сайта:
+#   python -m app.benchmarks.scrapers
+#   python -m app.benchmarks.scrapers --max-pages 2 --output scrapers.json
+# Страницы из app/benchmarks/fixtures/scrapers раздаются локальным HTTP-сервером
+# и повторяют селекторы и поведение neoflex.ru: переключение городов, пагинацию
+# и модальные окна клиентов. Нужен только браузер: playwright install firefox.
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'scrapers')
+
+# Что должно получиться на фикстурах
+EXPECTED = {'cities': 4, 'customers': 12, 'career': 'hr@neoflex.ru'}
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(host: str = '127.0.0.1', port: int = 0):
+    '''
+    Поднимает в фоновом потоке HTTP-сервер с фикстурами.
+
+    Returns:
+      пару (сервер, словарь urls для scrape_all).
+    '''
+
+    server = ThreadingHTTPServer((host, port), functools.partial(_QuietHandler, directory=FIXTURES_DIR))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://{host}:{server.server_address[1]}'
+    urls = {name: f'{base_url}/{name}.html' for name in ('contacts', 'customers', 'career')}
+    return server, urls
+
+
+def check(result: dict):
+    '''
+    Returns:
+      список расхождений с EXPECTED; пустой, если скрэпперы отработали верно.
+    '''
+
+    problems = []
+    if len(result['cities']) != EXPECTED['cities']:
+        problems.append(f'cities: {len(result["cities"])} != {EXPECTED["cities"]}')
+    if len(result['customers']) != EXPECTED['customers']:
+        problems.append(f'customers: {len(result["customers"])} != {EXPECTED["customers"]}')
+    if result['career'] != EXPECTED['career']:
+        problems.append(f'career: {result["career"]!r} != {EXPECTED["career"]!r}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the web scrapers against local HTML fixtures.')
+    parser.add_argument('--max-pages', type=int, default=4, help='Pages open at the same time.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+
+    server, urls = serve_fixtures()
+    try:
+        start = time.perf_counter()
+        result = asyncio.run(scrape_all(max_pages=args.max_pages, urls=urls))
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    problems = check(result)
+    report = {
+        'seconds': round(seconds, 2),
+        'cities': len(result['cities']),
+        'customers': len(result['customers']),
+        'career': result['career'],
+        'problems': problems,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from app.src.utils import get_config
+from app.src.agent.tagger import classifier, margin
+
+
+config = get_config()
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'tagger_questions.json')
+
+
+# Калибровка порога tagger.min_margin на отложенной выборке:
+#   python -m app.benchmarks.tagger
+#   python -m app.benchmarks.tagger --questions my_questions.json --min-accuracy 0.95
+# Центроиды тегов и эмбеддинги берутся из рабочего индекса (после app/ingest.py).
+# В выборке у каждого вопроса указаны ожидаемые теги. Для каждого порога считается
+# доля вопросов, которые классификатор размечает сам (остальные уходят в LLM),
+# и доля верных среди них (хотя бы один предсказанный тег есть среди ожидаемых);
+# предлагается наименьший порог с точностью не ниже --min-accuracy.
+def load_questions(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def predictions(questions: list[dict]):
+    '''
+    Returns:
+      по паре (отрыв, угадан ли тег) на вопрос. Теги берутся так же,
+      как в TagClassifier.classify, но без отсечения по порогу.
+    '''
+
+    rows = []
+    for item in questions:
+        scores = classifier.scores(item['question'])
+        if not scores:
+            rows.append((0.0, False))
+            continue
+        best = max(scores.values())
+        tags = {tag for tag, score in scores.items() if score >= best - classifier.margin}
+        rows.append((margin(scores), bool(tags & set(item['tags']))))
+    return rows
+
+
+def sweep(rows, thresholds):
+    result = []
+    for threshold in thresholds:
+        covered = [correct for value, correct in rows if value >= threshold]
+        result.append({
+            'threshold': round(float(threshold), 4),
+            'local_rate': round(len(covered) / max(len(rows), 1), 4),
+            'accuracy': round(sum(covered) / len(covered), 4) if covered else 1.0,
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate tagger.min_margin on labelled held-out questions.')
+    parser.add_argument('--questions', default=FIXTURES_PATH, help='JSON list of {"question", "tags"}.')
+    parser.add_argument('--min-accuracy', type=float, default=0.9,
+                        help='Required share of correct tags among questions tagged locally.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    rows = predictions(questions)
+    thresholds = np.unique(np.round([value for value, _ in rows] + [0.0], 4))
+
+    table = sweep(rows, np.append(thresholds, thresholds[-1] + 1e-4))
+    suggested = next(row for row in table if row['accuracy'] >= args.min_accuracy)
+    report = {
+        'questions': len(questions),
+        'current': config.tagger.min_margin,
+        'suggested': suggested,
+        'margins': [
+            {'question': item['question'], 'margin': round(value, 4), 'correct': correct}
+            for item, (value, correct) in zip(questions, rows)
+        ],
+        'sweep': table,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
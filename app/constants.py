@@ -13,4 +13,18 @@ DOCUMENT_TAGS = {
     'Карьера': '/about/career',
     'Пресс-центр': '/press-center',
     'Контакты': '/contacts',
+}
+
+# Теги хранятся в метаданных чанков еще и булевыми полями, чтобы Chroma
+# могла фильтровать по ним в where-запросе
+TAG_METADATA_KEYS = {
+    'Решения': 'tag_solutions',
+    'Кейсы': 'tag_cases',
+    'Экспертизы': 'tag_expertises',
+    'О компании': 'tag_about',
+    'Партнеры': 'tag_partners',
+    'Клиенты': 'tag_customers',
+    'Карьера': 'tag_career',
+    'Пресс-центр': 'tag_press_center',
+    'Контакты': 'tag_contacts',
 }
\ No newline at end of file
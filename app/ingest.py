@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import json
+import logging
+
+from app.src.ingestion.pipeline import build_documents, SCRAPED_SOURCES
+from app.src.ingestion.indexer import sync_documents
+from app.src.utils import get_config
+from app.src.vectorstore.vectorstore import export_to_mmap
+
+
+config = get_config()
+
+
+# Инкрементальная индексация базы знаний:
+#   python -m app.ingest                 - полный прогон со скрэпперами
+#   python -m app.ingest --no-scrape     - только результаты краулера
+#   python -m app.ingest --dry-run       - посчитать изменения, ничего не записывая
+#   python -m app.ingest --export-mmap   - перенести готовую коллекцию Chroma в mmap-индекс
+# Индекс, собранный блокнотом, нужно один раз переиндексировать полным прогоном: у его чанков
+# нет булевых полей тегов tag_*, без них не работает поиск по тегам (semantic_search.tagged_k).
+def main():
+    parser = argparse.ArgumentParser(description='Incremental ingestion into the documents collection.')
+    parser.add_argument('--dataset-url', default=config.ingestion.dataset_url,
+                        help='Apify dataset with website-content-crawler results.')
+    parser.add_argument('--no-scrape', action='store_true',
+                        help='Skip playwright scrapers (contacts, customers, career).')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be added and deleted.')
+    parser.add_argument('--export-mmap', action='store_true',
+                        help='Copy the existing Chroma collection into the mmap index and exit.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.export_mmap:
+        print(json.dumps({'exported': export_to_mmap()}))
+        return
+
+    docs = asyncio.run(build_documents(args.dataset_url, scrape=not args.no_scrape))
+    # Без скрэпперов их прошлые чанки (контакты, клиенты, карьера) сохраняются, а не удаляются
+    stats = sync_documents(
+        docs, dry_run=args.dry_run, keep_sources=SCRAPED_SOURCES if args.no_scrape else ()
+    )
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
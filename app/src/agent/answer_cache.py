@@ -0,0 +1,171 @@
+import re
+import threading
+import time
+
+import numpy as np
+from langchain_core.messages import HumanMessage
+
+from app.src.utils import get_config
+from app.src.metrics import register_cache
+from app.src.vectorstore.vectorstore import get_embeddings, collection_version, run_in_embedding_executor
+from app.src.agent.router import is_self_contained
+
+
+config = get_config()
+
+_WORD_RE = re.compile(r'[\w-]+')
+_LATIN_RE = re.compile(r'[A-Za-z]')
+
+
+class AnswerCache:
+    '''
+    Семантический кэш ответов.
+    Новый вопрос сопоставляется с уже отвеченными по косинусному сходству эмбеддингов;
+    если сходство не ниже threshold и совпадают сущности вопросов (числа, имена,
+    см. question_entities), возвращается сохраненный ответ с источниками.
+    Записи живут ttl секунд, всего хранится не больше max_size записей (старые вытесняются).
+    Кэш целиком сбрасывается при изменении коллекции documents.
+    '''
+
+    def __init__(self, threshold: float, ttl: float, max_size: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._entries = []  # (время записи, сущности, ответ), в том же порядке, что и строки _vectors
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _clear(self):
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._entries = []
+
+    def _sync_version(self, version):
+        if version != self._version:
+            self._clear()
+            self._version = version
+
+    def _expire(self, now: float):
+        alive = [i for i, (created_at, _, _) in enumerate(self._entries) if now - created_at < self.ttl]
+        if len(alive) != len(self._entries):
+            self._vectors = self._vectors[alive]
+            self._entries = [self._entries[i] for i in alive]
+
+    def lookup(self, vector: np.ndarray, entities: frozenset, version):
+        '''
+        Returns:
+          сохраненный ответ для ближайшего вопроса с теми же сущностями или None.
+        '''
+
+        with self._lock:
+            self._sync_version(version)
+            self._expire(time.time())
+
+            if self._entries:
+                sims = self._vectors @ vector
+                for i in np.argsort(-sims):
+                    if sims[i] < self.threshold:
+                        break
+                    _, entry_entities, response = self._entries[i]
+                    if entry_entities == entities:
+                        self.hits += 1
+                        return response
+
+            self.misses += 1
+            return None
+
+    def store(self, vector: np.ndarray, entities: frozenset, response: dict, version):
+        with self._lock:
+            self._sync_version(version)
+            row = vector[np.newaxis, :]
+            self._vectors = row if not self._entries else np.vstack([self._vectors, row])
+            self._entries.append((time.time(), entities, response))
+
+            overflow = len(self._entries) - self.max_size
+            if overflow > 0:
+                self._vectors = self._vectors[overflow:]
+                self._entries = self._entries[overflow:]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+answer_cache = AnswerCache(
+    threshold=config.answer_cache.threshold,
+    ttl=config.answer_cache.ttl,
+    max_size=config.answer_cache.max_size
+)
+register_cache('answer', answer_cache.stats)
+
+
+def _embed_question(question: str):
+    # Тот же текст, что уходит в поиск по исходному запросу - вектор берется из кэша эмбеддингов
+    vector = np.asarray(get_embeddings().embed_query(question), dtype=np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+def question_entities(question: str):
+    '''
+    Сущности вопроса, которые обязаны совпасть у вопросов с общим ответом:
+    числа, слова латиницей и слова с заглавной буквы не в начале вопроса
+    (по первым пяти буквам, чтобы "Москва" и "Москве" совпадали).
+    Эмбеддинги E5 почти не различают вопросы, отличающиеся только сущностью:
+    "офис в Москве" и "офис в Самаре" похожи не меньше, чем два пересказа одного вопроса.
+    '''
+
+    entities = set()
+    for i, word in enumerate(_WORD_RE.findall(question)):
+        if word.isdigit() or _LATIN_RE.search(word) or (i > 0 and word[0].isupper()):
+            entities.add(word.lower()[:5])
+    return frozenset(entities)
+
+
+def _eligible(question: str, history):
+    # Ответ на уточнение ("а телефоны?") зависит от диалога, а кэш общий для всех сессий:
+    # отвечаем из кэша только на первый вопрос сессии или вопрос, понятный без истории
+    return is_self_contained(list(history) + [HumanMessage(content=question)])
+
+
+def _cacheable(response: dict):
+    # Кэшируем только ответы, опирающиеся на найденные документы:
+    # болтовня и ответы без источников слишком зависят от контекста диалога
+    return bool(response.get('source_documents'))
+
+
+def lookup_answer(question: str, history=()):
+    '''
+    Ищет в кэше ответ на близкий по смыслу вопрос.
+
+    Args:
+      question: вопрос пользователя.
+      history: сообщения сессии до этого вопроса.
+
+    Returns:
+      пару (ответ или None, ключ для последующего store_answer).
+      Для вопросов, зависящих от диалога, кэш не используется: (None, None).
+    '''
+
+    if not config.answer_cache.enabled or not _eligible(question, history):
+        return None, None
+    key = (_embed_question(question), question_entities(question), collection_version())
+    return answer_cache.lookup(*key), key
+
+
+def store_answer(key, response: dict):
+    if key is not None and _cacheable(response):
+        vector, entities, version = key
+        answer_cache.store(vector, entities, response, version)
+
+
+async def alookup_answer(question: str, history=()):
+    '''
+    Асинхронная версия lookup_answer: эмбеддинг считается в пуле эмбеддингов.
+    '''
+
+    if not config.answer_cache.enabled:
+        return None, None
+    return await run_in_embedding_executor(lookup_answer, question, history)
@@ -0,0 +1,201 @@
+import math
+import re
+
+from app.src.utils import get_config
+from app.src.vectorstore.bm25 import tokenize
+from app.src.metrics import CONTEXT_TOKENS
+
+
+config = get_config()
+
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+
+class Passage:
+    '''
+    Фрагмент контекста: текст, источник и место в выдаче (меньше - важнее).
+    '''
+
+    def __init__(self, text: str, source: str, rank: int):
+        self.text = text
+        self.source = source
+        self.rank = rank
+
+
+def count_tokens(text: str):
+    # Приблизительно, как count_tokens_approximately в memory.py, но с поправкой на кириллицу
+    return math.ceil(len(text) / config.context.chars_per_token)
+
+
+def _strip_prefix(text: str):
+    # В старых чанках в тексте остался префикс E5 "passage: " - модели он не нужен
+    prefix = config.embeddings.passage_prefix
+    if prefix and text.startswith(prefix):
+        text = text[len(prefix):]
+    return text.strip()
+
+
+def collect_passages(tool_msgs):
+    '''
+    Собирает фрагменты из ответов инструментов в порядке выдачи.
+    Артефакт ретривера - пары документ-скор, уже отсортированные реранжированием;
+    результаты веб-поиска - словари {link, snippet} либо только текст ответа инструмента.
+    '''
+
+    passages = []
+    for tool_msg in tool_msgs:
+        if not tool_msg.artifact:
+            if tool_msg.content:
+                passages.append(Passage(_strip_prefix(str(tool_msg.content)), tool_msg.name or 'tool', len(passages)))
+            continue
+        for item in tool_msg.artifact:
+            if isinstance(item, dict):
+                text, source = item.get('snippet', ''), item.get('link', 'unknown')
+            else:
+                doc, _ = item
+                text, source = doc.page_content, doc.metadata.get('source', 'unknown')
+            text = _strip_prefix(text)
+            if text:
+                passages.append(Passage(text, source, len(passages)))
+    return passages
+
+
+def _overlap(left: str, right: str):
+    '''
+    Длина самого длинного конца left, с которого начинается right
+    (перекрытие соседних чанков, см. documents.chunk_overlap), или 0.
+    '''
+
+    longest = min(len(left), len(right), 2 * config.documents.chunk_overlap)
+    for size in range(longest, config.context.min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def stitch(passages):
+    '''
+    Склеивает соседние чанки одного источника, убирая повторяющееся перекрытие,
+    и выбрасывает фрагменты, целиком содержащиеся в других.
+    Склеенный фрагмент получает лучшее место из двух.
+    '''
+
+    by_source = {}
+    for passage in passages:
+        by_source.setdefault(passage.source, []).append(passage)
+
+    stitched = []
+    for group in by_source.values():
+        merged = True
+        while merged:
+            merged = False
+            for left in group:
+                for right in group:
+                    if left is right:
+                        continue
+                    if right.text in left.text:
+                        size = len(right.text)
+                    else:
+                        size = _overlap(left.text, right.text)
+                        if not size:
+                            continue
+                        left.text += right.text[size:]
+                    left.rank = min(left.rank, right.rank)
+                    group.remove(right)
+                    merged = True
+                    break
+                if merged:
+                    break
+        stitched.extend(group)
+    return sorted(stitched, key=lambda passage: passage.rank)
+
+
+def _stems(text: str):
+    # Грубый стемминг обрезкой: "москве" и "москва" совпадают по первым пяти буквам.
+    # Предлоги и союзы короче трех букв совпадают почти везде и только шумят
+    return {term[:5] for term in tokenize(text) if len(term) > 2}
+
+
+def _split_sentences(text: str):
+    return [sentence.strip() for sentence in _SENTENCE_RE.split(text) if sentence.strip()]
+
+
+def select_sentences(text: str, query_stems: set, max_tokens: int):
+    '''
+    Экстрактивное сжатие: оставляет предложения с наибольшим пересечением
+    со словами запроса, в исходном порядке и в пределах max_tokens.
+    Если ни одно предложение не пересекается с запросом - берется начало текста.
+    '''
+
+    sentences = _split_sentences(text)
+    scored = [(len(query_stems & _stems(sentence)), i) for i, sentence in enumerate(sentences)]
+    if not any(score for score, _ in scored):
+        return truncate(text, max_tokens)
+
+    picked, used = [], 0
+    for score, i in sorted(scored, key=lambda item: (-item[0], item[1])):
+        tokens = count_tokens(sentences[i])
+        if score == 0 or used + tokens > max_tokens:
+            continue
+        picked.append(i)
+        used += tokens
+    return ' '.join(sentences[i] for i in sorted(picked))
+
+
+def truncate(text: str, max_tokens: int):
+    # Обрезаем по границе предложения, если она есть в пределах бюджета
+    limit = int(max_tokens * config.context.chars_per_token)
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind('. '), cut.rfind('\n'))
+    return cut[:boundary + 1].strip() if boundary > limit // 2 else cut.strip()
+
+
+def pack(passages, query: str, max_tokens: int):
+    '''
+    Укладывает фрагменты в бюджет токенов в порядке важности.
+    Фрагмент, который не помещается целиком, сжимается (экстрактивно,
+    если включен context.extractive, иначе обрезается), когда от бюджета
+    осталось хотя бы context.min_passage_tokens; остальные отбрасываются.
+    '''
+
+    query_stems = _stems(query)
+    packed, used = [], 0
+    for passage in passages:
+        remaining = max_tokens - used
+        text = passage.text
+        if config.context.extractive and query_stems:
+            text = select_sentences(text, query_stems, min(remaining, config.context.max_passage_tokens))
+        if count_tokens(text) > remaining:
+            if remaining < config.context.min_passage_tokens:
+                continue
+            text = truncate(text, remaining)
+        if text:
+            packed.append(text)
+            used += count_tokens(text)
+    return packed
+
+
+def build_context(tool_msgs, query: str):
+    '''
+    Контекст для промпта генерации по ответам инструментов:
+    префиксы убираются, соседние чанки склеиваются, затем фрагменты
+    укладываются в context.max_tokens.
+
+    Args:
+      tool_msgs: последние сообщения инструментов.
+      query: вопрос пользователя (для экстрактивного сжатия).
+
+    Returns:
+      текст контекста или пустую строку, если ничего не найдено.
+    '''
+
+    passages = collect_passages(tool_msgs)
+    if not passages:
+        return ''
+    CONTEXT_TOKENS.labels('raw').observe(sum(count_tokens(passage.text) for passage in passages))
+    packed = pack(stitch(passages), query, config.context.max_tokens)
+    text = '\n\n'.join(packed)
+    CONTEXT_TOKENS.labels('packed').observe(count_tokens(text))
+    return text
@@ -1,144 +1,404 @@
-from typing_extensions import List
-
-from langchain_core.documents import Document
-from langchain_core.messages import SystemMessage
-
-from langgraph.graph import MessagesState, StateGraph, END
-from langgraph.prebuilt import ToolNode, tools_condition
-from langgraph.checkpoint.memory import MemorySaver
-
-from app.src.agent.tools import retrieve_from_local, web_search
-from app.src.utils import load_prompt, get_config
-from app.src.agent.llm import llm
-
-
-config = get_config()
-
-
-class State(MessagesState):
-    context: List[Document]
-
-
-# Роут на ретривер либо генерация прямого ответа
-def query_or_respond(state: MessagesState):
-    prompt = [SystemMessage(content=load_prompt('app/src/agent/prompts/qr-prompt.txt'))] + state['messages']
-    llm_with_tools = llm.bind_tools([retrieve_from_local, web_search])
-    response = llm_with_tools.invoke(prompt)
-    return {'messages': [response]}
-
-
-tools = ToolNode([retrieve_from_local, web_search])
-
-
-# Гененирует итоговый ответ по результатам обращения к тулзам
-def generate(state: MessagesState):
-    recent_tool_msgs = []
-    for message in reversed(state['messages']):
-        if message.type == 'tool':
-            recent_tool_msgs.append(message)
-        else:
-            break
-
-    tool_msgs = recent_tool_msgs[::-1]
-
-    docs_content = '\n\n'.join(
-        doc.page_content
-        for tool_msg in tool_msgs
-        if tool_msg.artifact
-        for doc, _ in tool_msg.artifact
-    )
-    if not docs_content:
-        docs_content = 'Контекст отсутствует'
-    system_message_content = (
-        f"{load_prompt('app/src/agent/prompts/generate-prompt.txt')}"
-        f'{docs_content}'
-    )
-    conversation_msgs = [
-        message
-        for message in state['messages']
-        if message.type in ('human', 'system')
-        or (message.type == 'ai' and not message.tool_calls)
-    ]
-    prompt = [SystemMessage(system_message_content)] + conversation_msgs
-    # may be a good idea to add prefixes to previous msgs or some introduction line
-
-    response = llm.invoke(prompt)
-    context = []
-
-    for tool_msg in tool_msgs:
-        if tool_msg.artifact is not None:
-            context.extend(tool_msg.artifact)
-
-    return {'messages': [response], 'context': context}
-
-
-graph_builder = StateGraph(State)
-
-# Добавляем ноды в граф
-graph_builder.add_node(query_or_respond)
-graph_builder.add_node(tools)
-graph_builder.add_node(generate)
-
-# Добавляем роут на ретривер
-graph_builder.set_entry_point('query_or_respond')
-graph_builder.add_conditional_edges(
-    'query_or_respond',
-    tools_condition,
-    {END: END, 'tools': 'tools'}
-)
-graph_builder.add_edge('tools', 'generate')
-graph_builder.add_edge('generate', END)
-
-# Добавляем чекпоинтер, чтобы хранить MessagesState
-memory = MemorySaver()
-graph = graph_builder.compile(checkpointer=memory)
-
-# Игрушечный конфиг
-config = {'configurable': {'thread_id': 'abc123'}}
-
-
-def process_input_message(session_id: str, input_message: str):
-    '''
-    Обрабатывает пойманное на API сообщение.
-
-    Args:
-      session_id: id сессии.
-      input_message: сообщение, передающееся в граф
-
-    Returns:
-      ответ модели, источники, id сессии. Согласуется с pydantic-моделью ответа.
-    '''
-
-    response = graph.invoke(
-        {'messages': [{'role': 'user', 'content': input_message}], 'context': []},
-        stream_mode='values',
-        config=config
-    )
-
-    # Парсим ответ от модельки
-    src = []
-    if response.get('context') and len(response['context']) > 0:
-        for doc in response['context']:
-            if isinstance(doc, dict):
-                src.append({
-                    'source': doc['link'],
-                    'snippet': doc['snippet']
-                })
-            if isinstance(doc, tuple):
-                src.append({
-                    'source': doc[0].metadata.get('source', 'unknown'),
-                    'snippet': (f'score: {doc[1]} ' + doc[0].page_content[:150] + '...')\
-                        .encode('utf-8', errors='ignore').decode('utf-8')
-                    # добавил скор в вывод для наглядности
-                })
-            else: src.append({
-                'source': 'unknown',
-                'snippet': f'Были получены неожиданные результаты поиска: {type(doc)}'
-                })
-
-    return {
-        'answer': response['messages'][-1].content
-        if response.get('messages') else "Ответ не получен.",
-        'source_documents': src,
-        'session_id': session_id
-    }
\ No newline at end of file
+import os
+from uuid import uuid4
+
+from typing_extensions import List
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+from langgraph.graph import MessagesState, StateGraph, END
+from langgraph.prebuilt import ToolNode, tools_condition
+
+from app.src.agent.tools import retrieve_from_local, web_search
+from app.src.utils import load_prompt, get_config, PROMPTS_DIR
+from app.src.agent.llm import llm
+from app.src.agent import llm_client
+from app.src.agent.llm_cache import cached, acached
+from app.src.agent.memory import (
+    make_checkpointer, SessionRegistry, trim_history, atrim_history, summary_messages
+)
+from app.src.agent.answer_cache import lookup_answer, alookup_answer, store_answer
+from app.src.metrics import callbacks
+from app.src.agent.context import build_context
+from app.src.agent.router import route, aroute, after_route, is_self_contained
+from app.src.agent import prefetch
+
+
+config = get_config()
+
+
+class State(MessagesState):
+    context: List[Document]
+    summary: str
+
+
+QR_PROMPT_PATH = os.path.join(PROMPTS_DIR, 'qr-prompt.txt')
+GENERATE_PROMPT_PATH = os.path.join(PROMPTS_DIR, 'generate-prompt.txt')
+
+
+def _query_or_respond_prompt(state: MessagesState):
+    return [SystemMessage(content=load_prompt(QR_PROMPT_PATH))] + summary_messages(state) + state['messages']
+
+
+def _router_payload(state: MessagesState):
+    # id сообщений и вызовов инструментов случайные, в ключ кэша идут только смысловые поля
+    return [state.get('summary', '')] + [
+        [message.type, message.content,
+         [[call['name'], call['args']] for call in getattr(message, 'tool_calls', [])]]
+        for message in state['messages']
+    ]
+
+
+def _dump_router_response(response: AIMessage):
+    return {
+        'content': response.content,
+        'tool_calls': [{'name': call['name'], 'args': call['args']} for call in response.tool_calls]
+    }
+
+
+def _load_router_response(data: dict):
+    # Только при попадании в кэш: при промахе нода возвращает исходное сообщение модели
+    # с его id, response_metadata и usage_metadata.
+    # Для каждого восстановленного из кэша вызова инструмента нужен свой id
+    return AIMessage(
+        content=data['content'],
+        tool_calls=[{**call, 'id': f'call_{uuid4().hex}'} for call in data['tool_calls']]
+    )
+
+
+def _last_question(state: MessagesState):
+    return next((str(message.content) for message in reversed(state['messages']) if message.type == 'human'), '')
+
+
+def _settle_prefetch(config: RunnableConfig, response: AIMessage):
+    # Поиск, запущенный параллельно с роутером, не понадобится, если роутер не вызвал ретривер
+    if not any(call['name'] == 'retrieve_from_local' for call in response.tool_calls):
+        prefetch.discard(config)
+    return response
+
+
+# Роут на ретривер либо генерация прямого ответа.
+# Пока LLM думает, поиск по самому вопросу уже идет (prefetch.py): если роутер
+# попросит найти то же самое, инструмент возьмет готовый результат
+def query_or_respond(state: MessagesState, config: RunnableConfig):
+    if is_self_contained(state['messages']):
+        prefetch.start(config, _last_question(state))
+
+    llm_with_tools = llm.bind_tools([retrieve_from_local, web_search])
+    response = cached(
+        'router', load_prompt(QR_PROMPT_PATH), _router_payload(state),
+        lambda: llm_client.invoke('router', llm_with_tools, _query_or_respond_prompt(state)),
+        dump=_dump_router_response, load=_load_router_response
+    )
+    return {'messages': [_settle_prefetch(config, response)]}
+
+
+async def aquery_or_respond(state: MessagesState, config: RunnableConfig):
+    if is_self_contained(state['messages']):
+        prefetch.astart(config, _last_question(state))
+
+    llm_with_tools = llm.bind_tools([retrieve_from_local, web_search])
+
+    async def acompute():
+        return await llm_client.ainvoke('router', llm_with_tools, _query_or_respond_prompt(state))
+
+    response = await acached(
+        'router', load_prompt(QR_PROMPT_PATH), _router_payload(state), acompute,
+        dump=_dump_router_response, load=_load_router_response
+    )
+    return {'messages': [_settle_prefetch(config, response)]}
+
+
+tools = ToolNode([retrieve_from_local, web_search])
+
+
+def _recent_tool_messages(state: MessagesState):
+    recent_tool_msgs = []
+    for message in reversed(state['messages']):
+        if message.type == 'tool':
+            recent_tool_msgs.append(message)
+        else:
+            break
+
+    return recent_tool_msgs[::-1]
+
+
+def _generate_prompt(state: MessagesState, tool_msgs):
+    # Склеенные и уложенные в context.max_tokens фрагменты, см. context.py
+    docs_content = build_context(tool_msgs, _last_question(state))
+    if not docs_content:
+        docs_content = 'Контекст отсутствует'
+    system_message_content = (
+        f'{load_prompt(GENERATE_PROMPT_PATH)}'
+        f'{docs_content}'
+    )
+    conversation_msgs = [
+        message
+        for message in state['messages']
+        if message.type in ('human', 'system')
+        or (message.type == 'ai' and not message.tool_calls)
+    ]
+    # may be a good idea to add prefixes to previous msgs or some introduction line
+    return [SystemMessage(system_message_content)] + summary_messages(state) + conversation_msgs
+
+
+def _tool_context(tool_msgs):
+    context = []
+
+    for tool_msg in tool_msgs:
+        if tool_msg.artifact is not None:
+            context.extend(tool_msg.artifact)
+
+    return context
+
+
+# Гененирует итоговый ответ по результатам обращения к тулзам
+def generate(state: MessagesState):
+    tool_msgs = _recent_tool_messages(state)
+    response = llm_client.invoke('generate', llm, _generate_prompt(state, tool_msgs))
+    return {'messages': [response], 'context': _tool_context(tool_msgs)}
+
+
+async def agenerate(state: MessagesState):
+    tool_msgs = _recent_tool_messages(state)
+    response = await llm_client.ainvoke('generate', llm, _generate_prompt(state, tool_msgs))
+    return {'messages': [response], 'context': _tool_context(tool_msgs)}
+
+
+graph_builder = StateGraph(State)
+
+# Добавляем ноды в граф.
+# У нод есть синхронная и асинхронная версии, чтобы граф работал и через invoke, и через ainvoke
+graph_builder.add_node('trim_history', RunnableLambda(trim_history, afunc=atrim_history))
+graph_builder.add_node('route', RunnableLambda(route, afunc=aroute))
+graph_builder.add_node('query_or_respond', RunnableLambda(query_or_respond, afunc=aquery_or_respond))
+graph_builder.add_node('tools', tools)
+graph_builder.add_node('generate', RunnableLambda(generate, afunc=agenerate))
+
+# Добавляем роут на ретривер.
+# Локальный роутер (router.py) отправляет уверенные вопросы о компании сразу в tools,
+# LLM-роутер query_or_respond вызывается только для остальных
+graph_builder.set_entry_point('trim_history')
+graph_builder.add_edge('trim_history', 'route')
+graph_builder.add_conditional_edges(
+    'route',
+    after_route,
+    {'tools': 'tools', 'query_or_respond': 'query_or_respond'}
+)
+graph_builder.add_conditional_edges(
+    'query_or_respond',
+    tools_condition,
+    {END: END, 'tools': 'tools'}
+)
+graph_builder.add_edge('tools', 'generate')
+graph_builder.add_edge('generate', END)
+
+# Добавляем чекпоинтер, чтобы хранить MessagesState.
+# История хранится отдельно для каждой сессии, простаивающие сессии удаляются
+memory = make_checkpointer()
+graph = graph_builder.compile(checkpointer=memory)
+sessions = SessionRegistry(
+    memory,
+    session_ttl=config.memory.session_ttl,
+    eviction_interval=config.memory.eviction_interval,
+    keep_checkpoints=config.memory.keep_checkpoints
+)
+
+
+def _thread_config(session_id: str):
+    # Обработчик метрик получает события всех нод, инструментов и вызовов LLM внутри графа.
+    # request_id - свой у каждого запуска графа, по нему prefetch находит свой поиск
+    return {
+        'configurable': {'thread_id': session_id, 'request_id': uuid4().hex},
+        'callbacks': callbacks()
+    }
+
+
+def _format_sources(context):
+    src = []
+    for doc in context or []:
+        if isinstance(doc, dict):
+            src.append({
+                'source': doc['link'],
+                'snippet': doc['snippet']
+            })
+        elif isinstance(doc, tuple):
+            src.append({
+                'source': doc[0].metadata.get('source', 'unknown'),
+                'snippet': (f'score: {doc[1]} ' + doc[0].page_content[:150] + '...')\
+                    .encode('utf-8', errors='ignore').decode('utf-8')
+                # добавил скор в вывод для наглядности
+            })
+        else: src.append({
+            'source': 'unknown',
+            'snippet': f'Были получены неожиданные результаты поиска: {type(doc)}'
+            })
+    return src
+
+
+def _format_response(response, session_id: str):
+    # Парсим ответ от модельки
+    return {
+        'answer': response['messages'][-1].content
+        if response.get('messages') else "Ответ не получен.",
+        'source_documents': _format_sources(response.get('context')),
+        'session_id': session_id
+    }
+
+
+def _cache_entry(result: dict):
+    return {'answer': result['answer'], 'source_documents': result['source_documents']}
+
+
+def _graph_input(input_message: str):
+    return {'messages': [{'role': 'user', 'content': input_message}], 'context': []}
+
+
+def _history(session_id: str):
+    return graph.get_state(_thread_config(session_id)).values.get('messages', [])
+
+
+async def _ahistory(session_id: str):
+    return (await graph.aget_state(_thread_config(session_id))).values.get('messages', [])
+
+
+def _cached_turn(input_message: str, cached: dict):
+    # Ход, отвеченный из кэша, тоже записывается в историю сессии (как после generate),
+    # иначе следующий уточняющий вопрос его не увидит
+    return {'messages': [HumanMessage(content=input_message), AIMessage(content=cached['answer'])]}
+
+
+def process_input_message(session_id: str, input_message: str):
+    '''
+    Обрабатывает пойманное на API сообщение.
+
+    Args:
+      session_id: id сессии.
+      input_message: сообщение, передающееся в граф
+
+    Returns:
+      ответ модели, источники, id сессии. Согласуется с pydantic-моделью ответа.
+    '''
+
+    sessions.evict(session_id)
+    cached, cache_key = lookup_answer(input_message, _history(session_id))
+    if cached is not None:
+        graph.update_state(_thread_config(session_id), _cached_turn(input_message, cached), as_node='generate')
+        return {**cached, 'session_id': session_id}
+
+    response = graph.invoke(
+        _graph_input(input_message),
+        stream_mode='values',
+        config=_thread_config(session_id)
+    )
+    result = _format_response(response, session_id)
+    store_answer(cache_key, _cache_entry(result))
+    return result
+
+
+async def process_input_message_async(session_id: str, input_message: str):
+    '''
+    Асинхронная версия process_input_message: граф выполняется через ainvoke,
+    так что поток event loop не блокируется на ожидании LLM.
+    '''
+
+    await sessions.aevict(session_id)
+    cached, cache_key = await alookup_answer(input_message, await _ahistory(session_id))
+    if cached is not None:
+        await graph.aupdate_state(
+            _thread_config(session_id), _cached_turn(input_message, cached), as_node='generate'
+        )
+        return {**cached, 'session_id': session_id}
+
+    response = await graph.ainvoke(
+        _graph_input(input_message),
+        stream_mode='values',
+        config=_thread_config(session_id)
+    )
+    result = _format_response(response, session_id)
+    store_answer(cache_key, _cache_entry(result))
+    return result
+
+
+async def stream_input_message(session_id: str, input_message: str):
+    '''
+    Потоковая версия process_input_message.
+    Источники отдаются сразу после ноды tools, до начала генерации,
+    затем токены ответа - по мере их прихода от LLM. Прямой ответ роутера
+    (без вызова инструментов) отдается одним фрагментом, когда роутер закончил.
+
+    Args:
+      session_id: id сессии.
+      input_message: сообщение, передающееся в граф
+
+    Yields:
+      события-словари с ключом type:
+        sources - {'source_documents': [...]};
+        token - {'content': очередной фрагмент ответа};
+        done - {'answer': полный ответ, 'session_id': id сессии}.
+    '''
+
+    await sessions.aevict(session_id)
+    cached, cache_key = await alookup_answer(input_message, await _ahistory(session_id))
+    if cached is not None:
+        await graph.aupdate_state(
+            _thread_config(session_id), _cached_turn(input_message, cached), as_node='generate'
+        )
+        yield {'type': 'sources', 'source_documents': cached['source_documents']}
+        yield {'type': 'token', 'content': cached['answer']}
+        yield {'type': 'done', 'answer': cached['answer'], 'session_id': session_id}
+        return
+
+    # Токены роутера копятся в routed_tokens: отдавать их можно, только когда нода
+    # закончилась без вызова инструментов, иначе это не ответ, а текст рядом с вызовом
+    answer, sources, routed_tokens = [], [], []
+    async for mode, chunk in graph.astream(
+        _graph_input(input_message),
+        stream_mode=['updates', 'messages'],
+        config=_thread_config(session_id)
+    ):
+        if mode == 'updates':
+            routed = chunk.get('query_or_respond')
+            if routed:
+                message = routed['messages'][-1]
+                # Ответ роутера мог прийти из кэша LLM, тогда токенов не было - отдаем его целиком
+                content = ''.join(routed_tokens) or message.content
+                routed_tokens = []
+                if not message.tool_calls and content:
+                    answer.append(content)
+                    yield {'type': 'token', 'content': content}
+
+            update = chunk.get('tools')
+            if update:
+                sources = _format_sources(_tool_context(update['messages']))
+                yield {'type': 'sources', 'source_documents': sources}
+        elif mode == 'messages':
+            message, metadata = chunk
+            node = metadata.get('langgraph_node')
+            # query_or_respond тоже слушаем: если инструменты не нужны, ответ дает именно он
+            if node not in ('query_or_respond', 'generate'):
+                continue
+            # Вызовы LLM внутри поиска (теги, переформулировка) - не ответ. Упреждающий поиск
+            # идет внутри query_or_respond, поэтому отсеиваем их по llm_site
+            if metadata.get('llm_site'):
+                continue
+            # Только потоковые фрагменты. Целое сообщение в этом режиме - это ответ, восстановленный
+            # из кэша LLM (новый id, которого не было среди фрагментов) или ответ модели без стриминга;
+            # его текст берется из updates
+            if not isinstance(message, AIMessageChunk):
+                continue
+            if not isinstance(message.content, str) or not message.content:
+                continue
+            if node == 'query_or_respond':
+                routed_tokens.append(message.content)
+                continue
+            answer.append(message.content)
+            yield {'type': 'token', 'content': message.content}
+
+    result = {
+        'answer': ''.join(answer) or 'Ответ не получен.',
+        'source_documents': sources
+    }
+    store_answer(cache_key, result)
+    yield {'type': 'done', 'answer': result['answer'], 'session_id': session_id}
\ No newline at end of file
@@ -1,59 +1,123 @@
-import getpass
-import os
-
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_openai.chat_models import ChatOpenAI
-
-from app.src.utils import load_prompt, get_config
-
-
-config = get_config()
-
-if not os.environ.get('OPENROUTER_API_KEY'):
-  os.environ['OPENROUTER_API_KEY'] = getpass.getpass('Enter API key for OpenRouter: ')
-
-if not os.environ.get('OPENROUTER_BASE_URL'):
-  os.environ['OPENROUTER_BASE_URL'] = 'https://openrouter.ai/api/v1'
-
-
-# В качестве LLM выбрана gpt-4.1-nano.
-# Дешевая, быстрая модель, поддерживающая тулзы - это важно.
-llm = ChatOpenAI(
-  openai_api_key=os.environ.get('OPENROUTER_API_KEY'),
-  openai_api_base=os.environ.get('OPENROUTER_BASE_URL'),
-  model_name=config.model.name,
-  temperature=config.model.temperature
-)
-
-
-# Обращается к LLM, чтобы извлечь подходящие теги из пользовательского запроса.
-def get_query_tags(user_query: str):
-    prompt = load_prompt('app/src/agent/prompts/tag-getter-prompt.txt')
-    f_prompt = prompt.format(user_query=user_query)
-    response = llm.invoke(f_prompt)
-
-    tags = []
-    try:
-        res = response.content.strip()
-        if res[0] == '[' and res[-1] == ']':
-            tags = eval(response.content.strip())
-    except:
-        pass
-    return tags
-
-
-# Обращается к LLM, чтобы та переформулировала запрос.
-def reformulate_query(user_query: str):
-    user_query = user_query[:config.reformulate.max_length]
-
-    prompt = [
-        SystemMessage(content=(
-            load_prompt('app/src/agent/prompts/reformulation-prompt.txt')
-        )),
-        HumanMessage(content=user_query)
-    ]
-    response = llm.invoke(prompt)
-    try:
-        return response.content.strip() or user_query
-    except:
-        return user_query
\ No newline at end of file
+import getpass
+import json
+import os
+import sys
+import warnings
+
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_openai.chat_models import ChatOpenAI
+
+from app.src.utils import load_prompt, get_config, PROMPTS_DIR
+from app.src.agent.llm_cache import cached, acached
+from app.src.metrics import llm_site
+from app.src.agent import llm_client
+
+
+config = get_config()
+
+# Спрашиваем ключ только в интерактивном запуске (блокнот, консоль):
+# в сервисе getpass повис бы навсегда, поэтому там просто предупреждаем
+if not os.environ.get('OPENROUTER_API_KEY'):
+  if 'ipykernel' in sys.modules or (sys.stdin is not None and sys.stdin.isatty()):
+    os.environ['OPENROUTER_API_KEY'] = getpass.getpass('Enter API key for OpenRouter: ')
+  else:
+    warnings.warn('OPENROUTER_API_KEY is not set, LLM calls will fail.', stacklevel=2)
+
+if not os.environ.get('OPENROUTER_BASE_URL'):
+  os.environ['OPENROUTER_BASE_URL'] = 'https://openrouter.ai/api/v1'
+
+
+http_client, http_async_client = llm_client.make_http_clients()
+
+# В качестве LLM выбрана gpt-4.1-nano.
+# Дешевая, быстрая модель, поддерживающая тулзы - это важно.
+llm = ChatOpenAI(
+  openai_api_key=os.environ.get('OPENROUTER_API_KEY'),
+  openai_api_base=os.environ.get('OPENROUTER_BASE_URL'),
+  model_name=config.model.name,
+  temperature=config.model.temperature,
+  # Общий keep-alive пул соединений; повторы делает llm_client (с джиттером и по месту вызова)
+  http_client=http_client,
+  http_async_client=http_async_client,
+  max_retries=0 if config.llm_client.enabled else None,
+  # Число токенов приходит и в потоковом режиме - для метрик rag_llm_tokens
+  stream_usage=True
+)
+
+
+TAGS_PROMPT_PATH = os.path.join(PROMPTS_DIR, 'tag-getter-prompt.txt')
+REFORMULATION_PROMPT_PATH = os.path.join(PROMPTS_DIR, 'reformulation-prompt.txt')
+
+
+def _parse_tags(content: str):
+    tags = []
+    try:
+        res = content.strip()
+        if res[0] == '[' and res[-1] == ']':
+            tags = [tag for tag in json.loads(res) if isinstance(tag, str)]
+    except:
+        pass
+    return tags
+
+
+# Обращается к LLM, чтобы извлечь подходящие теги из пользовательского запроса.
+# Модель работает с temperature 0, поэтому ответы на одинаковые запросы кэшируются.
+def get_query_tags(user_query: str):
+    template = load_prompt(TAGS_PROMPT_PATH)
+    content = cached(
+        'tags', template, user_query,
+        lambda: llm_client.invoke('tags', llm, template.format(user_query=user_query), llm_site('tags')).content
+    )
+    return _parse_tags(content)
+
+
+async def aget_query_tags(user_query: str):
+    template = load_prompt(TAGS_PROMPT_PATH)
+
+    async def acompute():
+        return (await llm_client.ainvoke(
+            'tags', llm, template.format(user_query=user_query), llm_site('tags')
+        )).content
+
+    content = await acached('tags', template, user_query, acompute)
+    return _parse_tags(content)
+
+
+def _reformulation_prompt(template: str, user_query: str):
+    return [
+        SystemMessage(content=template),
+        HumanMessage(content=user_query)
+    ]
+
+
+def _parse_reformulation(content: str, user_query: str):
+    try:
+        return content.strip() or user_query
+    except:
+        return user_query
+
+
+# Обращается к LLM, чтобы та переформулировала запрос.
+def reformulate_query(user_query: str):
+    user_query = user_query[:config.reformulate.max_length]
+    template = load_prompt(REFORMULATION_PROMPT_PATH)
+    content = cached(
+        'reformulate', template, user_query,
+        lambda: llm_client.invoke(
+            'reformulate', llm, _reformulation_prompt(template, user_query), llm_site('reformulate')
+        ).content
+    )
+    return _parse_reformulation(content, user_query)
+
+
+async def areformulate_query(user_query: str):
+    user_query = user_query[:config.reformulate.max_length]
+    template = load_prompt(REFORMULATION_PROMPT_PATH)
+
+    async def acompute():
+        return (await llm_client.ainvoke(
+            'reformulate', llm, _reformulation_prompt(template, user_query), llm_site('reformulate')
+        )).content
+
+    content = await acached('reformulate', template, user_query, acompute)
+    return _parse_reformulation(content, user_query)
\ No newline at end of file
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.src.utils import get_config
+from app.src.metrics import register_cache
+
+
+config = get_config()
+
+
+class LLMCache:
+    '''
+    Кэш ответов LLM: LRU в памяти поверх таблицы SQLite.
+    Значения - любые JSON-сериализуемые объекты, записи старше ttl секунд не отдаются.
+    Таблица ограничена disk_size записями; устаревшие и самые старые записи
+    удаляются раз в CLEANUP_INTERVAL записей, а не при каждой.
+    '''
+
+    CLEANUP_INTERVAL = 256
+
+    def __init__(self, path: str, memory_size: int, ttl: float, disk_size: int):
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.disk_size = disk_size
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)')
+        self._db.commit()
+        self._inserts = 0
+
+    def _remember(self, key: str, created_at: float, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str):
+        '''
+        Returns:
+          пару (найдено ли значение, значение).
+        '''
+
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is None:
+                row = self._db.execute(
+                    'SELECT created_at, value FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    item = (row[0], json.loads(row[1]))
+                    self._remember(key, *item)
+            else:
+                self._memory.move_to_end(key)
+
+            if item is None or now - item[0] >= self.ttl:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, item[1]
+
+    def put(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now)
+            )
+            self._inserts += 1
+            if self._inserts % self.CLEANUP_INTERVAL == 0:
+                self._db.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+                self._db.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                    (self.disk_size,)
+                )
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'memory_entries': len(self._memory)}
+
+
+llm_cache = LLMCache(
+    path=config.llm_cache.path,
+    memory_size=config.llm_cache.memory_size,
+    ttl=config.llm_cache.ttl,
+    disk_size=config.llm_cache.disk_size
+)
+register_cache('llm', llm_cache.stats)
+
+
+def is_enabled(site: str):
+    '''
+    Кэш можно отключить целиком (llm_cache.enabled), для отдельного
+    места вызова (llm_cache.sites) или переменной окружения LLM_CACHE_BYPASS=1.
+    '''
+
+    if os.environ.get('LLM_CACHE_BYPASS') == '1':
+        return False
+    return config.llm_cache.enabled and config.llm_cache.sites.get(site, False)
+
+
+def make_key(site: str, template: str, payload):
+    '''
+    Ключ кэша: место вызова, имя модели, хэш шаблона промпта и входные данные.
+    При смене модели или правке промпта старые записи просто перестают совпадать.
+    '''
+
+    template_hash = hashlib.sha256(template.encode('utf-8')).hexdigest()
+    raw = json.dumps([site, config.model.name, template_hash, payload], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _identity(value):
+    return value
+
+
+def cached(site: str, template: str, payload, compute, dump=_identity, load=_identity):
+    '''
+    Возвращает закэшированный результат compute() для данного входа
+    либо вызывает compute() и сохраняет результат.
+    Если результат не сериализуется в JSON как есть, dump переводит его
+    в JSON-объект для записи, а load восстанавливает при попадании в кэш;
+    при промахе возвращается исходный результат compute().
+    '''
+
+    if not is_enabled(site):
+        return compute()
+
+    key = make_key(site, template, payload)
+    found, value = llm_cache.get(key)
+    if found:
+        return load(value)
+    value = compute()
+    llm_cache.put(key, dump(value))
+    return value
+
+
+async def acached(site: str, template: str, payload, acompute, dump=_identity, load=_identity):
+    '''
+    Асинхронная версия cached: acompute - функция, возвращающая корутину.
+    '''
+
+    if not is_enabled(site):
+        return await acompute()
+
+    key = make_key(site, template, payload)
+    found, value = llm_cache.get(key)
+    if found:
+        return load(value)
+    value = await acompute()
+    llm_cache.put(key, dump(value))
+    return value
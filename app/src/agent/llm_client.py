@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait, TimeoutError as FutureTimeoutError
+
+import httpx
+import numpy as np
+import openai
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import ContextThreadPoolExecutor, ensure_config, merge_configs
+
+from app.src.utils import get_config
+from app.src.metrics import (
+    LLM_QUEUE_SECONDS, LLM_RETRIES, LLM_HEDGES, metrics_handler, register_llm_latency
+)
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых запрос к LLM имеет смысл повторить: сеть, таймаут, 429 и 5xx
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+# Пул для дублирующих (hedged) запросов синхронного пути; контекст копируется,
+# чтобы вызов попал в трассировку и метрики своей ноды
+_hedge_executor = ContextThreadPoolExecutor(
+    max_workers=config.llm_client.hedge.max_workers,
+    thread_name_prefix='llm-hedge'
+)
+# Сколько попыток сейчас выполняется в пуле: когда заняты все потоки,
+# дублирующий запрос встал бы в очередь, и hedging только добавил бы нагрузки
+_hedge_lock = threading.Lock()
+_hedge_running = 0
+
+
+def _hedge_saturated():
+    with _hedge_lock:
+        return _hedge_running >= config.llm_client.hedge.max_workers
+
+
+class _FirstChunk(BaseCallbackHandler):
+    '''
+    Отмечает, что модель начала отдавать ответ. При стриминге (stream_input_message)
+    первые токены к этому моменту уже ушли пользователю, и повтор запроса
+    продублировал бы их, поэтому после первого чанка попытка не повторяется.
+    Заодно помнит незавершенные вызовы модели: отмененный без стриминга запрос
+    LangChain не закрывает ни on_llm_end, ни on_llm_error.
+    '''
+
+    run_inline = True
+
+    def __init__(self):
+        self.seen = False
+        self.running = set()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.running.add(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.running.add(run_id)
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.seen = True
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.running.discard(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.running.discard(run_id)
+
+
+def _tracked(run_config, tracker: _FirstChunk):
+    # Обработчик добавляется к унаследованным от графа callbacks, а не заменяет их:
+    # иначе пропали бы стриминг токенов и метрики
+    return merge_configs(ensure_config(run_config), {'callbacks': [tracker]})
+
+
+def _limits():
+    pool = config.llm_client.pool
+    return httpx.Limits(
+        max_connections=pool.max_connections,
+        max_keepalive_connections=pool.max_keepalive_connections,
+        keepalive_expiry=pool.keepalive_expiry
+    )
+
+
+def _timeout():
+    # Общий таймаут - по самой долгой ноде; у каждого вызова он свой (см. LLMSite)
+    pool = config.llm_client.pool
+    longest = max(site.timeout for site in config.llm_client.sites.values())
+    return httpx.Timeout(longest, connect=pool.connect_timeout)
+
+
+def make_http_clients():
+    '''
+    HTTP-клиенты для ChatOpenAI с keep-alive пулом соединений из llm_client.pool.
+
+    Returns:
+      пару (httpx.Client, httpx.AsyncClient).
+    '''
+
+    return (
+        httpx.Client(limits=_limits(), timeout=_timeout()),
+        httpx.AsyncClient(limits=_limits(), timeout=_timeout())
+    )
+
+
+class LatencyStats:
+    '''
+    Длительности последних window успешных вызовов и квантили по ним.
+    '''
+
+    def __init__(self, window: int):
+        self._lock = threading.Lock()
+        self._durations = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._durations.append(seconds)
+
+    def __len__(self):
+        return len(self._durations)
+
+    def quantile(self, q: float):
+        with self._lock:
+            if not self._durations:
+                return None
+            return float(np.quantile(list(self._durations), q))
+
+    def stats(self):
+        return {q: self.quantile(q) for q in (0.5, 0.95, 0.99)} if len(self) else {}
+
+
+class LLMSite:
+    '''
+    Место вызова LLM (router, generate, summary, tags, reformulate) со своими
+    ограничениями из llm_client.sites: число одновременных запросов, таймаут
+    одной попытки, число повторов и hedging - дублирующий запрос, если первый
+    не ответил за квантиль llm_client.hedge.quantile недавних длительностей.
+    Hedging включается только для коротких идемпотентных вызовов: их ответы
+    не стримятся пользователю, поэтому лишний запрос стоит только токенов.
+    '''
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float, retries: int, hedge: bool):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.latency = LatencyStats(config.llm_client.hedge.window)
+        # Синхронные и асинхронные вызовы ограничиваются отдельно: сервис работает
+        # в одном из режимов, и семафор event loop из потока не захватить
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        register_llm_latency(name, self.latency.stats)
+
+    def _async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores.setdefault(loop, asyncio.Semaphore(self._max_concurrency))
+        return semaphore
+
+    def hedge_delay(self):
+        '''
+        Через сколько секунд отправлять дублирующий запрос: квантиль недавних
+        длительностей, пока их меньше min_samples - initial_delay.
+        '''
+
+        settings = config.llm_client.hedge
+        if len(self.latency) < settings.min_samples:
+            return settings.initial_delay
+        return max(settings.min_delay, self.latency.quantile(settings.quantile))
+
+    def backoff(self, attempt: int):
+        # Экспоненциальная пауза с полным джиттером, чтобы повторы разных запросов не совпадали
+        settings = config.llm_client.retry
+        return random.uniform(0, min(settings.max_backoff, settings.backoff * 2 ** attempt))
+
+    def _attempt(self, runnable, input, run_config):
+        start = time.perf_counter()
+        result = runnable.invoke(input, run_config, timeout=self.timeout)
+        self.latency.observe(time.perf_counter() - start)
+        return result
+
+    async def _aattempt(self, runnable, input, run_config):
+        start = time.perf_counter()
+        result = await runnable.ainvoke(input, run_config, timeout=self.timeout)
+        self.latency.observe(time.perf_counter() - start)
+        return result
+
+    def _pooled_attempt(self, started: threading.Event, runnable, input, run_config):
+        global _hedge_running
+        with _hedge_lock:
+            _hedge_running += 1
+        started.set()
+        try:
+            return self._attempt(runnable, input, run_config)
+        finally:
+            with _hedge_lock:
+                _hedge_running -= 1
+
+    def _hedged(self, runnable, input, run_config):
+        started = threading.Event()
+        first = _hedge_executor.submit(self._pooled_attempt, started, runnable, input, run_config)
+        # Задержка отсчитывается от начала попытки, а не от постановки в очередь пула
+        started.wait()
+        try:
+            return first.result(timeout=self.hedge_delay())
+        except FutureTimeoutError:
+            pass
+        if _hedge_saturated():
+            LLM_HEDGES.labels(self.name, 'skipped').inc()
+            return first.result()
+
+        LLM_HEDGES.labels(self.name, 'sent').inc()
+        second = _hedge_executor.submit(self._pooled_attempt, threading.Event(), runnable, input, run_config)
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        LLM_HEDGES.labels(self.name, 'won').inc()
+                    # Проигравший поток остановить нельзя - он доработает в фоне
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _ahedged(self, runnable, input, run_config):
+        first = asyncio.ensure_future(self._aattempt(runnable, input, run_config))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+            if done:
+                return first.result()
+
+            LLM_HEDGES.labels(self.name, 'sent').inc()
+            second = asyncio.ensure_future(self._aattempt(runnable, input, run_config))
+            tasks.append(second)
+            pending, error = {first, second}, None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            LLM_HEDGES.labels(self.name, 'won').inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Проигравший (или ненужный после отмены вызывающего) запрос отменяется вместе с HTTP-соединением
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _retry(self, attempt: int, error: Exception, tracker: _FirstChunk):
+        if attempt >= self.retries or not isinstance(error, RETRYABLE_ERRORS) or tracker.seen:
+            return None
+        LLM_RETRIES.labels(self.name, type(error).__name__).inc()
+        delay = self.backoff(attempt)
+        logger.warning('LLM call %s failed (%s), retrying in %.2fs', self.name, error, delay)
+        return delay
+
+    def invoke(self, runnable, input, run_config=None):
+        if not config.llm_client.enabled:
+            return runnable.invoke(input, run_config)
+        call = self._hedged if self.hedge else self._attempt
+        attempt = 0
+        while True:
+            waited = time.perf_counter()
+            with self._semaphore:
+                LLM_QUEUE_SECONDS.labels(self.name).observe(time.perf_counter() - waited)
+                tracker = _FirstChunk()
+                try:
+                    return call(runnable, input, _tracked(run_config, tracker))
+                except Exception as e:
+                    delay = self._retry(attempt, e, tracker)
+                    if delay is None:
+                        raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def ainvoke(self, runnable, input, run_config=None):
+        if not config.llm_client.enabled:
+            return await runnable.ainvoke(input, run_config)
+        call = self._ahedged if self.hedge else self._aattempt
+        attempt = 0
+        while True:
+            waited = time.perf_counter()
+            async with self._async_semaphore():
+                LLM_QUEUE_SECONDS.labels(self.name).observe(time.perf_counter() - waited)
+                tracker = _FirstChunk()
+                try:
+                    return await call(runnable, input, _tracked(run_config, tracker))
+                except Exception as e:
+                    delay = self._retry(attempt, e, tracker)
+                    if delay is None:
+                        raise
+                finally:
+                    # Отмененные проигравшие hedging не должны навсегда остаться в метриках
+                    for run_id in tracker.running:
+                        metrics_handler.cancel(run_id)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+sites = {
+    name: LLMSite(name, **settings)
+    for name, settings in config.llm_client.sites.items()
+}
+
+
+def invoke(site: str, runnable, input, run_config=None):
+    '''
+    Вызывает LLM (или привязанную к ней цепочку, например bind_tools)
+    с лимитами, повторами и hedging места вызова site.
+
+    Args:
+      site: место вызова из llm_client.sites.
+      runnable: модель или цепочка.
+      input: промпт.
+      run_config: config вызова (например, llm_site для вызовов вне нод графа).
+
+    Returns:
+      ответ модели.
+    '''
+
+    return sites[site].invoke(runnable, input, run_config)
+
+
+async def ainvoke(site: str, runnable, input, run_config=None):
+    return await sites[site].ainvoke(runnable, input, run_config)
\ No newline at end of file
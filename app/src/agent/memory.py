@@ -0,0 +1,307 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage, RemoveMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from app.src.utils import load_prompt, get_config, PROMPTS_DIR
+from app.src.agent.llm import llm
+from app.src.agent import llm_client
+
+
+config = get_config()
+
+SUMMARY_PROMPT_PATH = os.path.join(PROMPTS_DIR, 'summary-prompt.txt')
+
+
+def _checkpoint_id_at(timestamp: float):
+    '''
+    Наименьший id чекпоинта, созданного в момент timestamp (секунды Unix).
+    LangGraph выдает чекпоинтам UUID v6, у которого время в старших разрядах,
+    поэтому id в строковом виде упорядочены по времени создания.
+    '''
+
+    ticks = int(timestamp * 10 ** 7) + 0x01B21DD213814000
+    value = ((ticks >> 12) & 0xFFFFFFFFFFFF) << 80 | (0x6000 | ticks & 0x0FFF) << 64 | 0x8000 << 48
+    return str(uuid.UUID(int=value))
+
+
+class PrunableMemorySaver(MemorySaver):
+    '''
+    MemorySaver, у которого можно удалить старые чекпоинты сессии.
+    Граф сохраняет чекпоинт на каждом шаге, и штатный MemorySaver хранит их все,
+    так что память длинной сессии росла бы без предела.
+    '''
+
+    def prune_thread(self, thread_id: str, keep: int):
+        '''
+        Оставляет у сессии только keep последних чекпоинтов
+        вместе с их отложенными записями и значениями каналов.
+        '''
+
+        for checkpoint_ns, checkpoints in list(self.storage.get(thread_id, {}).items()):
+            ids = sorted(checkpoints, reverse=True)
+            if len(ids) <= keep:
+                continue
+            # Значения каналов лежат отдельно, по версиям: удаляем версии, на которые
+            # ссылались только удаленные чекпоинты
+            kept, dropped = set(), set()
+            for position, checkpoint_id in enumerate(ids):
+                checkpoint = self.serde.loads_typed(checkpoints[checkpoint_id][0])
+                (kept if position < keep else dropped).update(checkpoint['channel_versions'].items())
+            for checkpoint_id in ids[keep:]:
+                checkpoints.pop(checkpoint_id, None)
+                self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            for channel, version in dropped - kept:
+                self.blobs.pop((thread_id, checkpoint_ns, channel, version), None)
+
+
+class ThreadedSqliteSaver(SqliteSaver):
+    '''
+    Чекпоинтер на SQLite для синхронного и асинхронного графа.
+    Штатный SqliteSaver умеет только синхронные методы, поэтому асинхронные
+    здесь выполняют те же операции в отдельном потоке.
+    '''
+
+    @classmethod
+    def from_path(cls, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        saver = cls(sqlite3.connect(path, check_same_thread=False))
+        saver.setup()
+        return saver
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=''):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def stale_threads(self, before: float):
+        '''
+        Сессии, последний чекпоинт которых создан раньше before (секунды Unix).
+        Один запрос по первичному ключу, сами чекпоинты не читаются.
+        '''
+
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                'SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(checkpoint_id) < ?',
+                (_checkpoint_id_at(before),)
+            )
+            return [thread_id for (thread_id,) in cur.fetchall()]
+
+    def prune_thread(self, thread_id: str, keep: int):
+        '''
+        Оставляет у сессии только keep последних чекпоинтов и их отложенные записи.
+        '''
+
+        with self.cursor() as cur:
+            cur.execute(
+                '''
+                DELETE FROM checkpoints WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, ROW_NUMBER() OVER (
+                            PARTITION BY checkpoint_ns ORDER BY checkpoint_id DESC
+                        ) AS position
+                        FROM checkpoints WHERE thread_id = ?
+                    ) WHERE position > ?
+                )
+                ''',
+                (thread_id, keep)
+            )
+            cur.execute(
+                '''
+                DELETE FROM writes WHERE thread_id = ? AND NOT EXISTS (
+                    SELECT 1 FROM checkpoints
+                    WHERE checkpoints.thread_id = writes.thread_id
+                      AND checkpoints.checkpoint_ns = writes.checkpoint_ns
+                      AND checkpoints.checkpoint_id = writes.checkpoint_id
+                )
+                ''',
+                (thread_id,)
+            )
+
+
+def make_checkpointer():
+    '''
+    Создает чекпоинтер по memory.checkpointer: memory (в памяти процесса) или sqlite (на диске).
+    '''
+
+    if config.memory.checkpointer == 'sqlite':
+        return ThreadedSqliteSaver.from_path(config.memory.sqlite_path)
+    return PrunableMemorySaver()
+
+
+class SessionRegistry:
+    '''
+    Помнит, когда к каждой сессии обращались в последний раз,
+    и удаляет из чекпоинтера сессии, простаивающие дольше session_ttl секунд.
+    Проверка выполняется не чаще, чем раз в eviction_interval секунд.
+    Чекпоинтер SQLite общий для всех воркеров uvicorn, поэтому для него простой
+    считается по времени последнего чекпоинта сессии, а не по обращениям
+    к этому процессу: иначе воркер удалял бы сессии, активные в соседнем.
+    У сессии, к которой обратились, остаются только keep_checkpoints последних
+    чекпоинтов: графу нужен лишь последний, а длинная сессия иначе росла бы без предела.
+    '''
+
+    def __init__(self, checkpointer, session_ttl: float, eviction_interval: float, keep_checkpoints: int):
+        self.checkpointer = checkpointer
+        self.session_ttl = session_ttl
+        self.eviction_interval = eviction_interval
+        self.keep_checkpoints = keep_checkpoints
+
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._evicted_at = time.monotonic()
+        self.evicted = 0
+
+    def touch(self, session_id: str):
+        '''
+        Отмечает обращение к сессии.
+
+        Returns:
+          пора ли искать простаивающие сессии.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            self._last_seen[session_id] = now
+            if now - self._evicted_at < self.eviction_interval:
+                return False
+            self._evicted_at = now
+            return True
+
+    def _idle_threads(self):
+        '''
+        Returns:
+          id сессий, которые пора удалить.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            idle = {sid for sid, seen in self._last_seen.items() if now - seen > self.session_ttl}
+            recent = set(self._last_seen) - idle
+
+        if isinstance(self.checkpointer, SqliteSaver):
+            # Сессии, сохраненные до перезапуска или обслуживаемые другими воркерами,
+            # этот процесс мог не видеть - смотрим на все потоки в базе
+            stale = self.checkpointer.stale_threads(time.time() - self.session_ttl)
+            idle = {thread_id for thread_id in stale if thread_id not in recent}
+
+        with self._lock:
+            for sid in idle:
+                self._last_seen.pop(sid, None)
+            self.evicted += len(idle)
+        return idle
+
+    def _prune(self, session_id: str):
+        prune_thread = getattr(self.checkpointer, 'prune_thread', None)
+        if prune_thread is not None:
+            prune_thread(session_id, self.keep_checkpoints)
+
+    def evict(self, session_id: str):
+        self._prune(session_id)
+        if self.touch(session_id):
+            for thread_id in self._idle_threads():
+                self.checkpointer.delete_thread(thread_id)
+
+    async def aevict(self, session_id: str):
+        await asyncio.to_thread(self._prune, session_id)
+        if self.touch(session_id):
+            for thread_id in await asyncio.to_thread(self._idle_threads):
+                await self.checkpointer.adelete_thread(thread_id)
+
+    def active_sessions(self):
+        with self._lock:
+            return len(self._last_seen)
+
+
+def _split_history(messages):
+    '''
+    Делит историю на то, что помещается в memory.max_history_tokens (последние сообщения,
+    начиная с реплики пользователя), и то, что нужно выкинуть.
+    '''
+
+    kept = trim_messages(
+        messages,
+        max_tokens=config.memory.max_history_tokens,
+        strategy='last',
+        token_counter=count_tokens_approximately,
+        start_on='human',
+    )
+    if not kept:
+        # Текущий вопрос оставляем в любом случае, даже если он один больше бюджета
+        kept = messages[-1:]
+    kept_ids = {message.id for message in kept}
+    return [message for message in messages if message.id not in kept_ids]
+
+
+def _summary_prompt(summary: str, dropped):
+    dialog = '\n'.join(
+        f'{message.type}: {message.content}'
+        for message in dropped
+        if message.type in ('human', 'ai') and message.content
+    )
+    return [
+        SystemMessage(content=load_prompt(SUMMARY_PROMPT_PATH)),
+        HumanMessage(content=f'Текущее краткое содержание:\n{summary or "-"}\n\nНовые реплики:\n{dialog}')
+    ]
+
+
+def trim_history(state):
+    '''
+    Держит историю сессии в пределах бюджета токенов.
+    Старые сообщения удаляются из состояния (а значит, и из чекпоинтера);
+    при memory.policy = summary они перед удалением сворачиваются в краткое содержание.
+    '''
+
+    dropped = _split_history(state['messages'])
+    if not dropped:
+        return {}
+
+    update = {'messages': [RemoveMessage(id=message.id) for message in dropped]}
+    if config.memory.policy == 'summary':
+        response = llm_client.invoke('summary', llm, _summary_prompt(state.get('summary', ''), dropped))
+        update['summary'] = response.content.strip()
+    return update
+
+
+async def atrim_history(state):
+    dropped = _split_history(state['messages'])
+    if not dropped:
+        return {}
+
+    update = {'messages': [RemoveMessage(id=message.id) for message in dropped]}
+    if config.memory.policy == 'summary':
+        response = await llm_client.ainvoke('summary', llm, _summary_prompt(state.get('summary', ''), dropped))
+        update['summary'] = response.content.strip()
+    return update
+
+
+def summary_messages(state):
+    '''
+    Системное сообщение с кратким содержанием ранней части диалога, если оно есть.
+    '''
+
+    summary = state.get('summary')
+    if not summary:
+        return []
+    return [SystemMessage(content=f'Краткое содержание предыдущей части диалога: {summary}')]
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import threading
+import time
+
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+
+from app.src.utils import get_config
+from app.src.vectorstore.bm25 import tokenize
+from app.src.agent.retrieval import prefetch_search, aprefetch_search
+from app.src.metrics import PREFETCH, PREFETCH_OVERLAP_SECONDS, PREFETCH_WASTED_SECONDS
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+# Отдельный пул, чтобы заранее запущенные поиски не занимали потоки ретривера
+executor = ContextThreadPoolExecutor(
+    max_workers=config.prefetch.max_workers,
+    thread_name_prefix='prefetch'
+)
+
+
+class Prefetch:
+    '''
+    Запущенный заранее поиск: запрос, future (поток) или task (event loop) и время старта.
+    '''
+
+    def __init__(self, query: str, result, is_async: bool):
+        self.query = query
+        self.result = result
+        self.is_async = is_async
+        self.started = time.perf_counter()
+
+
+_lock = threading.Lock()
+_pending: dict[str, Prefetch] = {}
+
+
+def _key(run_config):
+    # Ключ - запуск графа, а не сессия: два одновременных запроса одной сессии
+    # (например, из двух вкладок) не должны забирать или выбрасывать поиск друг друга
+    return ((run_config or {}).get('configurable') or {}).get('request_id')
+
+
+def is_equivalent(lhs: str, rhs: str):
+    '''
+    Запросы считаются одинаковыми, если их множества слов совпадают
+    хотя бы на prefetch.min_jaccard (по Жаккару).
+    '''
+
+    lhs_terms, rhs_terms = set(tokenize(lhs)), set(tokenize(rhs))
+    if not lhs_terms or not rhs_terms:
+        return False
+    return len(lhs_terms & rhs_terms) / len(lhs_terms | rhs_terms) >= config.prefetch.min_jaccard
+
+
+def _register(run_config, query: str, result, is_async: bool):
+    key = _key(run_config)
+    now = time.perf_counter()
+    with _lock:
+        # Поиски запусков, упавших до инструмента, никто не заберет - выбрасываем их по возрасту
+        stale = [other for other, prefetch in _pending.items() if now - prefetch.started > config.prefetch.ttl]
+        dropped = [_pending.pop(other) for other in stale]
+        if key in _pending:
+            dropped.append(_pending.pop(key))
+        _pending[key] = Prefetch(query, result, is_async)
+    for prefetch in dropped:
+        _drop(prefetch, 'unused')
+
+
+def _pop(run_config):
+    with _lock:
+        return _pending.pop(_key(run_config), None)
+
+
+def _drop(prefetch: Prefetch, reason: str):
+    # Поток остановить нельзя, поэтому потраченное время - оценка снизу, если поиск еще идет
+    prefetch.result.cancel()
+    PREFETCH.labels(reason).inc()
+    PREFETCH_WASTED_SECONDS.observe(time.perf_counter() - prefetch.started)
+
+
+def start(run_config, query: str):
+    '''
+    Запускает в фоне (пул prefetch) BM25 и семантический поиск по query, пока LLM-роутер
+    решает, что делать. Теги и переформулировка - вызовы LLM, заранее они не делаются:
+    если роутер не выберет поиск, потрачено будет только время CPU.
+    '''
+
+    if config.prefetch.enabled and _key(run_config) is not None:
+        _register(run_config, query, executor.submit(prefetch_search, query), is_async=False)
+
+
+def astart(run_config, query: str):
+    '''
+    Асинхронная версия start: поиск идет задачей в текущем event loop.
+    '''
+
+    if config.prefetch.enabled and _key(run_config) is not None:
+        task = asyncio.ensure_future(aprefetch_search(query))
+        # Ошибку выброшенного поиска забираем, чтобы asyncio не ругался на необработанное исключение
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        _register(run_config, query, task, is_async=True)
+
+
+def discard(run_config):
+    '''
+    Роутер не стал вызывать retrieve_from_local - результат не понадобится.
+    '''
+
+    prefetch = _pop(run_config)
+    if prefetch is not None:
+        _drop(prefetch, 'unused')
+
+
+def _claim(run_config, query: str, allow_async: bool):
+    prefetch = _pop(run_config)
+    if prefetch is None:
+        return None
+    # Задачу event loop из синхронного инструмента не дождаться - считаем промахом
+    if (prefetch.is_async and not allow_async) or not is_equivalent(prefetch.query, query):
+        _drop(prefetch, 'miss')
+        return None
+    # Сколько поиск успел проработать параллельно с роутером
+    PREFETCH_OVERLAP_SECONDS.observe(time.perf_counter() - prefetch.started)
+    return prefetch
+
+
+def _failed():
+    logger.exception('Speculative retrieval failed')
+    PREFETCH.labels('error').inc()
+
+
+def take(run_config, query: str):
+    '''
+    Забирает результат заранее запущенного поиска, если роутер
+    запросил то же самое. Иначе (или при ошибке поиска) - None.
+
+    Returns:
+      результат prefetch_search (для retrieve(prefetched=...)) или None.
+    '''
+
+    prefetch = _claim(run_config, query, allow_async=False)
+    if prefetch is None:
+        return None
+    try:
+        result = prefetch.result.result()
+    except Exception:
+        _failed()
+        return None
+    PREFETCH.labels('hit').inc()
+    return result
+
+
+async def atake(run_config, query: str):
+    prefetch = _claim(run_config, query, allow_async=True)
+    if prefetch is None:
+        return None
+    try:
+        if prefetch.is_async:
+            result = await prefetch.result
+        else:
+            result = await asyncio.wrap_future(prefetch.result)
+    except Exception:
+        _failed()
+        return None
+    PREFETCH.labels('hit').inc()
+    return result
@@ -0,0 +1,333 @@
+import asyncio
+import logging
+import re
+import time
+
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+
+from app.src.utils import soft_merge, rrf_merge, rerank_by_tags, tag_filter, get_config
+from app.src.vectorstore.vectorstore import (
+    get_vector_store, search_many, embed_queries, run_in_embedding_executor
+)
+from app.src.vectorstore.bm25 import get_bm25_index, tokenize
+from app.src.metrics import observe_many, store_query
+from app.src.agent.llm import reformulate_query, areformulate_query
+from app.src.agent.tagger import get_query_tags, aget_query_tags
+from app.constants import DOCUMENT_TAGS
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+# Общий пул потоков для этапов ретривера: LLM-вызовы и поиск по базе
+# большую часть времени ждут сеть/модель, поэтому потоки здесь дешевые.
+# Пул копирует контекст в поток: вызовы LLM остаются дочерними для графа (callbacks, метрики).
+executor = ContextThreadPoolExecutor(
+    max_workers=config.retrieval.max_workers,
+    thread_name_prefix='retrieval'
+)
+
+# Запросы с точными фактами (почта, сайт, телефон, год) лучше всего ищутся лексически
+_EXACT_FACT_RE = re.compile(r'@|https?://|www\.|\.ru\b|\.com\b|\+?\d[\d\s()-]{5,}\d|\b(19|20)\d{2}\b')
+_QUESTION_WORDS = {
+    'как', 'что', 'где', 'когда', 'почему', 'зачем', 'какой', 'какая', 'какие', 'каких',
+    'кто', 'сколько', 'чем', 'можно', 'ли', 'расскажи', 'how', 'what', 'where', 'when', 'why', 'who'
+}
+
+
+def _timed(timings: dict, stage: str, func, *args, **kwargs):
+    '''
+    Вызывает func и записывает длительность вызова в timings[stage].
+    '''
+
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+async def _atimed(timings: dict, stage: str, awaitable):
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def search_variants(queries):
+    '''
+    Семантический поиск по нескольким вариантам запроса (исходный, переформулированный и т.д.)
+    за один батч эмбеддингов и один запрос к Chroma.
+
+    Returns:
+      по списку пар документ-скор на каждый вариант.
+    '''
+
+    return search_many(queries, k=config.semantic_search.k)
+
+
+async def asearch_variants(queries):
+    return await run_in_embedding_executor(search_variants, queries)
+
+
+def warm_query_embedding(query: str):
+    '''
+    Считает эмбеддинг исходного запроса заранее, пока LLM переформулирует запрос:
+    он остается в кэше эмбеддингов, и потом оба варианта ищутся одним батчем
+    (см. search_variants) без повторного прогона модели. Без кэша ничего не делает.
+    '''
+
+    if config.embedding_cache.enabled:
+        embed_queries([query])
+
+
+def tagged_search(query: str, tags):
+    '''
+    Поиск только среди документов с тегами запроса (where-фильтр Chroma
+    по булевым полям тегов). Достает релевантные по тегам документы,
+    которые не попали в общий top-k. Эмбеддинг запроса берется из кэша,
+    если поиск по исходному запросу уже его посчитал.
+    '''
+
+    where = tag_filter(tags)
+    if where is None or not config.semantic_search.tagged_k:
+        return []
+    with store_query(config.vectorstore.backend, 'search_tagged'):
+        return get_vector_store().similarity_search_with_score(
+            query,
+            k=config.semantic_search.tagged_k,
+            filter=where
+        )
+
+
+async def atagged_search(query: str, tags):
+    return await run_in_embedding_executor(tagged_search, query, tags)
+
+
+def lexical_search(query: str):
+    '''
+    Поиск по индексу BM25. Если гибридный поиск выключен или индекс
+    еще не построен (см. app/ingest.py) - None.
+    '''
+
+    if not config.hybrid.enabled:
+        return None
+    index = get_bm25_index()
+    if index is None:
+        return None
+    with store_query('bm25', 'search'):
+        return index.search(query, k=config.hybrid.lexical_k)
+
+
+async def alexical_search(query: str):
+    # BM25 считает скоры по всему индексу на CPU - в event loop он бы блокировал остальные запросы
+    return await run_in_embedding_executor(lexical_search, query)
+
+
+def is_keyword_query(query: str):
+    '''
+    Похож ли запрос на поиск по ключевым словам: содержит имейл, адрес сайта,
+    телефон или год, либо состоит из нескольких слов без вопросительных.
+    '''
+
+    if _EXACT_FACT_RE.search(query):
+        return True
+    terms = tokenize(query)
+    return 0 < len(terms) <= config.hybrid.fast_path_max_terms and not _QUESTION_WORDS & set(terms)
+
+
+def _use_fast_path(query: str, lexical_docs):
+    # Для ключевых запросов BM25 находит нужные чанки сам - тогда не тратим
+    # время на LLM (теги, переформулировка) и эмбеддинг запроса.
+    # Все слова запроса должны найтись в лучшем документе, иначе делаем полный поиск
+    if not (lexical_docs and config.hybrid.lexical_fast_path and is_keyword_query(query)):
+        return False
+    return set(tokenize(query)) <= set(tokenize(lexical_docs[0][0].page_content))
+
+
+def filter_tags(tags):
+    return set.intersection(set(tags), set(DOCUMENT_TAGS.keys()))
+
+
+def prefetch_search(query: str):
+    '''
+    Часть retrieve без LLM-вызовов: поиск BM25 и семантический поиск по исходному
+    запросу. Запускается заранее, пока LLM-роутер решает, нужен ли поиск
+    (см. prefetch.py), и передается в retrieve через prefetched.
+
+    Returns:
+      словарь с результатами поисков lexical и raw; raw - None, если запрос
+      уйдет по быстрому пути BM25 и семантический поиск не понадобится.
+    '''
+
+    lexical_docs = lexical_search(query)
+    if _use_fast_path(query, lexical_docs):
+        return {'lexical': lexical_docs, 'raw': None}
+    retrieved_docs, = search_variants([query])
+    return {'lexical': lexical_docs, 'raw': retrieved_docs}
+
+
+async def aprefetch_search(query: str):
+    lexical_docs = await alexical_search(query)
+    if _use_fast_path(query, lexical_docs):
+        return {'lexical': lexical_docs, 'raw': None}
+    retrieved_docs, = await asearch_variants([query])
+    return {'lexical': lexical_docs, 'raw': retrieved_docs}
+
+
+def _search_both(query: str, r_query: str, timings: dict, retrieved_docs=None):
+    # Оба варианта запроса - один батч эмбеддингов и один запрос к хранилищу;
+    # если исходный уже искали заранее (prefetch), ищется только переформулированный
+    if retrieved_docs is None:
+        return _timed(timings, 'search', search_variants, [query, r_query])
+    r_retrieved_docs, = _timed(timings, 'search_reformulated', search_variants, [r_query])
+    return retrieved_docs, r_retrieved_docs
+
+
+def _retrieve_sequential(query: str, timings: dict, retrieved_docs=None):
+    found_tags = filter_tags(_timed(timings, 'tags', get_query_tags, query))
+    r_query = _timed(timings, 'reformulate', reformulate_query, query)
+    retrieved_docs, r_retrieved_docs = _search_both(query, r_query, timings, retrieved_docs)
+    tagged_docs = _timed(timings, 'search_tagged', tagged_search, query, found_tags)
+    return {'raw': retrieved_docs, 'reformulated': r_retrieved_docs, 'tagged': tagged_docs}, found_tags
+
+
+def _tags_and_tagged_search(query: str, timings: dict):
+    found_tags = filter_tags(_timed(timings, 'tags', get_query_tags, query))
+    return found_tags, _timed(timings, 'search_tagged', tagged_search, query, found_tags)
+
+
+def _retrieve_concurrent(query: str, timings: dict, retrieved_docs=None):
+    # Эмбеддинг исходного запроса считается сразу, пока LLM переформулирует запрос,
+    # поиск по тегам стартует, как только LLM вернет теги (эмбеддинг к этому времени уже в кэше).
+    # Оба варианта запроса ищутся одним батчем после переформулировки: модель прогоняется
+    # только по новому варианту, в хранилище уходит один запрос со списком векторов
+    warm_future = None if retrieved_docs is not None else \
+        executor.submit(_timed, timings, 'embed', warm_query_embedding, query)
+    tags_future = executor.submit(_tags_and_tagged_search, query, timings)
+
+    r_query = _timed(timings, 'reformulate', reformulate_query, query)
+    if warm_future is not None:
+        warm_future.result()
+    retrieved_docs, r_retrieved_docs = _search_both(query, r_query, timings, retrieved_docs)
+
+    found_tags, tagged_docs = tags_future.result()
+    return {'raw': retrieved_docs, 'reformulated': r_retrieved_docs, 'tagged': tagged_docs}, found_tags
+
+
+def _union(lhs_docs, rhs_docs):
+    # Один и тот же документ может прийти из обоих поисков - оставляем лучший скор
+    best = {}
+    for doc, score in lhs_docs + rhs_docs:
+        if doc.page_content not in best or score < best[doc.page_content][1]:
+            best[doc.page_content] = (doc, score)
+    return sorted(best.values(), key=lambda x: x[1])
+
+
+def _merge(results: dict):
+    # Без индекса BM25 остается прежнее "мягкое" слияние двух семантических поисков,
+    # документы из поиска по тегам добавляются к нему и дальше конкурируют на реранжировании
+    if results.get('lexical') is None:
+        docs = soft_merge(results['raw'], results['reformulated'])
+        return _union(docs, results.get('tagged', []))
+    ranked_lists = [docs for docs in results.values() if docs is not None]
+    return rrf_merge(ranked_lists, k=config.semantic_search.k + config.semantic_search.tagged_k, rrf_k=config.hybrid.rrf_k)
+
+
+def _finish(results: dict, found_tags, timings: dict, start: float):
+    docs = _timed(timings, 'merge', _merge, results)
+    reranked_docs = _timed(timings, 'rerank', rerank_by_tags, docs, found_tags)
+    reranked_docs = reranked_docs[:config.semantic_search.k]
+
+    timings['total'] = time.perf_counter() - start
+    observe_many('retrieval', timings)
+    logger.info(
+        'retrieve_from_local timings: %s',
+        ', '.join(f'{stage}={duration * 1000:.1f}ms' for stage, duration in timings.items())
+    )
+    return reranked_docs, timings
+
+
+def retrieve(query: str, prefetched: dict = None):
+    '''
+    Многошаговый поиск по локальной базе: теги запроса, переформулировка,
+    семантический поиск по обоим вариантам запроса, поиск среди
+    документов с тегами запроса и поиск BM25,
+    слияние (RRF, если есть индекс BM25, иначе "мягкое") и реранжирование по тегам.
+    Оба варианта запроса ищутся одним батчем после переформулировки (search_variants).
+    При retrieval.concurrent теги и переформулировка запрашиваются параллельно,
+    эмбеддинг исходного запроса считается, пока ждем LLM, а поиск по тегам стартует
+    сразу после ответа LLM; без него этапы идут по очереди.
+    Запросы из ключевых слов, которые BM25 находит целиком, обходятся без LLM
+    и семантического поиска (hybrid.lexical_fast_path).
+
+    Args:
+      query: пользовательский запрос.
+      prefetched: результат prefetch_search, если поиск по запросу запускался заранее -
+        тогда BM25 и семантический поиск по исходному запросу не повторяются.
+
+    Returns:
+      реранжированный список пар документ-скор и словарь с длительностями
+      этапов в секундах (ключ total - полное время поиска).
+    '''
+
+    timings = {}
+    start = time.perf_counter()
+    prefetched = prefetched or {}
+
+    lexical_docs = prefetched['lexical'] if 'lexical' in prefetched else \
+        _timed(timings, 'search_lexical', lexical_search, query)
+    if _use_fast_path(query, lexical_docs):
+        return _finish({'lexical': lexical_docs}, set(), timings, start)
+
+    if config.retrieval.concurrent:
+        results, found_tags = _retrieve_concurrent(query, timings, prefetched.get('raw'))
+    else:
+        results, found_tags = _retrieve_sequential(query, timings, prefetched.get('raw'))
+    results['lexical'] = lexical_docs
+
+    return _finish(results, found_tags, timings, start)
+
+
+async def aretrieve(query: str, prefetched: dict = None):
+    '''
+    Асинхронная версия retrieve: LLM-вызовы идут через ainvoke,
+    эмбеддинги и поиск - в ограниченном пуле embedding_executor.
+    '''
+
+    timings = {}
+    start = time.perf_counter()
+    prefetched = prefetched or {}
+
+    lexical_docs = prefetched['lexical'] if 'lexical' in prefetched else \
+        await _atimed(timings, 'search_lexical', alexical_search(query))
+    if _use_fast_path(query, lexical_docs):
+        return _finish({'lexical': lexical_docs}, set(), timings, start)
+
+    async def warm_embedding():
+        if prefetched.get('raw') is None:
+            await _atimed(timings, 'embed', run_in_embedding_executor(warm_query_embedding, query))
+
+    async def variants_search():
+        r_query, _ = await asyncio.gather(
+            _atimed(timings, 'reformulate', areformulate_query(query)), warm_embedding()
+        )
+        if prefetched.get('raw') is not None:
+            docs, = await _atimed(timings, 'search_reformulated', asearch_variants([r_query]))
+            return prefetched['raw'], docs
+        return await _atimed(timings, 'search', asearch_variants([query, r_query]))
+
+    async def tags_and_tagged_search():
+        found_tags = filter_tags(await _atimed(timings, 'tags', aget_query_tags(query)))
+        return found_tags, await _atimed(timings, 'search_tagged', atagged_search(query, found_tags))
+
+    (retrieved_docs, r_retrieved_docs), (found_tags, tagged_docs) = await asyncio.gather(
+        variants_search(), tags_and_tagged_search()
+    )
+
+    results = {
+        'raw': retrieved_docs, 'reformulated': r_retrieved_docs,
+        'tagged': tagged_docs, 'lexical': lexical_docs
+    }
+    return _finish(results, found_tags, timings, start)
\ No newline at end of file
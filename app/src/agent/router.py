@@ -0,0 +1,150 @@
+import logging
+import re
+from uuid import uuid4
+
+from langchain_core.messages import AIMessage
+
+from app.src.utils import get_config
+from app.src.vectorstore.vectorstore import run_in_embedding_executor
+from app.src.agent.tagger import classifier, margin
+from app.src.metrics import ROUTE_DECISIONS, ROUTE_CONFIDENCE
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+# Вопросы о компании: их почти всегда нужно искать в локальной базе
+_DOMAIN_RE = re.compile(
+    r'neoflex|неофлекс|офис|адрес|контакт|почт|телефон|ваканс|резюме|карьер|стажир|'
+    r'проект|решени|продукт|платформ|клиент|заказчик|партн[её]р|кейс|внедр|экспертиз|'
+    r'технолог|мероприят|компани',
+    re.IGNORECASE
+)
+# Вопросы о свежих событиях: ответ на них есть только в интернете, а web_search
+# выбирает лишь LLM-роутер - такие вопросы локальный роутер не пропускает мимо него
+_FRESH_RE = re.compile(
+    r'новост|сегодня|вчера|сейчас|на данный момент|в этом году|на этой неделе|'
+    r'последн|свеж|курс\w* (валют|акци|доллар|евро|рубл)|котировк|погод',
+    re.IGNORECASE
+)
+# Приветствия и болтовня - на них LLM-роутер отвечает сам, без инструментов
+_SMALLTALK_RE = re.compile(
+    r'^\W*(привет|здравствуй|добр(ый|ое) (день|вечер|утро)|спасибо|благодарю|пока|до свидания|'
+    r'как дела|кто ты|что ты умеешь|hi|hello|thanks?)\b',
+    re.IGNORECASE
+)
+# Уточнения к прошлым репликам ("а в Саратове?", "а их контакты?") - поисковый запрос
+# по ним без истории не составить, это делает LLM-роутер
+_FOLLOW_UP_RE = re.compile(
+    r'^\W*(а|и|ещ[её]|тогда)\b|\b(он|она|оно|они|его|е[её]|их|ему|им|там|туда|тот|та|те)\b',
+    re.IGNORECASE
+)
+
+
+def _last_question(messages):
+    return next((str(message.content) for message in reversed(messages) if message.type == 'human'), '')
+
+
+def _has_history(messages):
+    return any(message.type == 'ai' for message in messages)
+
+
+def is_self_contained(messages):
+    '''
+    Можно ли искать по последнему вопросу как есть: это не болтовня
+    и не уточнение, которое без истории диалога не понять.
+    '''
+
+    question = _last_question(messages)
+    if not question.strip() or _SMALLTALK_RE.search(question):
+        return False
+    return not (_has_history(messages) and _FOLLOW_UP_RE.search(question))
+
+
+class RouteDecision:
+    '''
+    Решение локального роутера: route - retrieve (сразу в поиск) или llm
+    (решает LLM-роутер), reason - почему, confidence - уверенность (см. margin).
+    '''
+
+    def __init__(self, route: str, reason: str, confidence: float):
+        self.route = route
+        self.reason = reason
+        self.confidence = confidence
+
+
+def decide(messages):
+    '''
+    Решает, нужен ли LLM-роутер для последнего вопроса.
+    Мимо него в поиск уходят только вопросы, где есть явный признак вопроса
+    о компании и отрыв от среднего центроида тегов (см. margin) не меньше
+    router.min_margin. Болтовня, уточнения к прошлым репликам и вопросы
+    о свежих событиях (им нужен web_search) всегда уходят в LLM.
+
+    Args:
+      messages: сообщения состояния графа.
+
+    Returns:
+      RouteDecision.
+    '''
+
+    question = _last_question(messages)
+    if not question.strip():
+        return RouteDecision('llm', 'empty', 0.0)
+    if _SMALLTALK_RE.search(question):
+        return RouteDecision('llm', 'smalltalk', 0.0)
+    if _has_history(messages) and _FOLLOW_UP_RE.search(question):
+        return RouteDecision('llm', 'follow_up', 0.0)
+    if _FRESH_RE.search(question):
+        return RouteDecision('llm', 'fresh', 0.0)
+    if not _DOMAIN_RE.search(question):
+        return RouteDecision('llm', 'no_pattern', 0.0)
+
+    confidence = margin(classifier.scores(question))
+    if confidence >= config.router.min_margin:
+        return RouteDecision('retrieve', 'pattern', confidence)
+    return RouteDecision('llm', 'low_confidence', confidence)
+
+
+def _apply(decision: RouteDecision, messages):
+    ROUTE_DECISIONS.labels(decision.route, decision.reason).inc()
+    ROUTE_CONFIDENCE.labels(decision.route).observe(decision.confidence)
+    logger.debug('Route: %s (%s, confidence %.3f)', decision.route, decision.reason, decision.confidence)
+
+    if decision.route != 'retrieve':
+        return {}
+    # Тот же вызов инструмента, что сделал бы LLM-роутер: вопрос пользователя как есть
+    return {'messages': [AIMessage(content='', tool_calls=[{
+        'name': 'retrieve_from_local',
+        'args': {'query': _last_question(messages)},
+        'id': f'call_{uuid4().hex}',
+    }])]}
+
+
+def route(state):
+    '''
+    Нода графа перед query_or_respond. Уверенные вопросы о компании
+    сразу получают вызов retrieve_from_local, минуя LLM-роутер;
+    для остальных состояние не меняется.
+    '''
+
+    if not config.router.enabled:
+        return {}
+    return _apply(decide(state['messages']), state['messages'])
+
+
+async def aroute(state):
+    if not config.router.enabled:
+        return {}
+    # Эмбеддинг вопроса - CPU, выполняется в пуле эмбеддингов
+    decision = await run_in_embedding_executor(decide, state['messages'])
+    return _apply(decision, state['messages'])
+
+
+def after_route(state):
+    '''
+    Условное ребро после route: в tools, если роутер вызвал инструмент, иначе в query_or_respond.
+    '''
+
+    message = state['messages'][-1]
+    return 'tools' if message.type == 'ai' and message.tool_calls else 'query_or_respond'
@@ -0,0 +1,186 @@
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from app.src.utils import get_config
+from app.src.vectorstore.vectorstore import (
+    get_vector_store, get_embeddings, collection_version, run_in_embedding_executor
+)
+from app.src.agent import llm
+from app.constants import DOCUMENT_TAGS
+
+
+config = get_config()
+
+
+def parse_tagline(tagline: str):
+    '''
+    Достает теги из строки metadata['tags'].
+    Теги в ней разделены пробелами, но сами могут содержать пробелы ("О компании"),
+    поэтому ищем вхождения известных тегов, а не делим строку.
+    '''
+
+    return [tag for tag in DOCUMENT_TAGS if tag in tagline]
+
+
+def _normalize(matrix: np.ndarray):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def margin(scores: dict):
+    '''
+    Отрыв сходства с лучшим центроидом тегов от среднего по всем центроидам.
+    Само сходство для уверенности не годится: у E5 оно высокое почти для любого
+    текста, а отрыв показывает, что вопрос действительно ближе к одной теме.
+    '''
+
+    if len(scores) < 2:
+        return 0.0
+    values = np.fromiter(scores.values(), dtype=np.float32, count=len(scores))
+    return float(values.max() - values.mean())
+
+
+class TagClassifier:
+    '''
+    Локальный классификатор тегов запроса.
+    Сравнивает эмбеддинг запроса с центроидами тегов, посчитанными по
+    размеченным чанкам из Chroma. Центроиды пересчитываются, когда меняется
+    коллекция (проверяется не чаще, чем раз в refresh_interval секунд).
+    '''
+
+    def __init__(self, min_margin: float, margin: float, refresh_interval: float):
+        self.min_margin = min_margin
+        self.margin = margin
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        # Теги и их центроиды подменяются одним присваиванием: scores читает их без блокировки
+        self._centroids: tuple[list[str], np.ndarray] = ([], np.empty((0, 0), dtype=np.float32))
+        self._version = None
+        self._checked_at = 0.0
+
+    def _build(self):
+        data = get_vector_store().get(include=['embeddings', 'metadatas'])
+        vectors = np.asarray(data['embeddings'], dtype=np.float32)
+
+        tags, centroids = [], []
+        if len(vectors):
+            vectors = _normalize(vectors)
+            for tag in DOCUMENT_TAGS:
+                mask = np.array([
+                    tag in parse_tagline((metadata or {}).get('tags', ''))
+                    for metadata in data['metadatas']
+                ])
+                if mask.any():
+                    tags.append(tag)
+                    centroids.append(vectors[mask].mean(axis=0))
+
+        self._centroids = (
+            tags,
+            _normalize(np.array(centroids, dtype=np.float32)) if centroids else np.empty((0, 0), dtype=np.float32)
+        )
+
+    def version(self):
+        '''
+        Возвращает версию коллекции, по которой построены центроиды,
+        при необходимости перестраивая их.
+        '''
+
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.refresh_interval:
+            return self._version
+
+        with self._lock:
+            current = collection_version()
+            if current != self._version:
+                self._build()
+                self._version = current
+            self._checked_at = now
+        return self._version
+
+    def scores(self, query: str):
+        '''
+        Косинусное сходство запроса с центроидом каждого тега.
+
+        Returns:
+          словарь тег - сходство.
+        '''
+
+        self.version()
+        tags, centroids = self._centroids
+        if not tags:
+            return {}
+        query_vector = _normalize(np.asarray(get_embeddings().embed_query(query), dtype=np.float32))
+        sims = centroids @ query_vector
+        return dict(zip(tags, sims.tolist()))
+
+    def classify(self, query: str):
+        '''
+        Returns:
+          кортеж (теги, уверенность). Уверенность - отрыв лучшего тега от среднего (см. margin),
+          при уверенности ниже min_margin теги не возвращаются.
+          Теги берутся те, что не хуже лучшего более чем на self.margin.
+        '''
+
+        scores = self.scores(query)
+        confidence = margin(scores)
+        if confidence < self.min_margin:
+            return (), confidence
+        best = max(scores.values())
+        tags = tuple(tag for tag, score in scores.items() if score >= best - self.margin)
+        return tags, confidence
+
+
+classifier = TagClassifier(
+    min_margin=config.tagger.min_margin,
+    margin=config.tagger.margin,
+    refresh_interval=config.tagger.refresh_interval
+)
+
+
+@lru_cache(maxsize=config.tagger.cache_size)
+def _classify(query: str, version):
+    return classifier.classify(query)
+
+
+def _local_tags(query: str):
+    return _classify(query, classifier.version())
+
+
+def _is_confident(confidence: float):
+    return confidence >= config.tagger.min_margin or not config.tagger.llm_fallback
+
+
+def get_query_tags(user_query: str):
+    '''
+    Подбирает теги для пользовательского запроса.
+    При tagger.backend = local используется локальный классификатор по центроидам,
+    с откатом на LLM для неуверенных запросов (tagger.llm_fallback).
+    При tagger.backend = llm - как раньше, запрос к LLM.
+    '''
+
+    if config.tagger.backend == 'llm':
+        return llm.get_query_tags(user_query)
+
+    tags, confidence = _local_tags(user_query)
+    if not _is_confident(confidence):
+        return llm.get_query_tags(user_query)
+    return list(tags)
+
+
+async def aget_query_tags(user_query: str):
+    '''
+    Асинхронная версия get_query_tags. Локальная классификация выполняется
+    в пуле эмбеддингов, откат на LLM - асинхронным вызовом.
+    '''
+
+    if config.tagger.backend == 'llm':
+        return await llm.aget_query_tags(user_query)
+
+    tags, confidence = await run_in_embedding_executor(_local_tags, user_query)
+    if not _is_confident(confidence):
+        return await llm.aget_query_tags(user_query)
+    return list(tags)
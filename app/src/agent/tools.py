@@ -1,57 +1,87 @@
-from langchain_core.tools import tool
-
-from langchain_community.tools import DuckDuckGoSearchResults
-
-from app.src.utils import soft_merge, rerank_by_tags, get_config
-from app.src.vectorstore.vectorstore import vector_store
-from app.src.agent.llm import get_query_tags, reformulate_query
-from app.constants import DOCUMENT_TAGS
-
-
-config = get_config()
-
-@tool(response_format='content_and_artifact')
-def retrieve_from_local(query: str):
-    '''
-    Используй этот инструмент для поиска актуальной, специфической информации
-    о компании Neoflex в локальной базе знаний.
-
-    Вызывай этот инструмент для вопросов о:
-    - Адресах, местоположении офисов, контактных данных
-    - Проектах, решениях, заказчиках, технологиях, платформах, партнерах
-    - Конкретных фактах, датах, названиях, именах, ссылках и т.д.
-    - Любых других специфических деталях операций или структуры Neoflex.
-
-    Отдавай приоритет использованию этого инструмента перед своими внутренними знаниями
-    для проверки специфических фактов, чтобы гарантировать точность.
-
-    Attributes:
-    query (str): строковый запрос на естественном языке,
-        должен содержать ключевые слова для поиска.
-    '''
-
-    tags_set = set(DOCUMENT_TAGS.keys())
-    found_tags = set.intersection(set(get_query_tags(query)), tags_set)
-
-    r_query = reformulate_query(query)
-
-    r_retrieved_docs = vector_store.similarity_search_with_score(
-        f'query: {r_query}',
-        k=config.semantic_search.k
-    )
-    retrieved_docs = vector_store.similarity_search_with_score(
-        f'query: {query}',
-        k=config.semantic_search.k
-    )
-
-    docs = soft_merge(retrieved_docs, r_retrieved_docs)
-    reranked_docs = rerank_by_tags(docs, found_tags)
-
-    serialized = '\n\n'.join(
-        (f'Источник: {doc.metadata.get("url", "Неизвестный источник")}\n' f'Содержимое документа: {doc.page_content}')
-        for doc, _ in reranked_docs
-    )
-    return serialized, reranked_docs
-
-
-web_search = DuckDuckGoSearchResults()
\ No newline at end of file
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import StructuredTool
+
+from app.src.agent.retrieval import retrieve, aretrieve
+from app.src.agent import prefetch
+from app.src.agent.web_search import get_web_search
+
+
+def _serialize(reranked_docs):
+    return '\n\n'.join(
+        (f'Источник: {doc.metadata.get("url", "Неизвестный источник")}\n' f'Содержимое документа: {doc.page_content}')
+        for doc, _ in reranked_docs
+    )
+
+
+def _retrieve_from_local(query: str, config: RunnableConfig):
+    '''
+    Используй этот инструмент для поиска актуальной, специфической информации
+    о компании Neoflex в локальной базе знаний.
+
+    Вызывай этот инструмент для вопросов о:
+    - Адресах, местоположении офисов, контактных данных
+    - Проектах, решениях, заказчиках, технологиях, платформах, партнерах
+    - Конкретных фактах, датах, названиях, именах, ссылках и т.д.
+    - Любых других специфических деталях операций или структуры Neoflex.
+
+    Отдавай приоритет использованию этого инструмента перед своими внутренними знаниями
+    для проверки специфических фактов, чтобы гарантировать точность.
+
+    Attributes:
+    query (str): строковый запрос на естественном языке,
+        должен содержать ключевые слова для поиска.
+    '''
+
+    # BM25 и семантический поиск по этому запросу могли быть запущены заранее, параллельно с LLM-роутером
+    reranked_docs, _ = retrieve(query, prefetched=prefetch.take(config, query))
+    return _serialize(reranked_docs), reranked_docs
+
+
+async def _aretrieve_from_local(query: str, config: RunnableConfig):
+    reranked_docs, _ = await aretrieve(query, prefetched=await prefetch.atake(config, query))
+    return _serialize(reranked_docs), reranked_docs
+
+
+# Инструмент с синхронной и асинхронной реализацией:
+# graph.invoke вызывает первую, graph.ainvoke - вторую.
+retrieve_from_local = StructuredTool.from_function(
+    func=_retrieve_from_local,
+    coroutine=_aretrieve_from_local,
+    name='retrieve_from_local',
+    response_format='content_and_artifact'
+)
+
+
+def _serialize_web(results):
+    return '\n\n'.join(
+        f'Источник: {item.get("link", "Неизвестный источник")}\nСодержимое: {item.get("snippet", "")}'
+        for item in results
+    )
+
+
+def _web_search(query: str):
+    '''
+    Используй этот инструмент для поиска в интернете общей информации,
+    которой нет в локальной базе знаний Neoflex.
+
+    Attributes:
+    query (str): строковый запрос на естественном языке.
+    '''
+
+    # Не успевший к дедлайну или отключенный поиск возвращает пустой список:
+    # ответ строится по тому, что нашлось локально
+    results = get_web_search().search(query)
+    return _serialize_web(results), results
+
+
+async def _aweb_search(query: str):
+    results = await get_web_search().asearch(query)
+    return _serialize_web(results), results
+
+
+web_search = StructuredTool.from_function(
+    func=_web_search,
+    coroutine=_aweb_search,
+    name='web_search',
+    response_format='content_and_artifact'
+)
\ No newline at end of file
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from app.src.utils import get_config
+from app.src.vectorstore.embedding_cache import normalize_text
+from app.src.metrics import WEB_SEARCH, WEB_SEARCH_SECONDS, WEB_SEARCH_CIRCUIT_OPEN
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+
+class DuckDuckGoBackend:
+    '''
+    Прежний поиск через DuckDuckGo (пакет duckduckgo-search).
+    '''
+
+    def __init__(self, **kwargs):
+        from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+        self.wrapper = DuckDuckGoSearchAPIWrapper()
+
+    def search(self, query: str, max_results: int):
+        return [
+            {'title': item.get('title', ''), 'link': item.get('link', ''), 'snippet': item.get('snippet', '')}
+            for item in self.wrapper.results(query, max_results)
+        ]
+
+
+class HttpBackend:
+    '''
+    Поиск через HTTP-сервис: GET url?q=<запрос>&n=<сколько>, ответ - JSON-список
+    {title, link, snippet}. Так подключается локальная заглушка
+    (python -m app.benchmarks.fake_search) для тестов и бенчмарков.
+    '''
+
+    def __init__(self, url: str, timeout: float, **kwargs):
+        import requests
+        self.session = requests.Session()
+        self.url = url
+        self.timeout = timeout
+
+    def search(self, query: str, max_results: int):
+        response = self.session.get(self.url, params={'q': query, 'n': max_results}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()[:max_results]
+
+
+BACKENDS = {
+    'duckduckgo': DuckDuckGoBackend,
+    'http': HttpBackend,
+}
+
+
+class CircuitBreaker:
+    '''
+    После failure_threshold неудач подряд поиск отключается на cooldown секунд:
+    ответы строятся только по локальной базе. Затем пропускается один
+    пробный запрос - при успехе поиск снова включается.
+    '''
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if self._failures >= self.failure_threshold or self._opened_at is not None:
+                    self._opened_at = time.monotonic()
+            WEB_SEARCH_CIRCUIT_OPEN.set(self._opened_at is not None)
+
+
+class WebSearch:
+    '''
+    Обертка над бэкендом веб-поиска:
+      - ожидание ответа ограничено deadline секунд, после чего запрос
+        отвечает пустым списком (сам вызов бэкенда дорабатывает в фоне);
+      - результаты кэшируются на ttl секунд по нормализованному запросу;
+      - одинаковые запросы, пришедшие одновременно, ждут один вызов бэкенда;
+      - одновременно идет не больше max_concurrency вызовов бэкенда;
+      - при серии ошибок или медленных ответов срабатывает CircuitBreaker.
+    '''
+
+    def __init__(self, backend, deadline: float, max_results: int, max_concurrency: int,
+                 cache_ttl: float, cache_size: int, breaker: CircuitBreaker):
+        self.backend = backend
+        self.deadline = deadline
+        self.max_results = max_results
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.breaker = breaker
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='web-search')
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    @staticmethod
+    def _key(query: str):
+        return normalize_text(query).lower()
+
+    def _cached(self, key: str):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, results = entry
+            if expires_at < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return results
+
+    def _remember(self, key: str, results):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, results)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _call(self, query: str):
+        start = time.perf_counter()
+        try:
+            return self.backend.search(query, self.max_results), time.perf_counter() - start
+        finally:
+            WEB_SEARCH_SECONDS.observe(time.perf_counter() - start)
+
+    def _complete(self, key: str, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if future.exception() is not None:
+            self.breaker.record(False)
+            return
+        results, seconds = future.result()
+        # Ответ, опоздавший к дедлайну, все равно кэшируем, но для breaker это неудача
+        self.breaker.record(seconds <= self.deadline)
+        if results:
+            self._remember(key, results)
+
+    def _submit(self, key: str, query: str):
+        '''
+        Returns:
+          пару (future вызова бэкенда или None, если поиск отключен breaker; присоединился ли к чужому вызову).
+        '''
+
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, True
+            if not self.breaker.allow():
+                return None, False
+            future = self._executor.submit(self._call, query)
+            self._inflight[key] = future
+        future.add_done_callback(lambda done: self._complete(key, done))
+        return future, False
+
+    def _start(self, query: str):
+        key = self._key(query)
+        results = self._cached(key)
+        if results is not None:
+            WEB_SEARCH.labels('cache').inc()
+            return results, None, False
+        future, coalesced = self._submit(key, query)
+        if future is None:
+            WEB_SEARCH.labels('circuit_open').inc()
+            return [], None, False
+        return None, future, coalesced
+
+    @staticmethod
+    def _failed(query: str, error: Exception):
+        if isinstance(error, (FutureTimeoutError, asyncio.TimeoutError)):
+            WEB_SEARCH.labels('timeout').inc()
+            logger.warning('Web search timed out for %r', query)
+        else:
+            WEB_SEARCH.labels('error').inc()
+            logger.warning('Web search failed for %r: %s', query, error)
+        return []
+
+    def search(self, query: str):
+        '''
+        Returns:
+          список словарей {title, link, snippet}; пустой, если поиск не успел,
+          упал или отключен.
+        '''
+
+        results, future, coalesced = self._start(query)
+        if future is None:
+            return results
+        try:
+            results, _ = future.result(timeout=self.deadline)
+        except Exception as e:
+            return self._failed(query, e)
+        WEB_SEARCH.labels('coalesced' if coalesced else 'ok').inc()
+        return results
+
+    async def asearch(self, query: str):
+        results, future, coalesced = self._start(query)
+        if future is None:
+            return results
+        try:
+            # shield: по таймауту отменяется только ожидание, а не общий для всех вызов бэкенда
+            results, _ = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.deadline)
+        except Exception as e:
+            return self._failed(query, e)
+        WEB_SEARCH.labels('coalesced' if coalesced else 'ok').inc()
+        return results
+
+
+_lock = threading.Lock()
+_web_search = None
+
+
+def get_web_search():
+    '''
+    Веб-поиск по настройкам web_search. Бэкенд создается при первом обращении.
+    '''
+
+    global _web_search
+    if _web_search is None:
+        with _lock:
+            if _web_search is None:
+                settings = config.web_search
+                if settings.backend not in BACKENDS:
+                    raise ValueError(
+                        f'Unknown web search backend: {settings.backend}. Available: {", ".join(BACKENDS)}'
+                    )
+                backend = BACKENDS[settings.backend](url=settings.http.url, timeout=settings.deadline)
+                _web_search = WebSearch(
+                    backend,
+                    deadline=settings.deadline,
+                    max_results=settings.max_results,
+                    max_concurrency=settings.max_concurrency,
+                    cache_ttl=settings.cache_ttl,
+                    cache_size=settings.cache_size,
+                    breaker=CircuitBreaker(
+                        failure_threshold=settings.breaker.failure_threshold,
+                        cooldown=settings.breaker.cooldown
+                    )
+                )
+    return _web_search
\ No newline at end of file
@@ -0,0 +1,157 @@
+import logging
+import re
+import zlib
+
+import numpy as np
+
+from app.src.utils import get_config, tag_metadata
+from app.constants import DOCUMENT_TAGS
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def shingles(text: str, size: int):
+    '''
+    Хэши словесных шинглов текста (uint32).
+    Тексты короче size слов превращаются в один шингл.
+    '''
+
+    words = _WORD_RE.findall(text.lower())
+    grams = {' '.join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64)
+
+
+class MinHasher:
+    '''
+    MinHash-сигнатуры на multiply-shift хэшировании: num_perm независимых
+    функций h(x) = (a * x + b) >> 32 в арифметике uint64.
+    '''
+
+    def __init__(self, num_perm: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes: np.ndarray):
+        with np.errstate(over='ignore'):
+            values = (self.a[:, np.newaxis] * hashes[np.newaxis, :] + self.b[:, np.newaxis]) >> np.uint64(32)
+        return values.min(axis=1)
+
+
+def _candidate_pairs(signatures: np.ndarray, bands: int):
+    # LSH: документы, у которых совпала хотя бы одна полоса сигнатуры, становятся кандидатами
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    pairs = set()
+    for band in range(bands):
+        chunk = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = chunk.view(np.dtype((np.void, chunk.dtype.itemsize * rows))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        buckets = np.split(np.argsort(inverse, kind='stable'), np.cumsum(counts)[:-1])
+        for members in buckets:
+            if len(members) < 2:
+                continue
+            pairs.update(
+                (int(members[i]), int(members[j]))
+                for i in range(len(members)) for j in range(i + 1, len(members))
+            )
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.array(sorted(pairs), dtype=np.int64)
+
+
+def _clusters(lengths, pairs: np.ndarray):
+    '''
+    Группы дубликатов вокруг представителя - самого длинного чанка группы.
+    Чанк попадает в группу, только если он сам похож на представителя:
+    связи не транзитивны, и цепочка A~B~C из шаблонных страниц не схлопывает
+    A и C, если они между собой не похожи.
+
+    Args:
+      lengths: длины чанков.
+      pairs: пары похожих чанков (уже прошедшие порог).
+
+    Returns:
+      список пар (представитель, остальные чанки группы).
+    '''
+
+    neighbors = [[] for _ in lengths]
+    for i, j in pairs:
+        neighbors[i].append(int(j))
+        neighbors[j].append(int(i))
+
+    assigned = np.zeros(len(lengths), dtype=bool)
+    clusters = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if assigned[i]:
+            continue
+        assigned[i] = True
+        members = [j for j in sorted(neighbors[i]) if not assigned[j]]
+        assigned[members] = True
+        clusters.append((i, members))
+    return clusters
+
+
+def _merge_metadata(representative, duplicates):
+    # Источники и теги выброшенных чанков переезжают в оставшийся
+    docs = [representative] + duplicates
+    sources = sorted({doc.metadata.get('source', '') for doc in docs} - {''})
+    taglines = ' '.join(doc.metadata.get('tags', '') for doc in docs)
+    tags = [tag for tag in DOCUMENT_TAGS if tag in taglines]
+
+    representative.metadata['sources'] = ' '.join(sources)
+    representative.metadata['tags'] = ' '.join(tags)
+    representative.metadata.update(tag_metadata(tags))
+    return representative
+
+
+def deduplicate(docs, threshold: float = None, shingle_size: int = None,
+                num_perm: int = None, bands: int = None):
+    '''
+    Убирает почти одинаковые чанки (повторяющуюся навигацию, шаблонный текст пресс-центра и т.п.).
+    Кандидаты ищутся через MinHash + LSH, затем пары проверяются по оценке
+    коэффициента Жаккара шинглов. Из каждой группы дубликатов остается самый
+    длинный чанк, к нему в метаданные добавляются источники (sources) и теги остальных.
+    В группу входят только чанки, похожие на сам оставшийся чанк (см. _clusters).
+
+    Args:
+      docs: список документов.
+      threshold: минимальная схожесть по Жаккару, чтобы считать чанки дубликатами.
+      shingle_size: длина шингла в словах.
+      num_perm: длина MinHash-сигнатуры.
+      bands: число полос LSH (num_perm должно на него делиться).
+
+    Returns:
+      список документов без дубликатов, в исходном порядке.
+    '''
+
+    threshold = config.dedup.threshold if threshold is None else threshold
+    shingle_size = shingle_size or config.dedup.shingle_size
+    num_perm = num_perm or config.dedup.num_perm
+    bands = bands or config.dedup.bands
+
+    if len(docs) < 2:
+        return list(docs)
+
+    hasher = MinHasher(num_perm)
+    signatures = np.stack([
+        hasher.signature(shingles(doc.page_content, shingle_size))
+        for doc in docs
+    ])
+
+    pairs = _candidate_pairs(signatures, bands)
+    if len(pairs):
+        similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+        pairs = pairs[similarity >= threshold]
+
+    keep = []
+    for best, members in _clusters([len(doc.page_content) for doc in docs], pairs):
+        duplicates = [docs[i] for i in members]
+        keep.append((best, _merge_metadata(docs[best], duplicates) if duplicates else docs[best]))
+
+    logger.info('Near-duplicate filter: %d -> %d chunks', len(docs), len(keep))
+    return [doc for _, doc in sorted(keep, key=lambda item: item[0])]
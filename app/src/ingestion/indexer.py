@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from langchain_core.documents import Document
+
+from app.src.utils import get_config
+from app.src.vectorstore.vectorstore import get_vector_store
+from app.src.vectorstore.bm25 import build_bm25_index
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+
+def chunk_id(doc):
+    '''
+    Id чанка - хэш от содержимого и метаданных.
+    Один и тот же чанк всегда получает один и тот же id, измененный - новый.
+    '''
+
+    payload = json.dumps(
+        [doc.page_content, doc.metadata],
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_manifest(path: str):
+    if not os.path.exists(path):
+        return {'revision': 0, 'sources': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path: str, manifest: dict):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _batches(items, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _kept_documents(vector_store, keep_sources):
+    '''
+    Уже проиндексированные чанки источников keep_sources - с прежними id,
+    чтобы они не удалились и попали в индекс BM25 и манифест.
+    '''
+
+    stored = vector_store.get(include=['metadatas'])
+    ids = [
+        doc_id for doc_id, metadata in zip(stored['ids'], stored['metadatas'])
+        if (metadata or {}).get('source') in keep_sources
+    ]
+    if not ids:
+        return {}
+    kept = vector_store.get(ids=ids, include=['documents', 'metadatas'])
+    return {
+        doc_id: Document(page_content=content, metadata=metadata or {})
+        for doc_id, content, metadata in zip(kept['ids'], kept['documents'], kept['metadatas'])
+    }
+
+
+def sync_documents(docs, dry_run: bool = False, keep_sources=()):
+    '''
+    Приводит коллекцию documents в соответствие с переданным набором чанков:
+    эмбеддит и добавляет только новые или измененные чанки, удаляет те,
+    которых больше нет (в том числе чанки удаленных страниц и дубликаты
+    от прошлых полных перезаливок), пересобирает индекс BM25 для гибридного
+    поиска и записывает манифест проиндексированного.
+
+    Args:
+      docs: полный актуальный набор чанков.
+      dry_run: только посчитать изменения, ничего не записывая.
+      keep_sources: источники, которые в этом прогоне не собирались
+        (скрэпперы при --no-scrape): их чанки остаются как есть.
+
+    Returns:
+      словарь со статистикой: сколько чанков добавлено, удалено и осталось без изменений.
+    '''
+
+    vector_store = get_vector_store()
+    batch_size = config.ingestion.batch_size
+
+    # Одинаковые чанки получают одинаковый id, так что дубликаты схлопываются здесь же
+    desired = {chunk_id(doc): doc for doc in docs}
+    existing = set(vector_store.get(include=[])['ids'])
+    if keep_sources:
+        for doc_id, doc in _kept_documents(vector_store, set(keep_sources)).items():
+            desired.setdefault(doc_id, doc)
+
+    to_add = [doc_id for doc_id in desired if doc_id not in existing]
+    to_delete = [doc_id for doc_id in existing if doc_id not in desired]
+    stats = {
+        'added': len(to_add),
+        'deleted': len(to_delete),
+        'unchanged': len(desired) - len(to_add),
+        'total': len(desired),
+    }
+    if dry_run:
+        return stats
+
+    start = time.perf_counter()
+    for batch in _batches(to_delete, batch_size):
+        vector_store.delete(ids=batch)
+    for batch in _batches(to_add, batch_size):
+        vector_store.add_documents(documents=[desired[doc_id] for doc_id in batch], ids=batch)
+        logger.info('Indexed %d chunks', len(batch))
+    # Лексический индекс дешево пересобрать целиком, он всегда отражает текущий набор чанков
+    if config.hybrid.enabled:
+        build_bm25_index(list(desired.keys()), list(desired.values()))
+    stats['seconds'] = time.perf_counter() - start
+
+    sources = {}
+    for doc_id, doc in desired.items():
+        sources.setdefault(doc.metadata.get('source', 'unknown'), []).append(doc_id)
+
+    manifest = load_manifest(config.ingestion.manifest_path)
+    save_manifest(config.ingestion.manifest_path, {
+        'revision': manifest['revision'] + (1 if to_add or to_delete else 0),
+        'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'model_name': config.embeddings.model_name,
+        'stats': stats,
+        'sources': sources,
+    })
+    return stats
@@ -0,0 +1,165 @@
+import re
+
+import numpy as np
+import requests
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import app.web_scrapers as web_scrapers
+import app.constants as constants
+from app.src.ingestion.dedup import deduplicate
+from app.src.utils import get_config, tag_metadata
+
+
+config = get_config()
+
+# Источники, документы которых собирают скрэпперы (scrape_documents), а не краулер
+SCRAPED_SOURCES = (constants.CONTACTS_URL, constants.CUSTOMERS_URL, constants.CAREER_URL)
+
+NAVIGATION_ARTIFACTS = {
+    'previous', 'next', 'поделиться', 'отправить на e-mail', 'узнать',
+    'пресс-центр', 'новости', 'сми о нас', 'показать еще', '...',
+    'подписаться на новости', 'отправить', 'поделитьсяотправить на e-mail'
+}
+
+
+def load_crawled_documents(dataset_url: str):
+    '''
+    Загружает результаты краулера Apify (website-content-crawler) из датасета.
+    '''
+
+    data = requests.get(dataset_url, timeout=60)
+    data.raise_for_status()
+    return [
+        Document(page_content=item['text'] or '', metadata={'source': item['url']})
+        for item in data.json()
+    ]
+
+
+def clean_navigation_artifacts(text: str):
+    '''
+    Удаляет из текста навигационные артефакты, не несущие смысла:
+    годы и номера страниц пагинации, кнопки "поделиться", "показать еще" и т.п.
+    '''
+
+    lines = text.splitlines()
+    cleaned_lines = []
+    for line in lines:
+        line = line.strip()
+
+        if not line:
+            continue
+        if re.fullmatch(r'20\d{2}', line):
+            continue
+        if re.fullmatch(r'\d{1,2}', line):
+            continue
+        if line.lower() in NAVIGATION_ARTIFACTS:
+            continue
+
+        cleaned_lines.append(line)
+
+    return '\n'.join(cleaned_lines)
+
+
+def split_documents(docs):
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=config.documents.chunk_size,
+        chunk_overlap=config.documents.chunk_overlap
+    )
+    splits = text_splitter.split_documents(docs)
+    for split in splits:
+        split.page_content = clean_navigation_artifacts(split.page_content)
+    return splits
+
+
+def tfidf_filter(docs, threshold_percentile: float):
+    '''
+    Отсеивает "воду": документы, чья сумма TF-IDF ниже заданного перцентиля.
+    '''
+
+    texts = [doc.page_content for doc in docs]
+
+    vectorizer = TfidfVectorizer()
+    tfidf_matrix = vectorizer.fit_transform(texts)
+
+    scores = np.asarray(tfidf_matrix.sum(axis=1)).flatten()
+    threshold = np.percentile(scores, threshold_percentile)
+
+    return [doc for doc, score in zip(docs, scores) if score > threshold]
+
+
+async def scrape_documents():
+    '''
+    Документы, которые краулер достать не может: контакты офисов по городам,
+    информация о клиентах и имейл для резюме (см. app/web_scrapers.py).
+    Все скрэпперы работают параллельно в одном браузере.
+    '''
+
+    scraped = await web_scrapers.scrape_all(max_pages=config.scraping.max_pages)
+
+    city_data = scraped['cities']
+    city_docs = [
+        Document(
+            metadata={'source': constants.CONTACTS_URL},
+            page_content=f'Контакты офисов компании в городе {name} (адрес, электронная почта, телефон): {data}'
+        )
+        for name, data in city_data.items()
+    ]
+
+    customer_data = scraped['customers']
+    customer_docs = [
+        Document(
+            metadata={'source': constants.CUSTOMERS_URL},
+            page_content=f'Информация об одном из клиентов (заказчиков) компании Neoflex: {data}'
+        )
+        for data in customer_data
+    ]
+
+    career_doc = Document(
+        metadata={'source': constants.CAREER_URL},
+        page_content=scraped['career']
+    )
+
+    return city_docs + customer_docs + [career_doc]
+
+
+def add_tags(docs):
+    '''
+    Проставляет теги по url страницы, породившей документ:
+    строкой в metadata['tags'] и булевыми полями для фильтрации в Chroma.
+    '''
+
+    for doc in docs:
+        matched_tags = [
+            tag for tag, snippet in constants.DOCUMENT_TAGS.items()
+            if snippet and snippet in doc.metadata.get('source', '')
+        ]
+        doc.metadata['tags'] = ' '.join(matched_tags)
+        doc.metadata.update(tag_metadata(matched_tags))
+    return docs
+
+
+async def build_documents(dataset_url: str, scrape: bool = True):
+    '''
+    Полный конвейер подготовки документов, раньше живший в neoflex_rag.ipynb:
+    загрузка краулинга, разбиение на чанки, очистка, TF-IDF фильтр,
+    скрэпперы, теги и удаление почти-дубликатов.
+    Префикс E5 "passage: " добавляет бэкенд эмбеддингов, в тексте чанков его нет.
+
+    Args:
+      dataset_url: url датасета Apify с результатами краулинга.
+      scrape: запускать ли скрэпперы playwright.
+
+    Returns:
+      список готовых к индексации документов.
+    '''
+
+    docs = split_documents(load_crawled_documents(dataset_url))
+    docs = tfidf_filter(docs, config.tfidf.threshold_percentile)
+    if scrape:
+        docs += await scrape_documents()
+    docs = add_tags(docs)
+    if config.dedup.enabled:
+        docs = deduplicate(docs)
+    return docs
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from app.src.utils import get_config, preload_prompts
+from app.src.vectorstore.vectorstore import warmup, has_tag_fields
+from app.src.agent.tagger import classifier
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+
+class Lifecycle:
+    '''
+    Жизненный цикл приложения: однократная загрузка конфига и промптов,
+    загрузка модели и хранилища (сразу или при первом запросе) и прогрев.
+    Готовность (ready) выставляется только после завершения прогрева.
+    '''
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self.error = None
+        self.timings = {}
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def _warmup(self):
+        try:
+            start = time.perf_counter()
+            warmup(config.startup.warmup_query)
+            self.timings['warmup'] = time.perf_counter() - start
+            if not has_tag_fields():
+                logger.warning(
+                    'Documents have no tag_* metadata fields (index built before they were added): '
+                    'tag-filtered search finds nothing and the tag boost falls back to the tags string. '
+                    'Re-run python -m app.ingest to re-index.'
+                )
+
+            # Центроиды тегов строятся по всей коллекции - тоже делаем это до первого запроса
+            start = time.perf_counter()
+            classifier.version()
+            self.timings['tag_centroids'] = time.perf_counter() - start
+
+            self._ready.set()
+            logger.info('Warm-up finished: %s', self.timings)
+        except Exception as e:
+            self.error = str(e)
+            logger.exception('Warm-up failed')
+
+    def startup(self):
+        '''
+        Вызывается один раз при старте сервера.
+        При startup.eager модель, хранилище и центроиды тегов загружаются в фоне,
+        иначе - лениво, при первом запросе, и приложение сразу считается готовым.
+        '''
+
+        start = time.perf_counter()
+        get_config()
+        preload_prompts()
+        self.timings['prompts'] = time.perf_counter() - start
+
+        if config.startup.eager:
+            threading.Thread(target=self._warmup, name='warmup', daemon=True).start()
+        else:
+            self._ready.set()
+
+
+lifecycle = Lifecycle()
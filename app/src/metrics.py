@@ -0,0 +1,452 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from app.src.utils import get_config
+
+
+config = get_config()
+logger = logging.getLogger(__name__)
+
+
+# Гистограммы задержек. Этапы подписаны как <группа>.<имя>:
+# node.generate, tool.retrieve_from_local, retrieval.reformulate, embed.query и т.д.
+STAGE_SECONDS = Histogram(
+    'rag_stage_seconds', 'Duration of pipeline stages: graph nodes, tools and retrieval steps.',
+    ['stage'], buckets=config.metrics.buckets
+)
+LLM_SECONDS = Histogram(
+    'rag_llm_seconds', 'LLM call latency by call site.',
+    ['site'], buckets=config.metrics.buckets
+)
+LLM_TOKENS = Counter(
+    'rag_llm_tokens', 'LLM tokens by call site and direction (prompt, completion).',
+    ['site', 'kind']
+)
+LLM_ERRORS = Counter('rag_llm_errors', 'Failed LLM calls by call site.', ['site'])
+LLM_QUEUE_SECONDS = Histogram(
+    'rag_llm_queue_seconds', 'Time an LLM call waited for its call site concurrency limit.',
+    ['site'], buckets=config.metrics.buckets
+)
+LLM_RETRIES = Counter('rag_llm_retries', 'Retried LLM calls by call site and error type.', ['site', 'error'])
+LLM_HEDGES = Counter(
+    'rag_llm_hedges',
+    'Hedged LLM requests by call site: sent (duplicate issued), won (duplicate answered first), '
+    'skipped (hedge pool saturated).',
+    ['site', 'result']
+)
+EMBEDDING_SECONDS = Histogram(
+    'rag_embedding_batch_seconds', 'Duration of one embedding model run.',
+    ['kind'], buckets=config.metrics.buckets
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    'rag_embedding_batch_size', 'Texts per embedding model run.',
+    ['kind'], buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+EMBEDDING_QUEUE_WAIT = Histogram(
+    'rag_embedding_queue_wait_seconds', 'Time a query waits in the micro-batcher before its batch runs.',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+EMBEDDING_BATCH_REQUESTS = Histogram(
+    'rag_embedding_batch_requests', 'Concurrent callers merged into one micro-batched embedding run.',
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+)
+STORE_SECONDS = Histogram(
+    'rag_store_query_seconds', 'Vector store and BM25 query latency.',
+    ['backend', 'operation'], buckets=config.metrics.buckets
+)
+CONTEXT_TOKENS = Histogram(
+    'rag_context_tokens', 'Approximate tokens of tool output before and after context packing.',
+    ['stage'], buckets=(100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000)
+)
+ROUTE_DECISIONS = Counter(
+    'rag_route_decisions', 'Local router decisions by route (retrieve, llm) and reason.',
+    ['route', 'reason']
+)
+ROUTE_CONFIDENCE = Histogram(
+    'rag_route_confidence', 'Local router confidence (best minus mean tag centroid similarity) by chosen route.',
+    ['route'], buckets=(0.005, 0.01, 0.02, 0.03, 0.04, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5)
+)
+PREFETCH = Counter(
+    'rag_prefetch', 'Speculative retrievals by outcome: hit, miss (router asked for another query), '
+    'unused (router did not retrieve), error.',
+    ['result']
+)
+PREFETCH_OVERLAP_SECONDS = Histogram(
+    'rag_prefetch_overlap_seconds', 'How long a reused speculative retrieval ran in parallel with the router.',
+    buckets=config.metrics.buckets
+)
+PREFETCH_WASTED_SECONDS = Histogram(
+    'rag_prefetch_wasted_seconds', 'Time spent on discarded speculative retrievals (lower bound if still running).',
+    buckets=config.metrics.buckets
+)
+WEB_SEARCH = Counter(
+    'rag_web_search', 'Web searches by outcome: cache, coalesced (joined an identical in-flight search), '
+    'ok, timeout (deadline exceeded), error, circuit_open (skipped while the backend is failing).',
+    ['result']
+)
+WEB_SEARCH_SECONDS = Histogram(
+    'rag_web_search_seconds', 'Web search backend call latency, including calls that missed the deadline.',
+    buckets=config.metrics.buckets
+)
+WEB_SEARCH_CIRCUIT_OPEN = Gauge('rag_web_search_circuit_open', 'Whether web search is disabled by the circuit breaker.')
+REQUEST_SECONDS = Histogram(
+    'rag_request_seconds', 'HTTP request latency by route and status.',
+    ['route', 'status'], buckets=config.metrics.buckets
+)
+
+# Вызовы LLM внутри нод графа подписываются по ноде, остальные передают llm_site явно
+SITE_BY_NODE = {
+    'query_or_respond': 'router',
+    'generate': 'generate',
+    'trim_history': 'summary',
+}
+
+
+class RequestTimings:
+    '''
+    Длительности этапов одного HTTP-запроса для заголовка Server-Timing.
+    Один и тот же этап может выполняться несколько раз (эмбеддинги, LLM),
+    тогда длительности суммируются.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def header(self, total: float = None):
+        with self._lock:
+            items = list(self.durations.items())
+        if total is not None:
+            items.append(('total', total))
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in items)
+
+
+# Текущий запрос. Сам объект изменяемый, поэтому этапы, выполненные в пулах потоков
+# со скопированным контекстом, попадают в тот же RequestTimings
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    '''
+    Начинает сбор Server-Timing для запроса.
+
+    Returns:
+      пару (RequestTimings, токен для end_request).
+    '''
+
+    timings = RequestTimings()
+    return timings, _request_timings.set(timings)
+
+
+def end_request(token):
+    _request_timings.reset(token)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    '''
+    Трейсер OpenTelemetry, если включен metrics.otel и пакет установлен, иначе None.
+    Экспортер настраивается снаружи (opentelemetry-instrument, переменные OTEL_*).
+    '''
+
+    global _tracer
+    if not config.metrics.otel:
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                try:
+                    from opentelemetry import trace
+                    _tracer = trace.get_tracer('neoflex-rag')
+                except ImportError:
+                    logger.warning('metrics.otel is enabled, but opentelemetry-api is not installed')
+                    _tracer = False
+    return _tracer or None
+
+
+def observe(stage: str, seconds: float):
+    '''
+    Записывает длительность этапа в гистограмму и в Server-Timing текущего запроса.
+    '''
+
+    if not config.metrics.enabled:
+        return
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def observe_many(group: str, durations: dict):
+    for stage, seconds in durations.items():
+        observe(f'{group}.{stage}', seconds)
+
+
+@contextmanager
+def _measure(name: str, record):
+    # С выключенными метриками блок выполняется как есть: без таймера, span и записи
+    if not config.metrics.enabled:
+        yield
+        return
+    tracer = get_tracer()
+    start = time.perf_counter()
+    with tracer.start_as_current_span(name) if tracer else nullcontext():
+        try:
+            yield
+        finally:
+            record(time.perf_counter() - start)
+
+
+def stage(name: str):
+    '''
+    Контекстный менеджер: измеряет блок как этап name (и открывает span, если включен OpenTelemetry).
+    '''
+
+    return _measure(name, lambda seconds: observe(name, seconds))
+
+
+def embedding_batch(kind: str, size: int):
+    '''
+    Измеряет один прогон модели эмбеддингов: kind - query или passage, size - размер батча.
+    '''
+
+    def record(seconds):
+        EMBEDDING_SECONDS.labels(kind).observe(seconds)
+        EMBEDDING_BATCH_SIZE.labels(kind).observe(size)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(f'embed.{kind}', seconds)
+
+    return _measure(f'embed.{kind}', record)
+
+
+def observe_embedding_queue(wait: float, seconds: float):
+    '''
+    Ожидание в очереди микробатчера и длительность батча, в который попал запрос.
+    Прогон модели идет в потоке батчера, поэтому в Server-Timing его пишет вызывающий.
+    '''
+
+    if not config.metrics.enabled:
+        return
+    EMBEDDING_QUEUE_WAIT.observe(wait)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add('embed.queue', wait)
+        timings.add('embed.query', seconds)
+
+
+def store_query(backend: str, operation: str):
+    '''
+    Измеряет запрос к хранилищу: backend - chroma, mmap или bm25.
+    '''
+
+    def record(seconds):
+        STORE_SECONDS.labels(backend, operation).observe(seconds)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(f'store.{operation}', seconds)
+
+    return _measure(f'store.{backend}.{operation}', record)
+
+
+def llm_site(site: str):
+    '''
+    Конфиг вызова LLM, по которому MetricsCallbackHandler узнает место вызова.
+    '''
+
+    return {'metadata': {'llm_site': site}}
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    '''
+    Обработчик событий LangChain: длительности нод графа, инструментов
+    и вызовов LLM (с числом токенов). Передается в config графа,
+    поэтому видит и вложенные вызовы - LLM внутри инструментов и нод.
+    '''
+
+    # Обработчик дешевый, поэтому и в асинхронном графе вызывается сразу, без пула потоков
+    run_inline = True
+
+    def __init__(self):
+        self._runs = {}
+
+    def _start(self, run_id, name: str, site: str = None):
+        tracer = get_tracer()
+        span = tracer.start_span(name) if tracer else None
+        self._runs[run_id] = (name, site, time.perf_counter(), _request_timings.get(), span)
+
+    def _end(self, run_id, usage: dict = None, error: bool = False):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        name, site, start, timings, span = run
+        seconds = time.perf_counter() - start
+
+        if site is None:
+            STAGE_SECONDS.labels(name).observe(seconds)
+        else:
+            LLM_SECONDS.labels(site).observe(seconds)
+            if error:
+                LLM_ERRORS.labels(site).inc()
+            for kind, tokens in (usage or {}).items():
+                LLM_TOKENS.labels(site, kind).inc(tokens)
+        if timings is not None:
+            timings.add(name, seconds)
+        if span is not None:
+            span.end()
+
+    def cancel(self, run_id):
+        '''
+        Забывает вызов без записи длительности и ошибки: отмененный запрос
+        (проигравший hedging, ушедший клиент) - не ошибка LLM, а его обрезанная
+        длительность исказила бы гистограмму. Повторный вызов для того же run_id ничего не делает.
+        '''
+
+        run = self._runs.pop(run_id, None)
+        if run is not None and run[4] is not None:
+            run[4].end()
+
+    @staticmethod
+    def _is_node(name: str, tags, metadata):
+        # Сама нода, а не вложенные в нее runnable: имя совпадает с langgraph_node и есть тег шага
+        return name is not None and name == (metadata or {}).get('langgraph_node') \
+            and any(tag.startswith('graph:step:') for tag in tags or [])
+
+    def on_chain_start(self, serialized, inputs, *, run_id, tags=None, metadata=None, **kwargs):
+        name = kwargs.get('name')
+        if self._is_node(name, tags, metadata):
+            self._start(run_id, f'node.{name}')
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        name = kwargs.get('name') or (serialized or {}).get('name', 'unknown')
+        self._start(run_id, f'tool.{name}')
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def _llm_start(self, run_id, metadata):
+        metadata = metadata or {}
+        node = metadata.get('langgraph_node')
+        site = metadata.get('llm_site') or SITE_BY_NODE.get(node, node or 'unknown')
+        self._start(run_id, f'llm.{site}', site=site)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._llm_start(run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._llm_start(run_id, metadata)
+
+    @staticmethod
+    def _usage(response):
+        # usage_metadata есть у сообщений chat-моделей (в том числе при стриминге со stream_usage),
+        # token_usage в llm_output - запасной вариант для старых интеграций
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    return {'prompt': usage.get('input_tokens', 0), 'completion': usage.get('output_tokens', 0)}
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        if usage:
+            return {'prompt': usage.get('prompt_tokens', 0), 'completion': usage.get('completion_tokens', 0)}
+        return None
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id, usage=self._usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        if isinstance(error, asyncio.CancelledError):
+            self.cancel(run_id)
+            return
+        self._end(run_id, error=True)
+
+
+metrics_handler = MetricsCallbackHandler()
+
+
+def callbacks():
+    '''
+    Обработчики для config графа: пустой список, если метрики выключены.
+    '''
+
+    return [metrics_handler] if config.metrics.enabled else []
+
+
+_caches = {}
+
+
+def register_cache(name: str, stats):
+    '''
+    Регистрирует кэш, чьи счетчики (метод stats()) отдаются на /metrics.
+    Счетчики читаются в момент опроса, на горячем пути ничего не меняется.
+    '''
+
+    _caches[name] = stats
+
+
+class _CacheCollector:
+    def collect(self):
+        lookups = CounterMetricFamily('rag_cache_lookups', 'Cache lookups by cache and result.',
+                                      labels=['cache', 'result'])
+        entries = GaugeMetricFamily('rag_cache_entries', 'Entries currently held in memory by cache.',
+                                    labels=['cache'])
+        for name, stats in list(_caches.items()):
+            for key, value in stats().items():
+                if key.endswith('entries'):
+                    entries.add_metric([name], value)
+                else:
+                    lookups.add_metric([name, key], value)
+        yield lookups
+        yield entries
+
+
+REGISTRY.register(_CacheCollector())
+
+
+_llm_latency = {}
+
+
+def register_llm_latency(site: str, stats):
+    '''
+    Регистрирует квантили длительностей недавних вызовов LLM места site (метод stats()):
+    по ним считается задержка hedging, на /metrics они отдаются как есть.
+    '''
+
+    _llm_latency[site] = stats
+
+
+class _LLMLatencyCollector:
+    def collect(self):
+        latency = GaugeMetricFamily('rag_llm_recent_latency_seconds',
+                                    'Quantiles of recent successful LLM call latency by call site.',
+                                    labels=['site', 'quantile'])
+        for site, stats in list(_llm_latency.items()):
+            for quantile, value in stats().items():
+                latency.add_metric([site, str(quantile)], value)
+        yield latency
+
+
+REGISTRY.register(_LLMLatencyCollector())
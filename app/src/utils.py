@@ -1,137 +1,204 @@
-import warnings
-
-import yaml
-from box import Box
-
-
-# Загрузчик конфига из yaml файла в объект
-def get_config():
-    try:
-      with open('app/src/config.yaml', 'r') as f:
-          config_dict = yaml.safe_load(f)
-      return Box(config_dict)
-    except Exception as e:
-        warnings.warn(
-            message=f'Oops, error occured! {e}',
-            stacklevel=3
-        )
-
-config = get_config()
-
-
-def load_prompt(path):
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
-
-
-# Больше не используется в связи с переходом на ChromaDB, у которой другая скор-система
-def normalize_similarity_score(scored_docs, lo, hi):
-    '''
-    Нормализует скоры семантического поиска на интервал [0, 1].
-    Это сильно удобнее, чем компактный интервал [0.7, 1], в котором по умолчанию лежат скоры для E5
-
-    Args:
-      scored_docs: список пар документ-скор.
-      lo: минимум скора для модели эмбеддингов.
-      hi: максимум скора для модели эмбеддингов.
-
-    Returns:
-      Список документов с нормализованными скорами.
-    '''
-
-    result = [
-        (doc, (score - lo) / (hi - lo))
-        for doc, score in scored_docs
-    ]
-    return result
-
-
-def soft_merge(lhs_docs, rhs_docs):
-    '''
-    "Мягко" объединяет два спика документов:
-    Удаляет все документы, у которых скор хуже среднего, соединяет списки вместе и
-    сортирует.
-    Если какие-то документы окажутся настолько релевантными, что перетянут в свою сторону средний скор,
-    то функция может вернуть меньше, чем K документов. Это поведение ожидаемо - идея в том,
-    что вылетевшие документы в таком случае не будут мешать модели работать с самыми релевантыми.
-
-    Args:
-      lhs_docs: первый список документов.
-      rhs_docs: второй список документов.
-
-    Returns:
-      K лучших документов, где K - длина наибольшего списка.
-    '''
-
-    res_len = max(len(lhs_docs), len(rhs_docs))
-
-
-    # lhs_docs = normalize_similarity_score(
-    #     lhs_docs, config.embeddings.score_lo, config.embeddings.score_hi)
-    # rhs_docs = normalize_similarity_score(
-    #     rhs_docs, config.embeddings.score_lo, config.embeddings.score_hi)
-
-
-    lhs_mean = sum([score for _, score in lhs_docs]) / len(lhs_docs) if lhs_docs else 0
-    rhs_mean = sum([score for _, score in rhs_docs]) / len(rhs_docs) if rhs_docs else 0
-    lhs_docs = [(doc, score) for doc, score in lhs_docs if score <= lhs_mean]
-    rhs_docs = [(doc, score) for doc, score in rhs_docs if score <= rhs_mean]
-
-    docs = sorted(lhs_docs+rhs_docs, key=lambda x: x[1], reverse=False) # Меньше скор - лучше
-    unique_docs = {doc.page_content: (doc, score) for doc, score in docs}.values()
-    unique_docs = list(unique_docs)
-
-    return unique_docs[:res_len]
-
-def rerank_by_tags(
-    docs, target_tags, boost=config.rerank.boost,
-    filter_irrelevant=False, threshold=config.rerank.threshold
-):
-    '''
-    Принимает на вход список документов, сравнивает их теги с целевыми
-    и подтягивает скор докуметов в зависимости от количества совпадений.
-    При filter_irrelevant = True отсекает явный мусор.
-
-    Args:
-      docs: список документов.
-      target_tags: искомые теги.
-      boost: увеличение сходства за каждое совпадение.
-      filter_irrelevant: флаг фильтрации документов.
-      threshold: порог фильтрации.
-
-    Returns:
-      отсортированный по скорам массив документов.
-
-    Raises:
-      ConnectionError: If no available port is found.
-    '''
-
-    reranked = []
-
-    if not target_tags:
-        reranked = docs.sort(key=lambda x: x[1], reverse=False)
-    else:
-        try:
-            target = {t.lower() for t in target_tags if isinstance(t, str)}
-        except:
-            target = set([])
-        for doc, score in docs:
-            doc_tags = doc.metadata.get('tags', '')
-            doc_tags_lo = doc_tags.lower()
-            tags = set(doc_tags_lo.split())
-
-            matches = len(target & tags)
-            adjusted_score = max(0.0, score - boost * matches)
-            reranked.append((doc, adjusted_score))
-
-    #reranked_normalized = normalize_similarity_score(
-    #    reranked, config.embeddings.score_lo, config.embeddings.score_hi)
-    reranked = reranked.sort(key=lambda x: x[1], reverse=False)
-
-    if filter_irrelevant:
-        reranked = [
-            (doc, score)
-            for doc, score in reranked if score < threshold
-            ]
-
-    return reranked
\ No newline at end of file
+import os
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import yaml
+from box import Box
+
+from app.constants import TAG_METADATA_KEYS
+
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent', 'prompts')
+
+
+# Загрузчик конфига из yaml файла в объект.
+# Конфиг читается один раз за процесс, все модули получают один и тот же объект
+@lru_cache(maxsize=None)
+def get_config():
+    try:
+      with open(CONFIG_PATH, 'r') as f:
+          config_dict = yaml.safe_load(f)
+      return Box(config_dict)
+    except Exception as e:
+        warnings.warn(
+            message=f'Oops, error occured! {e}',
+            stacklevel=3
+        )
+
+config = get_config()
+
+
+# Промпты не меняются во время работы, поэтому читаем каждый файл с диска один раз
+@lru_cache(maxsize=None)
+def load_prompt(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def preload_prompts():
+    '''
+    Загружает в кэш load_prompt все шаблоны из папки с промптами.
+    '''
+
+    for name in sorted(os.listdir(PROMPTS_DIR)):
+        if name.endswith('.txt'):
+            load_prompt(os.path.join(PROMPTS_DIR, name))
+
+
+# Больше не используется в связи с переходом на ChromaDB, у которой другая скор-система
+def normalize_similarity_score(scored_docs, lo, hi):
+    '''
+    Нормализует скоры семантического поиска на интервал [0, 1].
+    Это сильно удобнее, чем компактный интервал [0.7, 1], в котором по умолчанию лежат скоры для E5
+
+    Args:
+      scored_docs: список пар документ-скор.
+      lo: минимум скора для модели эмбеддингов.
+      hi: максимум скора для модели эмбеддингов.
+
+    Returns:
+      Список документов с нормализованными скорами.
+    '''
+
+    result = [
+        (doc, (score - lo) / (hi - lo))
+        for doc, score in scored_docs
+    ]
+    return result
+
+
+def soft_merge(lhs_docs, rhs_docs):
+    '''
+    "Мягко" объединяет два спика документов:
+    Удаляет все документы, у которых скор хуже среднего, соединяет списки вместе и
+    сортирует.
+    Если какие-то документы окажутся настолько релевантными, что перетянут в свою сторону средний скор,
+    то функция может вернуть меньше, чем K документов. Это поведение ожидаемо - идея в том,
+    что вылетевшие документы в таком случае не будут мешать модели работать с самыми релевантыми.
+
+    Args:
+      lhs_docs: первый список документов.
+      rhs_docs: второй список документов.
+
+    Returns:
+      K лучших документов, где K - длина наибольшего списка.
+    '''
+
+    res_len = max(len(lhs_docs), len(rhs_docs))
+
+
+    # lhs_docs = normalize_similarity_score(
+    #     lhs_docs, config.embeddings.score_lo, config.embeddings.score_hi)
+    # rhs_docs = normalize_similarity_score(
+    #     rhs_docs, config.embeddings.score_lo, config.embeddings.score_hi)
+
+
+    lhs_mean = sum([score for _, score in lhs_docs]) / len(lhs_docs) if lhs_docs else 0
+    rhs_mean = sum([score for _, score in rhs_docs]) / len(rhs_docs) if rhs_docs else 0
+    lhs_docs = [(doc, score) for doc, score in lhs_docs if score <= lhs_mean]
+    rhs_docs = [(doc, score) for doc, score in rhs_docs if score <= rhs_mean]
+
+    docs = sorted(lhs_docs+rhs_docs, key=lambda x: x[1], reverse=False) # Меньше скор - лучше
+    unique_docs = {doc.page_content: (doc, score) for doc, score in docs}.values()
+    unique_docs = list(unique_docs)
+
+    return unique_docs[:res_len]
+
+def rrf_merge(ranked_lists, k, rrf_k=60):
+    '''
+    Объединяет несколько ранжированных списков (плотный поиск, BM25 и т.д.)
+    методом Reciprocal Rank Fusion: документ получает сумму 1 / (rrf_k + ранг)
+    по всем спискам, где он встретился. Сами скоры списков не используются,
+    поэтому расстояния Chroma и скоры BM25 можно смешивать без нормализации.
+
+    Args:
+      ranked_lists: списки пар документ-скор, каждый отсортирован от лучшего к худшему.
+      k: сколько документов вернуть.
+      rrf_k: сглаживающая константа RRF.
+
+    Returns:
+      K лучших документов. Скор приведен к виду "меньше - лучше" на [0, 1),
+      как у расстояний Chroma, чтобы дальше работал rerank_by_tags.
+    '''
+
+    fused = {}
+    for docs in ranked_lists:
+        for rank, (doc, _) in enumerate(docs, start=1):
+            entry = fused.setdefault(doc.page_content, [doc, 0.0])
+            entry[1] += 1 / (rrf_k + rank)
+
+    best_possible = len(ranked_lists) / (rrf_k + 1)
+    merged = sorted(fused.values(), key=lambda x: x[1], reverse=True)[:k]
+    return [(doc, 1 - score / best_possible) for doc, score in merged]
+
+def tag_metadata(tags):
+    '''
+    Булевы поля метаданных для тегов документа: по одному полю на каждый
+    известный тег (см. TAG_METADATA_KEYS), True - если тег у документа есть.
+    '''
+
+    return {key: tag in tags for tag, key in TAG_METADATA_KEYS.items()}
+
+
+def tag_filter(tags):
+    '''
+    Условие where для Chroma: документ помечен хотя бы одним из тегов.
+    Если известных тегов нет - None.
+    '''
+
+    conditions = [{TAG_METADATA_KEYS[tag]: True} for tag in tags if tag in TAG_METADATA_KEYS]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$or': conditions}
+
+
+def _tag_matches(metadata: dict, tag: str, key: str):
+    # Индекс, собранный блокнотом до появления булевых полей тегов, хранит теги
+    # только строкой metadata['tags'] - для него совпадения считаются по ней
+    if key in metadata:
+        return bool(metadata[key])
+    return tag in metadata.get('tags', '')
+
+
+def rerank_by_tags(
+    docs, target_tags, boost=config.rerank.boost,
+    filter_irrelevant=False, threshold=config.rerank.threshold
+):
+    '''
+    Принимает на вход список документов, сравнивает их теги с целевыми
+    и подтягивает скор докуметов в зависимости от количества совпадений.
+    Совпадения считаются по булевым полям тегов в метаданных (см. tag_metadata),
+    а у чанков без них (индекс до переиндексации app/ingest.py) - по строке metadata['tags'];
+    поправка скоров и сортировка - одной векторной операцией.
+    При filter_irrelevant = True отсекает явный мусор.
+
+    Args:
+      docs: список документов.
+      target_tags: искомые теги.
+      boost: увеличение сходства за каждое совпадение.
+      filter_irrelevant: флаг фильтрации документов.
+      threshold: порог фильтрации.
+
+    Returns:
+      отсортированный по скорам массив документов.
+    '''
+
+    if not docs:
+        return []
+
+    scores = np.fromiter((score for _, score in docs), dtype=np.float64, count=len(docs))
+    keys = [(tag, TAG_METADATA_KEYS[tag]) for tag in target_tags or () if tag in TAG_METADATA_KEYS]
+    if keys:
+        matches = np.array([
+            [_tag_matches(doc.metadata or {}, tag, key) for tag, key in keys]
+            for doc, _ in docs
+        ]).sum(axis=1)
+        scores = np.maximum(scores - boost * matches, 0.0)
+
+    order = np.argsort(scores, kind='stable') # Меньше скор - лучше
+    if filter_irrelevant:
+        order = order[scores[order] < threshold]
+
+    return [(docs[i][0], float(scores[i])) for i in order]
\ No newline at end of file
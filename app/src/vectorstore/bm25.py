@@ -0,0 +1,216 @@
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import Counter
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.src.utils import get_config
+
+
+config = get_config()
+
+# Имейлы и адреса сайтов оставляем одним токеном - по ним как раз ищут точные факты
+_TOKEN_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+|\w+')
+
+
+def tokenize(text: str):
+    text = text.lower()
+    if text.startswith('passage: ') or text.startswith('query: '):
+        text = text.split(': ', 1)[1]
+    return _TOKEN_RE.findall(text)
+
+
+class BM25Index:
+    '''
+    Инвертированный индекс BM25 по тем же чанкам, что лежат в Chroma.
+    Постинги хранятся плоскими массивами numpy (документы и частоты терма,
+    смещения по термам), скоринг запроса - несколько векторных операций на терм.
+    '''
+
+    def __init__(self, ids, contents, metadatas, terms, offsets, post_docs, post_tf, doc_len,
+                 k1: float, b: float):
+        self.ids = ids
+        self.contents = contents
+        self.metadatas = metadatas
+        self.vocab = {term: i for i, term in enumerate(terms)}
+        self.terms = terms
+        self.offsets = offsets
+        self.post_docs = post_docs
+        self.post_tf = post_tf
+        self.doc_len = doc_len
+        self.avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def build(cls, ids, docs, k1: float, b: float):
+        counts = [Counter(tokenize(doc.page_content)) for doc in docs]
+        terms = sorted({term for c in counts for term in c})
+        vocab = {term: i for i, term in enumerate(terms)}
+
+        postings = [[] for _ in terms]
+        for doc_idx, c in enumerate(counts):
+            for term, tf in c.items():
+                postings[vocab[term]].append((doc_idx, tf))
+
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in postings])
+        flat = [item for p in postings for item in p]
+        post_docs = np.array([d for d, _ in flat], dtype=np.int32)
+        post_tf = np.array([tf for _, tf in flat], dtype=np.float32)
+        doc_len = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+
+        return cls(
+            list(ids), [doc.page_content for doc in docs], [doc.metadata for doc in docs],
+            terms, offsets, post_docs, post_tf, doc_len, k1, b
+        )
+
+    def save(self, path: str):
+        '''
+        Записывает индекс новой версией в path/versions/<имя> и делает ее текущей,
+        подменяя файл CURRENT одним os.replace (как MmapVectorStore): читатель
+        не соединит документы одной версии с постингами другой.
+        '''
+
+        previous = current_version(path)
+        version = uuid.uuid4().hex
+        directory = _directory(path, version)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'documents.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'ids': self.ids, 'contents': self.contents,
+                'metadatas': self.metadatas, 'terms': self.terms
+            }, f, ensure_ascii=False)
+        np.savez(
+            os.path.join(directory, 'postings.npz'),
+            offsets=self.offsets, post_docs=self.post_docs,
+            post_tf=self.post_tf, doc_len=self.doc_len
+        )
+
+        tmp_current = os.path.join(path, 'CURRENT.tmp')
+        with open(tmp_current, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(tmp_current, os.path.join(path, 'CURRENT'))
+        _prune(path, keep={version, previous})
+
+    @classmethod
+    def load(cls, path: str, k1: float, b: float, version: str = None):
+        directory = _directory(path, version)
+        with np.load(os.path.join(directory, 'postings.npz')) as arrays:
+            offsets, post_docs = arrays['offsets'], arrays['post_docs']
+            post_tf, doc_len = arrays['post_tf'], arrays['doc_len']
+        with open(os.path.join(directory, 'documents.json'), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(
+            data['ids'], data['contents'], data['metadatas'], data['terms'],
+            offsets, post_docs, post_tf, doc_len, k1, b
+        )
+
+    def scores(self, query: str):
+        n = len(self.ids)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            docs = self.post_docs[self.offsets[t]:self.offsets[t + 1]]
+            tf = self.post_tf[self.offsets[t]:self.offsets[t + 1]]
+            idf = np.log1p((n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avg_len)
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, k: int):
+        '''
+        Returns:
+          до k пар документ-скор BM25 (больше - лучше), документы с нулевым скором не возвращаются.
+        '''
+
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(id=self.ids[i], page_content=self.contents[i], metadata=self.metadatas[i]), float(scores[i]))
+            for i in top if scores[i] > 0
+        ]
+
+
+def current_version(path: str):
+    # None - индекса еще нет или он записан в прежнем формате, файлами прямо в path
+    try:
+        with open(os.path.join(path, 'CURRENT'), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _directory(path: str, version):
+    return path if version is None else os.path.join(path, 'versions', version)
+
+
+def _prune(path: str, keep):
+    # Предыдущую версию оставляем: ее могут дочитывать процессы, начавшие загрузку до переключения
+    versions_path = os.path.join(path, 'versions')
+    for name in os.listdir(versions_path):
+        if name not in keep:
+            shutil.rmtree(os.path.join(versions_path, name), ignore_errors=True)
+    if None not in keep:
+        return
+    for name in ('postings.npz', 'documents.json'):
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+
+
+def _load_current(path: str):
+    # Версию могут удалить между чтением CURRENT и открытием файлов,
+    # если за это время индекс переписали дважды - тогда берем новую
+    for attempt in range(3):
+        version = current_version(path)
+        try:
+            return version, BM25Index.load(path, k1=config.bm25.k1, b=config.bm25.b, version=version)
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
+
+
+_lock = threading.Lock()
+_index = None
+_index_version = None
+
+
+def get_bm25_index():
+    '''
+    Индекс BM25, сохраненный при последней индексации (app/ingest.py).
+    Перечитывается с диска, если индексация переключила версию. Если индекса нет - None.
+    '''
+
+    global _index, _index_version
+    path = config.bm25.path
+    version = current_version(path)
+    if version is None and not os.path.exists(os.path.join(path, 'postings.npz')):
+        # Индекс в прежнем формате могли удалить сразу после переключения на новую версию
+        version = current_version(path)
+        if version is None:
+            return None
+
+    if _index is None or version != _index_version:
+        with _lock:
+            if _index is None or version != _index_version:
+                _index_version, _index = _load_current(path)
+    return _index
+
+
+def build_bm25_index(ids, docs):
+    index = BM25Index.build(ids, docs, k1=config.bm25.k1, b=config.bm25.b)
+    index.save(config.bm25.path)
+    return index
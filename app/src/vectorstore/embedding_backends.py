@@ -0,0 +1,248 @@
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.src.utils import get_config
+from app.src.metrics import embedding_batch
+
+
+config = get_config()
+
+
+class PrefixedEmbeddings(Embeddings, ABC):
+    '''
+    Общая часть бэкендов эмбеддингов: префиксы E5 и батчи.
+    Запросы получают query_prefix, документы - passage_prefix. Префикс добавляется
+    только если текст еще не начинается ни с одного из них, так что старые
+    чанки с "passage: " в тексте и явно переданные префиксы не удваиваются.
+    cache_namespace описывает, чем получены вектора (бэкенд, модель, точность,
+    префиксы), - по нему CachedEmbeddings не путает вектора разных бэкендов.
+    '''
+
+    def __init__(self, query_prefix: str, passage_prefix: str, batch_size: int, normalize: bool):
+        self.query_prefix = query_prefix
+        self.passage_prefix = passage_prefix
+        self.batch_size = batch_size
+        self.normalize = normalize
+
+    def _namespace(self, *parts):
+        return '|'.join(str(part) for part in (*parts, self.query_prefix, self.passage_prefix, self.normalize))
+
+    def _prefixed(self, texts, prefix: str):
+        known = tuple(p for p in (self.query_prefix, self.passage_prefix) if p)
+        return [text if known and text.startswith(known) else f'{prefix}{text}' for text in texts]
+
+    @abstractmethod
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        '''
+        Прогон модели по уже префиксованным текстам.
+
+        Returns:
+          матрица эмбеддингов, по строке на текст.
+        '''
+
+    def _run(self, texts: list[str], kind: str):
+        # Каждый прогон модели попадает в rag_embedding_batch_seconds/_size
+        with embedding_batch(kind, len(texts)):
+            return self._encode(texts)
+
+    def embed_query(self, text: str):
+        return self._run(self._prefixed([text], self.query_prefix), 'query')[0].tolist()
+
+    def embed_queries(self, texts: list[str]):
+        return self._run(self._prefixed(texts, self.query_prefix), 'query').tolist()
+
+    def embed_documents(self, texts: list[str]):
+        return self._run(self._prefixed(texts, self.passage_prefix), 'passage').tolist()
+
+
+class SentenceTransformerEmbeddings(PrefixedEmbeddings):
+    '''
+    Прежний путь: модель sentence-transformers (PyTorch, fp32) на CPU.
+    '''
+
+    def __init__(self, model_name: str, threads: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.cache_namespace = self._namespace('sentence-transformers', model_name, 'fp32')
+
+    def _encode(self, texts: list[str]):
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=self.normalize,
+            convert_to_numpy=True
+        )
+
+
+class OnnxEmbeddings(PrefixedEmbeddings):
+    '''
+    Та же модель, экспортированная в ONNX и выполняемая ONNX Runtime,
+    опционально с динамической int8-квантизацией весов.
+    Экспорт и квантизация выполняются один раз, результат лежит в model_dir.
+    '''
+
+    def __init__(self, model_name: str, model_dir: str, quantize: bool = False,
+                 threads: int = 0, max_length: int = 512, **kwargs):
+        super().__init__(**kwargs)
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        # Под каждую модель своя папка, чтобы бенчмарк с другой моделью не затирал основную
+        model_dir = os.path.join(model_dir, model_name.replace('/', '--'))
+        model_path = self.prepare(model_name, model_dir, quantize)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = max_length
+        self.cache_namespace = self._namespace('onnx', model_name, 'int8' if quantize else 'fp32', max_length)
+
+    @staticmethod
+    def prepare(model_name: str, model_dir: str, quantize: bool):
+        '''
+        Экспортирует модель в ONNX (и квантизует), если этого еще не сделано.
+
+        Returns:
+          путь к .onnx файлу, который нужно загружать.
+        '''
+
+        model_path = os.path.join(model_dir, 'model.onnx')
+        if not os.path.exists(model_path):
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(model_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+        if not quantize:
+            return model_path
+
+        quantized_path = os.path.join(model_dir, 'model_quantized.onnx')
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            # Веса e5-large не влезают в один protobuf (2 ГБ) и лежат рядом во внешнем файле
+            quantize_dynamic(
+                model_path, quantized_path,
+                weight_type=QuantType.QInt8,
+                use_external_data_format=os.path.exists(f'{model_path}_data')
+            )
+        return quantized_path
+
+    def _encode_batch(self, texts: list[str]):
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=True,
+            max_length=self.max_length, return_tensors='np'
+        )
+        feeds = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        hidden = self.session.run(None, feeds)[0]
+
+        # Mean pooling по токенам без паддинга - как в sentence-transformers для E5
+        mask = encoded['attention_mask'][..., np.newaxis].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def _encode(self, texts: list[str]):
+        # Сортируем по длине, чтобы в батче было меньше паддинга, затем возвращаем исходный порядок
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        vectors = np.empty((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = [texts[i] for i in order[start:start + self.batch_size]]
+            pooled = self._encode_batch(batch)
+            if vectors.shape[1] == 0:
+                vectors = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[order[start:start + self.batch_size]] = pooled
+        return vectors
+
+
+class HashingEmbeddings(PrefixedEmbeddings):
+    '''
+    Детерминированные эмбеддинги без модели: хэши слов и символьных
+    триграмм раскладываются по dimensions координатам (feature hashing).
+    Качество несравнимо с E5, зато не нужны веса и CPU - для бенчмарков
+    самого конвейера (app/benchmarks) и быстрых проверок.
+    '''
+
+    _WORD_RE = re.compile(r'\w+')
+
+    def __init__(self, model_name: str = 'hashing', threads: int = 0, dimensions: int = 256, **kwargs):
+        super().__init__(**kwargs)
+        self.dimensions = dimensions
+        self.cache_namespace = self._namespace('hashing', dimensions)
+
+    def _features(self, text: str):
+        for prefix in (self.query_prefix, self.passage_prefix):
+            if prefix and text.startswith(prefix):
+                text = text[len(prefix):]
+                break
+        words = self._WORD_RE.findall(text.lower())
+        grams = [f'#{word[i:i + 3]}' for word in words for i in range(max(len(word) - 2, 1))]
+        return words + grams
+
+    def _encode(self, texts: list[str]):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode('utf-8')) for feature in self._features(text)),
+                dtype=np.int64
+            )
+            signs = np.where(hashes & 1, 1.0, -1.0)
+            np.add.at(vectors[row], (hashes >> 1) % self.dimensions, signs)
+        if self.normalize:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
+
+
+BACKENDS = {
+    'sentence-transformers': SentenceTransformerEmbeddings,
+    'onnx': OnnxEmbeddings,
+    'hashing': HashingEmbeddings,
+}
+
+
+def create_backend(backend: str = None, model_name: str = None, **overrides):
+    '''
+    Создает бэкенд эмбеддингов по настройкам из config.embeddings.
+
+    Args:
+      backend: sentence-transformers, onnx или hashing, по умолчанию embeddings.backend.
+      model_name: модель, по умолчанию embeddings.model_name.
+      overrides: переопределения остальных настроек (threads, batch_size, quantize и т.д.).
+
+    Returns:
+      объект Embeddings.
+    '''
+
+    backend = backend or config.embeddings.backend
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown embeddings backend: {backend}. Available: {", ".join(BACKENDS)}')
+
+    settings = {
+        'model_name': model_name or config.embeddings.model_name,
+        'query_prefix': config.embeddings.query_prefix,
+        'passage_prefix': config.embeddings.passage_prefix,
+        'batch_size': config.embeddings.batch_size,
+        'normalize': config.embeddings.normalize,
+        'threads': config.embeddings.threads,
+    }
+    if backend == 'onnx':
+        settings['model_dir'] = config.embeddings.onnx.model_dir
+        settings['quantize'] = config.embeddings.onnx.quantize
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return BACKENDS[backend](**settings)
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from langchain_core.embeddings import Embeddings
+
+from app.src.metrics import EMBEDDING_BATCH_REQUESTS, observe_embedding_queue
+
+
+logger = logging.getLogger(__name__)
+
+class _Request:
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+
+class BatchingEmbeddings(Embeddings):
+    '''
+    Микробатчинг эмбеддингов запросов между одновременными вызовами.
+    Запросы из разных потоков складываются в очередь, фоновый поток ждет
+    до max_wait секунд (или пока не наберется max_batch_size текстов),
+    делает один прогон модели на всех и раздает каждому его вектора.
+    На CPU один батч из N запросов заметно дешевле N отдельных прогонов.
+    Эмбеддинги документов (индексация) и так идут батчами и проходят напрямую.
+    Вызывающий ждет свой батч не дольше timeout секунд, упавший фоновый поток
+    перезапускается при следующем запросе.
+    '''
+
+    def __init__(self, embeddings: Embeddings, max_batch_size: int, max_wait: float, timeout: float):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self._pending = deque()
+        self._pending_texts = 0
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            if self._worker is not None:
+                logger.error('Embedding batcher thread died, restarting it')
+            self._worker = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+            self._worker.start()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            # Окно отсчитывается от первого запроса в очереди: пока шел прошлый батч,
+            # запросы уже накопились, и ждать за них еще раз не нужно
+            deadline = self._pending[0].enqueued + self.max_wait
+            while self._pending_texts < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            # Запрос целиком попадает в один батч; слишком большой запрос идет отдельным батчем
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0].texts) <= self.max_batch_size):
+                request = self._pending.popleft()
+                batch.append(request)
+                size += len(request.texts)
+            self._pending_texts -= size
+            return batch
+
+    def _process(self, batch):
+        started = time.perf_counter()
+        vectors = self.embeddings.embed_queries([text for request in batch for text in request.texts])
+        finished = time.perf_counter()
+
+        EMBEDDING_BATCH_REQUESTS.observe(len(batch))
+        offset = 0
+        for request in batch:
+            request.started, request.finished = started, finished
+            request.future.set_result(vectors[offset:offset + len(request.texts)])
+            offset += len(request.texts)
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch = self._next_batch()
+                self._process(batch)
+            except Exception as e:
+                # Любая ошибка батча достается его запросам, а поток продолжает обслуживать очередь
+                logger.exception('Embedding batch of %d requests failed', len(batch))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _withdraw(self, request: _Request):
+        # Запрос, который так и не попал в батч, убираем из очереди, чтобы модель не считала его впустую
+        with self._cond:
+            try:
+                self._pending.remove(request)
+            except ValueError:
+                return
+            self._pending_texts -= len(request.texts)
+
+    def embed_queries(self, texts: list[str]):
+        if not texts:
+            return []
+        request = _Request(list(texts))
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._pending_texts += len(request.texts)
+            self._cond.notify()
+
+        try:
+            vectors = request.future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._withdraw(request)
+            raise TimeoutError(f'Query embedding did not finish in {self.timeout}s') from None
+        # Метрики пишутся в потоке вызывающего, чтобы попасть в Server-Timing его запроса
+        observe_embedding_queue(request.started - request.enqueued, request.finished - request.started)
+        return vectors
+
+    def embed_query(self, text: str):
+        return self.embed_queries([text])[0]
+
+    def embed_documents(self, texts: list[str]):
+        return self.embeddings.embed_documents(texts)
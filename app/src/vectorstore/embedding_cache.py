@@ -0,0 +1,143 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text: str):
+    '''
+    Приводит текст запроса к каноничному виду: NFC и схлопнутые пробелы.
+    Именно нормализованный текст и уходит в модель, так что кэш не меняет результат.
+    '''
+
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Двухуровневый кэш эмбеддингов запросов поверх любой модели эмбеддингов.
+    Первый уровень - LRU в памяти с ограничением по числу векторов,
+    второй - SQLite на диске, вектора хранятся во float16.
+    Ключ - хэш от namespace (бэкенд, модель, точность - см. PrefixedEmbeddings.cache_namespace)
+    и нормализованного текста: после смены бэкенда или квантизации старые вектора не отдаются.
+    Эмбеддинги документов (индексация) не кэшируются.
+    '''
+
+    def __init__(self, embeddings: Embeddings, namespace: str,
+                 memory_size: int, path: str, disk_size: int):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)')
+        self._db.commit()
+        self._inserts = 0
+
+    def _key(self, text: str):
+        return hashlib.sha1(f'{self.namespace}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get(self, key: str):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return vector
+
+            row = self._db.execute('SELECT vector FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            vector = np.frombuffer(row[0], dtype=np.float16)
+            self._db.execute('UPDATE embeddings SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+            self._remember(key, vector)
+            self.hits_disk += 1
+            return vector
+
+    def _put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._remember(key, vector)
+            self._db.execute(
+                'INSERT OR REPLACE INTO embeddings (key, vector, accessed_at) VALUES (?, ?, ?)',
+                (key, vector.tobytes(), time.time())
+            )
+            self._inserts += 1
+            # Дисковый уровень тоже ограничен: время от времени выкидываем давно не используемые вектора
+            if self._inserts % 256 == 0:
+                self._db.execute(
+                    'DELETE FROM embeddings WHERE key IN ('
+                    'SELECT key FROM embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                    (self.disk_size,)
+                )
+            self._db.commit()
+
+    def embed_query(self, text: str):
+        text = normalize_text(text)
+        key = self._key(text)
+
+        vector = self._get(key)
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float16)
+            self._put(key, vector)
+        return vector.astype(np.float32).tolist()
+
+    def embed_queries(self, texts: list[str]):
+        '''
+        Эмбеддинги нескольких запросов сразу: найденные в кэше берутся из кэша,
+        остальные считаются одним батчем за один прогон модели.
+        '''
+
+        texts = [normalize_text(text) for text in texts]
+        keys = [self._key(text) for text in texts]
+        vectors = [self._get(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embeddings.embed_queries([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = np.asarray(vector, dtype=np.float16)
+                self._put(keys[i], vectors[i])
+        return [vector.astype(np.float32).tolist() for vector in vectors]
+
+    def embed_documents(self, texts: list[str]):
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        '''
+        Счетчики попаданий и промахов кэша.
+        '''
+
+        with self._lock:
+            return {
+                'hits_memory': self.hits_memory,
+                'hits_disk': self.hits_disk,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+            }
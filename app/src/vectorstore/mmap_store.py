@@ -0,0 +1,299 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+
+class _Snapshot:
+    # Неизменяемый срез индекса: запросы работают со своим срезом, пока запись готовит новый
+    def __init__(self, matrix, ids, contents, metadatas):
+        self.matrix = matrix
+        self.ids = ids
+        self.contents = contents
+        self.metadatas = metadatas
+        self.positions = {doc_id: i for i, doc_id in enumerate(ids)}
+        self._columns = {}
+
+    def column(self, key: str, value):
+        # Маска "metadata[key] == value" по всем документам, считается один раз на срез
+        if (key, value) not in self._columns:
+            self._columns[key, value] = np.fromiter(
+                ((metadata or {}).get(key) == value for metadata in self.metadatas),
+                dtype=bool, count=len(self.metadatas)
+            )
+        return self._columns[key, value]
+
+
+class MmapVectorStore(VectorStore):
+    '''
+    Векторный индекс в памяти процесса для небольших коллекций (тысячи чанков).
+    Нормализованные эмбеддинги лежат в .npy матрице (float16 или float32),
+    которая открывается через mmap - несколько воркеров делят одни и те же
+    страницы через page cache ОС. Тексты и метаданные - в documents.json рядом.
+    Каждая запись индекса - новая версия в versions/<имя>, а файл CURRENT
+    указывает на действующую: переключение одним os.replace, так что читатель
+    никогда не соединит документы одной версии с матрицей другой.
+
+    Поиск точный: одно матричное произведение и argpartition. Скор - квадрат
+    L2-расстояния между нормализованными векторами (2 - 2cos), как у Chroma
+    по умолчанию, так что меньше - лучше и пороги не меняются.
+    Фильтр where поддерживает равенство по полю метаданных, $or и $and
+    (этого хватает для фильтра по тегам, см. tag_filter).
+    '''
+
+    # Сколько строк матрицы приводить к float32 за раз при поиске по float16
+    BLOCK_SIZE = 8192
+
+    def __init__(self, embedding_function: Embeddings, path: str, dtype: str = 'float16'):
+        self.embedding_function = embedding_function
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    @property
+    def _current_path(self):
+        return os.path.join(self.path, 'CURRENT')
+
+    @property
+    def _versions_path(self):
+        return os.path.join(self.path, 'versions')
+
+    def _current_version(self):
+        # None - индекса еще нет или он записан в прежнем формате, файлами прямо в path
+        try:
+            with open(self._current_path, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _directory(self, version):
+        return self.path if version is None else os.path.join(self._versions_path, version)
+
+    def _read(self, version):
+        directory = self._directory(version)
+        matrix_path = os.path.join(directory, 'embeddings.npy')
+        if version is None and not os.path.exists(matrix_path):
+            return _Snapshot(np.empty((0, 0), dtype=self.dtype), [], [], [])
+        matrix = np.load(matrix_path, mmap_mode='r')
+        with open(os.path.join(directory, 'documents.json'), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return _Snapshot(matrix, data['ids'], data['contents'], data['metadatas'])
+
+    def _read_current(self):
+        # Версию могут удалить между чтением CURRENT и открытием файлов,
+        # если за это время индекс переписали дважды - тогда берем новую
+        for attempt in range(3):
+            version = self._current_version()
+            try:
+                return version, self._read(version)
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def _load(self):
+        # Перечитываем индекс, только если другой процесс (индексация) переключил версию
+        version = self._current_version()
+        snapshot = self._snapshot
+        if snapshot is None or version != self._version:
+            with self._lock:
+                if self._snapshot is None or version != self._version:
+                    self._version, self._snapshot = self._read_current()
+                snapshot = self._snapshot
+        return snapshot
+
+    def _save(self, matrix, ids, contents, metadatas):
+        # Новая версия пишется в свою папку целиком и только потом становится текущей
+        previous = self._current_version()
+        version = uuid.uuid4().hex
+        directory = self._directory(version)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'documents.json'), 'w', encoding='utf-8') as f:
+            json.dump({'ids': ids, 'contents': contents, 'metadatas': metadatas}, f, ensure_ascii=False)
+        np.save(os.path.join(directory, 'embeddings.npy'), np.ascontiguousarray(matrix, dtype=self.dtype))
+
+        tmp_current = f'{self._current_path}.tmp'
+        with open(tmp_current, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(tmp_current, self._current_path)
+        self._prune(keep={version, previous})
+
+    def _prune(self, keep):
+        # Предыдущую версию оставляем: ее могут дочитывать запросы, начавшиеся до переключения.
+        # Открытые через mmap файлы более старых версий остаются доступны до закрытия;
+        # где ОС не дает удалить открытый файл, папка удалится при следующей записи
+        for name in os.listdir(self._versions_path):
+            if name not in keep:
+                shutil.rmtree(os.path.join(self._versions_path, name), ignore_errors=True)
+        if None not in keep:
+            return
+        for name in ('embeddings.npy', 'documents.json'):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis, :]
+        return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+    def _mask(self, snapshot: _Snapshot, where: dict):
+        if not where:
+            return None
+        masks = []
+        for key, value in where.items():
+            if key == '$or':
+                masks.append(np.logical_or.reduce([self._mask(snapshot, cond) for cond in value]))
+            elif key == '$and':
+                masks.append(np.logical_and.reduce([self._mask(snapshot, cond) for cond in value]))
+            elif isinstance(value, dict):
+                if set(value) != {'$eq'}:
+                    raise ValueError(f'Unsupported filter operator for {key}: {value}')
+                masks.append(snapshot.column(key, value['$eq']))
+            else:
+                masks.append(snapshot.column(key, value))
+        return np.logical_and.reduce(masks)
+
+    def _similarities(self, snapshot: _Snapshot, queries: np.ndarray):
+        n = snapshot.matrix.shape[0]
+        sims = np.empty((queries.shape[0], n), dtype=np.float32)
+        for start in range(0, n, self.BLOCK_SIZE):
+            block = np.asarray(snapshot.matrix[start:start + self.BLOCK_SIZE], dtype=np.float32)
+            sims[:, start:start + self.BLOCK_SIZE] = queries @ block.T
+        return sims
+
+    def similarity_search_by_vectors_with_score(self, embeddings, k: int = 4, filter: dict = None):
+        '''
+        Поиск сразу по нескольким векторам запросов.
+
+        Returns:
+          по списку пар документ-скор на каждый вектор.
+        '''
+
+        snapshot = self._load()
+        queries = self._normalize(embeddings)
+        if not snapshot.ids:
+            return [[] for _ in range(queries.shape[0])]
+
+        sims = self._similarities(snapshot, queries)
+        mask = self._mask(snapshot, filter)
+        if mask is not None:
+            sims[:, ~mask] = -np.inf
+        available = len(snapshot.ids) if mask is None else int(mask.sum())
+        k = min(k, available)
+        if k == 0:
+            return [[] for _ in range(queries.shape[0])]
+
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        distances = 2 - 2 * np.take_along_axis(top_sims, order, axis=1)
+
+        return [
+            [
+                (Document(id=snapshot.ids[i], page_content=snapshot.contents[i], metadata=snapshot.metadatas[i]),
+                 float(distance))
+                for i, distance in zip(row, row_distances)
+            ]
+            for row, row_distances in zip(top, distances)
+        ]
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4, filter: dict = None):
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def count(self):
+        return len(self._load().ids)
+
+    def get(self, ids=None, include=None, limit: int = None, **kwargs):
+        '''
+        То же, что Chroma.get: ids и запрошенные в include поля
+        (documents, metadatas, embeddings).
+        '''
+
+        include = ['documents', 'metadatas'] if include is None else include
+        snapshot = self._load()
+        positions = range(len(snapshot.ids)) if ids is None else \
+            [snapshot.positions[doc_id] for doc_id in ids if doc_id in snapshot.positions]
+        positions = list(positions)[:limit]
+
+        result = {'ids': [snapshot.ids[i] for i in positions]}
+        if 'documents' in include:
+            result['documents'] = [snapshot.contents[i] for i in positions]
+        if 'metadatas' in include:
+            result['metadatas'] = [snapshot.metadatas[i] for i in positions]
+        if 'embeddings' in include:
+            result['embeddings'] = np.asarray(snapshot.matrix[positions], dtype=np.float32)
+        return result
+
+    def add_embeddings(self, ids, embeddings, contents, metadatas):
+        '''
+        Добавляет (или заменяет по id) документы с уже посчитанными эмбеддингами.
+        Индекс переписывается целиком - для коллекции в тысячи чанков это быстро.
+        '''
+
+        with self._lock:
+            _, snapshot = self._read_current()
+            replaced = set(ids)
+            keep = [i for i, doc_id in enumerate(snapshot.ids) if doc_id not in replaced]
+
+            vectors = self._normalize(embeddings).astype(self.dtype)
+            if keep:
+                vectors = np.concatenate([np.asarray(snapshot.matrix[keep], dtype=self.dtype), vectors])
+            self._save(
+                vectors,
+                [snapshot.ids[i] for i in keep] + list(ids),
+                [snapshot.contents[i] for i in keep] + list(contents),
+                [snapshot.metadatas[i] for i in keep] + list(metadatas),
+            )
+        return list(ids)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        embeddings = self.embedding_function.embed_documents(texts)
+        return self.add_embeddings(ids, embeddings, texts, metadatas)
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return None
+        with self._lock:
+            _, snapshot = self._read_current()
+            removed = set(ids)
+            keep = [i for i, doc_id in enumerate(snapshot.ids) if doc_id not in removed]
+            self._save(
+                np.asarray(snapshot.matrix[keep], dtype=self.dtype),
+                [snapshot.ids[i] for i in keep],
+                [snapshot.contents[i] for i in keep],
+                [snapshot.metadatas[i] for i in keep],
+            )
+        return True
+
+    @classmethod
+    def from_texts(cls, texts, embedding: Embeddings, metadatas=None, ids=None,
+                   path: str = 'app/storage/mmap_index', dtype: str = 'float16', **kwargs):
+        store = cls(embedding, path=path, dtype=dtype)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -1,19 +1,249 @@
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-
-from app.src.utils import get_config
-
-
-config = get_config()
-
-# Создаем локальное векторное хранилище, к нему подключаем эмбеддинги E5
-# (теперь от HuggingFace, ведь, как оказалось, Fastembeddings под капотом меняли E5 на другую модель).
-# По идее, E5 должна хорошо подходить для смеси русского текста и английской терминологии,
-# а еще показывает неплохие показатели.
-embeddings = HuggingFaceEmbeddings(model_name=config.embeddings.model_name)
-
-vector_store = Chroma(
-    collection_name='documents',
-    embedding_function=embeddings,
-    persist_directory='app/storage/documents_chroma_db',
-)
\ No newline at end of file
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+from app.src.utils import get_config
+from app.constants import TAG_METADATA_KEYS
+from app.src.metrics import store_query, register_cache
+from app.src.vectorstore.embedding_cache import CachedEmbeddings
+from app.src.vectorstore.embedding_backends import create_backend
+from app.src.vectorstore.embedding_batcher import BatchingEmbeddings
+from app.src.vectorstore.mmap_store import MmapVectorStore
+
+
+config = get_config()
+
+_lock = threading.Lock()
+_embeddings = None
+_vector_store = None
+
+
+def _create_embeddings():
+    # Подключаем эмбеддинги E5
+    # (теперь от HuggingFace, ведь, как оказалось, Fastembeddings под капотом меняли E5 на другую модель).
+    # По идее, E5 должна хорошо подходить для смеси русского текста и английской терминологии,
+    # а еще показывает неплохие показатели.
+    # Бэкенд (sentence-transformers или ONNX Runtime с int8) выбирается в embeddings.backend,
+    # он же добавляет префиксы E5 "query: " / "passage: ".
+    embeddings = create_backend()
+    cache_namespace = embeddings.cache_namespace
+
+    # Одновременные запросы объединяются в один прогон модели.
+    # Батчер стоит под кэшем: попадания в кэш не ждут в очереди
+    if config.embedding_batcher.enabled:
+        embeddings = BatchingEmbeddings(
+            embeddings,
+            max_batch_size=config.embedding_batcher.max_batch_size,
+            max_wait=config.embedding_batcher.max_wait_ms / 1000,
+            timeout=config.embedding_batcher.timeout
+        )
+
+    # Запросы часто повторяются (адреса офисов, почта для резюме),
+    # поэтому эмбеддинги запросов кэшируем в памяти и на диске.
+    if config.embedding_cache.enabled:
+        embeddings = CachedEmbeddings(
+            embeddings,
+            namespace=cache_namespace,
+            memory_size=config.embedding_cache.memory_size,
+            path=config.embedding_cache.path,
+            disk_size=config.embedding_cache.disk_size
+        )
+        register_cache('embedding', embeddings.stats)
+    return embeddings
+
+
+def get_embeddings():
+    '''
+    Модель эмбеддингов. Загружается при первом обращении (это долго),
+    дальше переиспользуется.
+    '''
+
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                _embeddings = _create_embeddings()
+    return _embeddings
+
+
+CHROMA_PATH = 'app/storage/documents_chroma_db'
+
+
+def _create_chroma(embeddings):
+    return Chroma(
+        collection_name='documents',
+        embedding_function=embeddings,
+        persist_directory=CHROMA_PATH,
+    )
+
+
+def _create_mmap_store(embeddings):
+    return MmapVectorStore(
+        embeddings,
+        path=config.vectorstore.mmap.path,
+        dtype=config.vectorstore.mmap.dtype
+    )
+
+
+def get_vector_store():
+    '''
+    Локальное векторное хранилище с подключенными эмбеддингами:
+    Chroma или MmapVectorStore, в зависимости от vectorstore.backend.
+    Открывается при первом обращении.
+    '''
+
+    global _vector_store
+    if _vector_store is None:
+        embeddings = get_embeddings()
+        with _lock:
+            if _vector_store is None:
+                if config.vectorstore.backend == 'mmap':
+                    _vector_store = _create_mmap_store(embeddings)
+                else:
+                    _vector_store = _create_chroma(embeddings)
+    return _vector_store
+
+
+def __getattr__(name):
+    # Старые импорты вида `from ...vectorstore import vector_store` (блокноты) продолжают работать,
+    # но модель грузится только в момент такого импорта, а не при импорте модуля
+    if name == 'embeddings':
+        return get_embeddings()
+    if name == 'vector_store':
+        return get_vector_store()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# Прогон E5 упирается в CPU, поэтому в асинхронном пути эмбеддинги и поиск
+# по базе выполняются в отдельном ограниченном пуле, а не в event loop.
+embedding_executor = ThreadPoolExecutor(
+    max_workers=config.concurrency.embedding_workers,
+    thread_name_prefix='embeddings'
+)
+
+
+async def run_in_embedding_executor(func, *args, **kwargs):
+    '''
+    Выполняет CPU-bound вызов (эмбеддинг, поиск по базе) в пуле embedding_executor.
+    Контекст (метрики текущего запроса, callbacks LangChain) копируется в поток, как в asyncio.to_thread.
+    '''
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(embedding_executor, partial(context.run, func, *args, **kwargs))
+
+
+def embed_queries(texts: list[str]):
+    '''
+    Эмбеддинги нескольких запросов за один прогон модели (с учетом кэша, если он включен).
+    '''
+
+    return get_embeddings().embed_queries(texts)
+
+
+def search_many(queries: list[str], k: int, where: dict = None):
+    '''
+    Семантический поиск сразу по нескольким вариантам запроса: эмбеддинги
+    всех вариантов считаются одним батчем, в Chroma уходит один запрос
+    со списком векторов.
+
+    Args:
+      queries: варианты запроса.
+      k: сколько документов вернуть на каждый вариант.
+      where: необязательный фильтр по метаданным, общий для всех вариантов.
+
+    Returns:
+      по списку пар документ-скор (расстояние, меньше - лучше) на каждый вариант,
+      в том же порядке, что и queries.
+    '''
+
+    if not queries:
+        return []
+    vectors = embed_queries(queries)
+    vector_store = get_vector_store()
+    if isinstance(vector_store, MmapVectorStore):
+        with store_query('mmap', 'search'):
+            return vector_store.similarity_search_by_vectors_with_score(vectors, k=k, filter=where)
+
+    with store_query('chroma', 'search'):
+        results = vector_store._collection.query(
+            query_embeddings=vectors,
+            n_results=k,
+            where=where,
+            include=['documents', 'metadatas', 'distances']
+        )
+    return [
+        [
+            (Document(id=doc_id, page_content=content, metadata=metadata or {}), distance)
+            for doc_id, content, metadata, distance in zip(ids, documents, metadatas, distances)
+        ]
+        for ids, documents, metadatas, distances in zip(
+            results['ids'], results['documents'], results['metadatas'], results['distances']
+        )
+    ]
+
+
+def count_documents():
+    vector_store = get_vector_store()
+    if isinstance(vector_store, MmapVectorStore):
+        return vector_store.count()
+    return vector_store._collection.count()
+
+
+def has_tag_fields():
+    '''
+    Есть ли у чанков булевы поля тегов (см. tag_metadata). У индекса, собранного
+    блокнотом до их появления, есть только строка tags: фильтр по тегам
+    (tagged_search) в нем ничего не находит, пока не выполнена переиндексация app/ingest.py.
+    Пустая коллекция считается подходящей.
+    '''
+
+    metadatas = get_vector_store().get(limit=1, include=['metadatas'])['metadatas']
+    return not metadatas or any(key in (metadatas[0] or {}) for key in TAG_METADATA_KEYS.values())
+
+
+def collection_version():
+    '''
+    Дешевый "отпечаток" состояния коллекции documents: число чанков и время
+    последней записи манифеста индексации (app/ingest.py).
+    Используется кэшами, которые нужно сбрасывать после переиндексации.
+    '''
+
+    try:
+        manifest_mtime = os.stat(config.ingestion.manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        manifest_mtime = None
+    return count_documents(), manifest_mtime
+
+
+def export_to_mmap():
+    '''
+    Копирует коллекцию Chroma в MmapVectorStore вместе с уже посчитанными
+    эмбеддингами, без повторного прогона модели.
+
+    Returns:
+      число перенесенных чанков.
+    '''
+
+    data = _create_chroma(get_embeddings()).get(include=['documents', 'metadatas', 'embeddings'])
+    store = _create_mmap_store(get_embeddings())
+    store.delete(ids=store.get(include=[])['ids'])
+    store.add_embeddings(data['ids'], data['embeddings'], data['documents'], data['metadatas'])
+    return len(data['ids'])
+
+
+def warmup(query: str):
+    '''
+    Прогревает модель и хранилище: один прямой проход модели в обход кэша
+    эмбеддингов и один поиск по базе.
+    '''
+
+    embeddings = get_embeddings()
+    getattr(embeddings, 'embeddings', embeddings).embed_query(query)
+    get_vector_store().similarity_search_with_score(query, k=1)
\ No newline at end of file
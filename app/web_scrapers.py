@@ -1,63 +1,134 @@
+import logging
+from contextlib import asynccontextmanager
+
 from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 import asyncio
 
 from app.constants import CONTACTS_URL, CAREER_URL, CUSTOMERS_URL
 
 
+logger = logging.getLogger(__name__)
+
+
+# Картинки, шрифты и видео скрэпперам не нужны, а грузятся дольше всего
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'media'}
+
+
+# Общий браузер для всех скрэпперов.
+# Firefox запускается один раз, страницы открываются в одном контексте,
+# одновременно открыто не больше max_pages страниц.
+class ScrapeEngine:
+    def __init__(self, max_pages: int = 4, headless: bool = True):
+        self.max_pages = max_pages
+        self.headless = headless
+        self._semaphore = asyncio.Semaphore(max_pages)
+        self._playwright = None
+        self._browser = None
+        self._context = None
+
+    async def __aenter__(self):
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.firefox.launch(headless=self.headless)
+        self._context = await self._browser.new_context(ignore_https_errors=True)
+        await self._context.route('**/*', self._block_resources)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._context.close()
+        await self._browser.close()
+        await self._playwright.stop()
+
+    @staticmethod
+    async def _block_resources(route):
+        if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    @asynccontextmanager
+    async def page(self, url: str):
+        # Ждем только DOM: нужные элементы дальше ждем селекторами, а не networkidle
+        async with self._semaphore:
+            page = await self._context.new_page()
+            try:
+                await page.goto(url, wait_until='domcontentloaded', timeout=60000)
+                yield page
+            finally:
+                await page.close()
+
+
+async def _run(engine, scraper, *args):
+    # Скрэпперы можно вызывать и по отдельности - тогда браузер поднимается только под них
+    if engine is not None:
+        return await scraper(engine, *args)
+    async with ScrapeEngine() as own_engine:
+        return await scraper(own_engine, *args)
+
+
+async def _inner_text(locator):
+    text = await locator.evaluate('element => element.innerText')
+    return text.strip().replace('\n', ' ')
+
+
 # Скрэппер для адресов компании в разных городах
-async def scrape_city_addresses():
-    url = CONTACTS_URL
+async def _scrape_city_addresses(engine, url):
     city_data = {}
 
     cities_container_selector = '.contacts-cities-container'
     button_selector = 'a'
     details_container_selector = '.selected-city-details'
 
-    async with async_playwright() as p:
-        # Заходим браузером на страницу контактов
-        browser = await p.firefox.launch(headless=True)
-        context = await browser.new_context(ignore_https_errors=True)
-        page = await context.new_page()
-
-        await page.goto(url, wait_until='networkidle', timeout=60000)
-
+    # Заходим браузером на страницу контактов
+    async with engine.page(url) as page:
         # Находим контейнер с кнопками
-        await page.wait_for_selector(cities_container_selector, state='visible', timeout=3000)
+        await page.wait_for_selector(cities_container_selector, state='visible', timeout=10000)
         cities_container = page.locator(cities_container_selector)
 
         city_buttons_locator = cities_container.locator(button_selector)
         button_count = await city_buttons_locator.count()
 
-        # Прокликиваем по очкереди каждую кнопку, собирая информацию по городам
+        # Прокликиваем по очереди каждую кнопку, собирая информацию по городам
         for i in range(button_count):
-            current_buttons_locator = cities_container.locator(button_selector)
-            button = current_buttons_locator.nth(i)
+            button = cities_container.locator(button_selector).nth(i)
 
             city_name = await button.text_content()
             city_name = city_name.strip()
 
+            details_locator = page.locator(details_container_selector)
+            previous_text = await details_locator.evaluate('element => element.innerText') \
+                if await details_locator.count() else None
+
             await button.click(timeout=1000)
-            await asyncio.sleep(1)
 
             try:
-                details_locator = page.locator(details_container_selector)
                 await details_locator.wait_for(state='visible', timeout=3000)
-    
-                details_text = await details_locator.evaluate('element => element.innerText', timeout=1000)
-                city_data[city_name] = details_text.strip().replace('\n', ' ')
+                # Вместо фиксированной паузы ждем, пока блок с деталями сменит содержимое.
+                # Для уже выбранного города текст не изменится - тогда просто берем текущий
+                try:
+                    await page.wait_for_function(
+                        '([selector, previous]) => {'
+                        ' const el = document.querySelector(selector);'
+                        ' return el && el.innerText !== previous; }',
+                        arg=[details_container_selector, previous_text],
+                        timeout=1000
+                    )
+                except PlaywrightTimeoutError:
+                    pass
+
+                city_data[city_name] = await _inner_text(details_locator)
             except PlaywrightTimeoutError:
                 continue
-                
-
-        await browser.close()
 
     return city_data
 
 
-# Скрэппер для информации о заказчиках
-# Работает по тому же принципу, что и scrape_city_addresses    
-async def scrape_customer_details():
-    url = CUSTOMERS_URL
+async def scrape_city_addresses(engine: ScrapeEngine = None, url: str = CONTACTS_URL):
+    return await _run(engine, _scrape_city_addresses, url)
+
+
+# Собирает клиентов с одной страницы пагинации.
+# Каждая страница пагинации открывается в своей вкладке, так что страницы обходятся параллельно
+async def _scrape_customers_page(engine, url, index):
     customer_data = []
 
     pagination_container_selector = '.customers-pagination__pages'
@@ -67,75 +138,91 @@ async def scrape_customer_details():
     customers_modal_content_selector = '.customer-modal__content-inner'
     close_button_selector = '.customer-modal__close'
 
-    async with async_playwright() as p:
-        browser = await p.firefox.launch(headless=True)
-        context = await browser.new_context(ignore_https_errors=True)
-        page = await context.new_page()
+    async with engine.page(url) as page:
+        await page.wait_for_selector(pagination_container_selector, state='visible', timeout=10000)
+        await page.locator(customers_container_selector).wait_for(state='visible', timeout=10000)
+        customers_container = page.locator(customers_container_selector)
 
-        await page.goto(url, wait_until='networkidle', timeout=60000)
+        if index > 0:
+            first_block = customers_container.locator(customers_list_block_selector).first
+            previous_text = await first_block.evaluate('element => element.innerText')
 
-        await page.wait_for_selector(pagination_container_selector, state='visible', timeout=5000)
-        pagination_container = page.locator(pagination_container_selector)
+            button = page.locator(pagination_container_selector).locator(button_selector).nth(index)
+            await button.click(timeout=3000)
 
-        pagination_buttons_locator = pagination_container.locator(button_selector)
-        button_count = await pagination_buttons_locator.count()
+            # Вместо networkidle ждем, пока список перерисуется под новую страницу
+            await page.wait_for_function(
+                '([selector, previous]) => {'
+                ' const el = document.querySelector(selector);'
+                ' return el && el.innerText !== previous; }',
+                arg=[f'{customers_container_selector} {customers_list_block_selector}', previous_text],
+                timeout=10000
+            )
 
-        for i in range(button_count):
-            current_buttons_locator = pagination_container.locator(button_selector)
-            button = current_buttons_locator.nth(i)
+        customer_block_locator = customers_container.locator(customers_list_block_selector)
+        customers_count = await customer_block_locator.count()
 
-            await button.click(timeout=3000)
-            await page.wait_for_load_state('networkidle', timeout=60000)
+        for j in range(customers_count):
+            try:
+                block = customers_container.locator(customers_list_block_selector).nth(j) # Troubles with blocks 11-15
+                await block.scroll_into_view_if_needed()
+                await block.click(timeout=3000)
+
+                details_locator = page.locator(customers_modal_content_selector)
+                await details_locator.wait_for(state='visible', timeout=10000)
+                customer_data.append(await _inner_text(details_locator))
+
+                close_button_locator = page.locator(close_button_selector)
+                await close_button_locator.click(timeout=3000)
+                await details_locator.wait_for(state='hidden', timeout=10000)
+            except Exception as e:
+                logger.warning('Skipping customer block %d on page %d: %s', j, index, e)
+                continue
 
-            await page.locator(customers_container_selector).wait_for(state='visible', timeout=10000)
-            customers_container = page.locator(customers_container_selector)
-            customer_block_locator = customers_container.locator(customers_list_block_selector)
-            customers_count = await customer_block_locator.count()
+    return customer_data
 
-            for j in range(customers_count):
-                try:
-                    current_customers_locator = customers_container.locator(customers_list_block_selector)
-                    block = current_customers_locator.nth(j) # Troubles with blocks 11-15
-                    await block.scroll_into_view_if_needed()
-                    await block.click(timeout=3000)
 
-                    locator = page.locator(customers_modal_content_selector)
-                    await locator.wait_for(state='visible', timeout=10000)
+# Скрэппер для информации о заказчиках
+async def _scrape_customer_details(engine, url):
+    pagination_container_selector = '.customers-pagination__pages'
+    button_selector = '.customers-pagination__link'
 
-                    details_locator = page.locator(customers_modal_content_selector)
-                    details_text = await details_locator.evaluate('element => element.innerText')
-                    customer_data.append(details_text.strip().replace('\n', ' '))
+    # Узнаем число страниц пагинации, затем обходим их параллельно
+    async with engine.page(url) as page:
+        await page.wait_for_selector(pagination_container_selector, state='visible', timeout=10000)
+        pages_count = await page.locator(pagination_container_selector).locator(button_selector).count()
 
-                    close_button_locator = page.locator(close_button_selector)
-                    await close_button_locator.click(timeout=3000)
-                    await page.locator(customers_modal_content_selector).wait_for(state='hidden', timeout=10000)
-                except Exception as e:
-                    print(f'{e}: Skipping block {j}')
-                    continue
+    pages = await asyncio.gather(*(
+        _scrape_customers_page(engine, url, index)
+        for index in range(pages_count)
+    ))
+    return [customer for page_data in pages for customer in page_data]
 
-        await browser.close()
 
-    return customer_data
+async def scrape_customer_details(engine: ScrapeEngine = None, url: str = CUSTOMERS_URL):
+    return await _run(engine, _scrape_customer_details, url)
 
 
 # Скрэппер для имейла карьерного центра
-async def scrape_career_details():
-    url = CAREER_URL
+async def _scrape_career_details(engine, url):
     email_container_selector = '.InfoBLock__info-info'
 
-    async with async_playwright() as p:
-        browser = await p.firefox.launch(headless=True)
-        context = await browser.new_context(ignore_https_errors=True)
-        page = await context.new_page()
-
-        await page.goto(url, wait_until='networkidle', timeout=60000)
+    async with engine.page(url) as page:
+        await page.wait_for_selector(email_container_selector, state='visible', timeout=10000)
+        return await _inner_text(page.locator(email_container_selector))
 
-        await page.wait_for_selector(email_container_selector, state='visible', timeout=6000)
-        email_container = page.locator(email_container_selector)
 
-        details_text = await email_container.evaluate('element => element.innerText', timeout=10000)
-        data = details_text.strip().replace('\n', ' ')
+async def scrape_career_details(engine: ScrapeEngine = None, url: str = CAREER_URL):
+    return await _run(engine, _scrape_career_details, url)
 
-        await browser.close()
 
-    return data
\ No newline at end of file
+# Запускает все скрэпперы разом в одном браузере
+async def scrape_all(max_pages: int = 4, urls: dict = None):
+    urls = urls or {}
+    async with ScrapeEngine(max_pages=max_pages) as engine:
+        city_data, customer_data, career_data = await asyncio.gather(
+            scrape_city_addresses(engine, urls.get('contacts', CONTACTS_URL)),
+            scrape_customer_details(engine, urls.get('customers', CUSTOMERS_URL)),
+            scrape_career_details(engine, urls.get('career', CAREER_URL)),
+        )
+    return {'cities': city_data, 'customers': customer_data, 'career': career_data}